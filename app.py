@@ -1,12 +1,19 @@
-from flask import Flask, jsonify, render_template, request, Response
-from database import CatalogDatabase
+from flask import Flask, jsonify, render_template, request, Response, url_for
+from database import CatalogDatabase, PRODUCT_SORTS, SchemaVersionError
 from feed_parser import FeedParser
+from ingest_jobs import IngestJobManager
+from response_cache import ResponseCache
+from search_index import SearchIndexManager
 import os
-from datetime import datetime
+import csv
+import io
+import json
+import zlib
+from contextlib import ExitStack
 import signal
 import sys
 import subprocess
-from threading import Timer, Lock
+from threading import Timer
 import time
 import logging
 from functools import wraps
@@ -31,9 +38,45 @@ logger.addHandler(console_handler)
 # Конфигурация
 XML_FILE = "catalog_feed.xml"
 PORT = 5003
-
-# Блокировка для обновления каталога
-update_lock = Lock()
+# Дельта-загрузка: перезаписываются только изменившиеся товары, пропавшие из фида удаляются
+DELTA_INGEST = os.getenv('DELTA_INGEST', '1') != '0'
+# Сборка новой версии каталога в отдельной схеме и атомарное переключение на нее.
+# Каждая версия - полная копия каталога с заново построенными индексами, поэтому
+# по умолчанию выключено: дельта-загрузка на месте пишет только изменившиеся товары
+VERSIONED_INGEST = os.getenv('VERSIONED_INGEST', '0') != '0'
+# Сколько предыдущих версий каталога хранить для отката
+CATALOG_KEEP_VERSIONS = int(os.getenv('CATALOG_KEEP_VERSIONS', '2'))
+# Число потоков записи при конвейерной загрузке (0 - запись в потоке разбора)
+INGEST_WRITERS = int(os.getenv('INGEST_WRITERS', '2'))
+# Число процессов нормализации товаров (0 - в процессе воркера)
+INGEST_PROCESSES = int(os.getenv('INGEST_PROCESSES', '0'))
+# Кэш ответов API: число записей и объем в памяти воркера, общий кэш в Postgres
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '1024'))
+RESPONSE_CACHE_MAX_MB = int(os.getenv('RESPONSE_CACHE_MAX_MB', '64'))
+RESPONSE_CACHE_SHARED = os.getenv('RESPONSE_CACHE_SHARED', '0') != '0'
+# Сколько секунд одинаковый запрос ждет уже выполняющийся (0 - не объединять запросы)
+COALESCE_TIMEOUT = float(os.getenv('COALESCE_TIMEOUT', '30'))
+# Подсказки поиска: максимальное число вариантов и бюджет времени на запрос
+SUGGEST_LIMIT = int(os.getenv('SUGGEST_LIMIT', '10'))
+SUGGEST_TIMEOUT_MS = int(os.getenv('SUGGEST_TIMEOUT_MS', '200'))
+# Поиск по снимку индекса в памяти воркера; база отвечает, если снимок не справился
+SEARCH_INDEX = os.getenv('SEARCH_INDEX', '0') != '0'
+SEARCH_INDEX_DIR = os.getenv('SEARCH_INDEX_DIR', 'search_index')
+# Запросы с большим числом кандидатов дешевле выполнить в Postgres
+SEARCH_INDEX_MAX_CANDIDATES = int(os.getenv('SEARCH_INDEX_MAX_CANDIDATES', '20000'))
+# Максимум id и артикулов в одном запросе /api/products/batch
+BATCH_MAX_PRODUCTS = int(os.getenv('BATCH_MAX_PRODUCTS', '100'))
+# Выгрузка каталога: товаров в пачке серверного курсора и размер куска ответа
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '5000'))
+EXPORT_CHUNK_BYTES = 64 * 1024
+# Колонки CSV-выгрузки; category_paths - JSON-массив путей категорий
+EXPORT_CSV_COLUMNS = ('id', 'article', 'name', 'price', 'url', 'picture', 'category_paths')
+# Пул соединений воркера: размер и сколько секунд ждать свободное соединение
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '20'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+# Подготовленные запросы на сервере (0 - для PgBouncer в режиме пула транзакций)
+PREPARED_STATEMENTS = os.getenv('PREPARED_STATEMENTS', '1') != '0'
 
 # Параметры подключения к базе данных
 def get_db_params():
@@ -64,8 +107,11 @@ def get_db_params():
         'port': os.getenv('DB_PORT', '5432')
     }
 
-# Глобальная переменная для базы данных
+# Глобальные переменные для базы данных и фоновых заданий загрузки
 db = None
+jobs = None
+cache = None
+search_index = None
 
 def init_database(max_retries=5, retry_delay=5):
     """Инициализация базы данных с повторными попытками"""
@@ -77,9 +123,20 @@ def init_database(max_retries=5, retry_delay=5):
             logger.info(f"Попытка подключения к базе данных ({retry_count + 1}/{max_retries})...")
             db_params = get_db_params()
             logger.info(f"Параметры подключения: host={db_params['host']}, port={db_params['port']}, dbname={db_params['dbname']}, user={db_params['user']}")
-            db = CatalogDatabase(**db_params)
+            db = CatalogDatabase(
+                **db_params,
+                coalesce_timeout=COALESCE_TIMEOUT,
+                pool_min=DB_POOL_MIN,
+                pool_max=DB_POOL_MAX,
+                pool_timeout=DB_POOL_TIMEOUT,
+                prepare_statements=PREPARED_STATEMENTS
+            )
             logger.info("База данных успешно инициализирована")
             return True
+        except SchemaVersionError as e:
+            # Повторные попытки не помогут, пока не выполнена flask migrate
+            logger.error(str(e))
+            return False
         except Exception as e:
             retry_count += 1
             logger.error(f"Ошибка при подключении к базе данных: {str(e)}")
@@ -94,10 +151,61 @@ def get_db():
     """Получение экземпляра базы данных"""
     global db
     if db is None:
-        if not init_database():
+        # Из обработчика запроса пробуем один раз, без ожидания между попытками:
+        # воркеры подключаются заранее в warm_up
+        if not init_database(max_retries=1):
             raise Exception("Не удалось инициализировать базу данных")
     return db
 
+def warm_up():
+    """Подготовка процесса к первому запросу: проверка версии схемы и соединения пула.
+
+    Вызывается из хуков gunicorn (см. gunicorn.conf.py); при preload_app
+    проверка схемы выполняется один раз в мастере, а воркер только
+    открывает свои соединения.
+    """
+    if db is None and not init_database():
+        raise Exception("Не удалось инициализировать базу данных")
+    db.warm_up()
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Применение миграций схемы базы данных (flask --app app migrate)"""
+    with CatalogDatabase(**get_db_params(), migrate=True):
+        pass
+
+def get_jobs():
+    """Получение менеджера фоновых заданий загрузки"""
+    global jobs
+    if jobs is None:
+        jobs = IngestJobManager(get_db(), update_catalog)
+    return jobs
+
+def get_cache():
+    """Получение кэша ответов API"""
+    global cache
+    if cache is None:
+        cache = ResponseCache(
+            get_db(),
+            max_entries=RESPONSE_CACHE_SIZE,
+            max_bytes=RESPONSE_CACHE_MAX_MB * 1024 * 1024,
+            shared=RESPONSE_CACHE_SHARED
+        )
+    return cache
+
+def get_search_index():
+    """Получение снимка поиска воркера; None, если поиск в памяти выключен"""
+    global search_index
+    if not SEARCH_INDEX:
+        return None
+    if search_index is None:
+        search_index = SearchIndexManager(
+            get_db(), SEARCH_INDEX_DIR,
+            max_candidates=SEARCH_INDEX_MAX_CANDIDATES,
+            keep=CATALOG_KEEP_VERSIONS + 1
+        )
+    return search_index
+
 # Настройка базовой аутентификации
 def check_auth(username, password):
     """Проверяет учетные данные пользователя"""
@@ -128,24 +236,37 @@ def before_request():
             return authenticate()
     # Проверяем подключение к базе данных
     try:
-        get_db()
+        get_db().begin_request()
     except Exception as e:
         return jsonify({'error': 'Database connection error'}), 500
 
-def update_catalog():
-    """Обновление каталога из XML-фида"""
+@app.teardown_request
+def teardown_request(exc):
+    # Область запроса в пуле соединений закрывается
+    if db is not None:
+        db.end_request()
+
+def update_catalog(progress=None):
+    """Обновление каталога из XML-фида.
+
+    Выполняется в фоновом задании, которое держит блокировку загрузки в Postgres.
+    """
     if not os.path.exists(XML_FILE):
         raise FileNotFoundError(f'Файл {XML_FILE} не найден')
     
-    # Используем блокировку для предотвращения параллельных обновлений
-    if not update_lock.acquire(blocking=False):
-        raise RuntimeError('Обновление каталога уже выполняется')
-    
-    try:
-        parser = FeedParser(XML_FILE, get_db())
-        parser.parse()
-    finally:
-        update_lock.release()
+    parser = FeedParser(
+        XML_FILE, get_db(),
+        delta=DELTA_INGEST,
+        versioned=VERSIONED_INGEST,
+        keep_versions=CATALOG_KEEP_VERSIONS,
+        writers=INGEST_WRITERS,
+        processes=INGEST_PROCESSES,
+        progress=progress
+    )
+    summary = parser.parse()
+    if get_search_index() is not None:
+        get_search_index().publish()
+    return summary
 
 @app.route('/')
 def index():
@@ -154,74 +275,324 @@ def index():
 
 @app.route('/update')
 def update_catalog_route():
-    """Обработчик для обновления каталога"""
+    """Запуск фонового обновления каталога"""
     try:
-        start_time = datetime.now()
-        update_catalog()
-        execution_time = (datetime.now() - start_time).total_seconds()
+        if not os.path.exists(XML_FILE):
+            raise FileNotFoundError(f'Файл {XML_FILE} не найден')
         
-        stats = get_db().get_statistics()
+        job_id = get_jobs().start()
         
         return jsonify({
             'success': True,
-            'message': 'Каталог успешно обновлен',
-            'stats': {
-                **stats,
-                'execution_time': execution_time
-            }
-        })
+            'message': 'Обновление каталога запущено',
+            'job_id': job_id,
+            'status_url': url_for('job_status_api', job_id=job_id)
+        }), 202
     
+    except RuntimeError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 409
     except Exception as e:
         return jsonify({
             'success': False,
             'error': str(e)
         })
 
+@app.route('/api/jobs/<int:job_id>')
+def job_status_api(job_id):
+    """API для получения состояния задания загрузки"""
+    job = get_jobs().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/versions')
+def versions_api():
+    """API для получения списка версий каталога"""
+    return jsonify(get_db().get_catalog_versions())
+
+@app.route('/rollback/<int:version>')
+def rollback_catalog_route(version):
+    """Откат каталога на сохраненную предыдущую версию"""
+    try:
+        get_db().rollback_catalog(version)
+        if get_search_index() is not None:
+            get_search_index().publish()
+        return jsonify({
+            'success': True,
+            'message': f'Каталог откатен на версию {version}'
+        })
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 404
+    except RuntimeError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 409
+
 @app.route('/api/search')
 def search_api():
-    """API для поиска товаров"""
+    """API для поиска товаров.
+
+    С параметром cursor (пустым для первой страницы) результаты отдаются
+    постранично по курсору, иначе - списком лучших per_page товаров.
+    """
     query = request.args.get('q', '').strip()
+    cursor = request.args.get('cursor')
+    per_page = request.args.get('per_page', 50, type=int)
+    category_id = request.args.get('category_id', type=int)
+    min_price = request.args.get('min_price', type=float)
+    max_price = request.args.get('max_price', type=float)
+    include_total = request.args.get('total', '0') in ('1', 'true')
+    
+    if per_page < 1:
+        return jsonify({'error': 'Invalid pagination parameters'}), 400
     if len(query) < 2:  # Минимальная длина запроса - 2 символа
-        return jsonify([])
+        if cursor is None:
+            return jsonify([])
+        return jsonify({'per_page': per_page, 'next_cursor': None, 'items': []})
+    
+    # Снимок в памяти не знает дерева категорий, такие запросы идут в базу
+    if get_search_index() is not None and category_id is None:
+        result = get_search_index().search(
+            query, cursor or None, per_page, min_price, max_price,
+            include_total and cursor is not None
+        )
+        if result is not None:
+            return jsonify(result if cursor is not None else result['items'])
+    
+    def produce():
+        try:
+            result = get_db().search_products(
+                query, cursor or None, per_page, category_id, min_price, max_price,
+                include_total and cursor is not None
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return result if cursor is not None else result['items']
     
     try:
-        products = get_db().search_products(query)
-        return jsonify(products)
+        return get_cache().respond(produce)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/suggest')
+def suggest_api():
+    """API для подсказок в строке поиска"""
+    query = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', SUGGEST_LIMIT, type=int), SUGGEST_LIMIT)
+    if len(query) < 2 or limit < 1:
+        return jsonify({'products': [], 'categories': []})
+    
+    def produce():
+        suggestions = get_db().suggest(query, limit, SUGGEST_TIMEOUT_MS)
+        if suggestions.get('partial'):
+            # Неполный ответ из-за превышения времени не кэшируем
+            return jsonify(suggestions), 200
+        return suggestions
+    
+    try:
+        return get_cache().respond(produce)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/statistics')
 def statistics_api():
-    """API для получения статистики каталога"""
-    return jsonify(get_db().get_statistics())
+    """API для получения статистики каталога или, с category_id, одной категории"""
+    category_id = request.args.get('category_id', type=int)
+    if category_id is None:
+        return get_cache().respond(lambda: get_db().get_statistics())
+    
+    def produce():
+        stats = get_db().get_category_statistics(category_id)
+        if stats is None:
+            return jsonify({'error': 'Category not found'}), 404
+        return stats
+    
+    return get_cache().respond(produce)
 
 @app.route('/api/categories')
 def categories_api():
-    """API для получения дерева категорий"""
-    return jsonify(get_db().get_category_tree())
+    """API для получения дерева категорий.
+
+    С параметром depth отдаются только depth верхних уровней дерева.
+    """
+    depth = request.args.get('depth', type=int)
+    if depth is None:
+        return get_cache().respond(lambda: get_db().get_category_tree())
+    if depth < 1:
+        return jsonify({'error': 'Invalid depth'}), 400
+    return get_cache().respond(lambda: get_db().get_category_children(None, depth))
+
+@app.route('/api/categories/<int:category_id>/children')
+def category_children_api(category_id):
+    """API для получения подкатегорий на depth уровней вниз (по умолчанию один)"""
+    depth = request.args.get('depth', 1, type=int)
+    if depth < 1:
+        return jsonify({'error': 'Invalid depth'}), 400
+    
+    def produce():
+        children = get_db().get_category_children(category_id, depth)
+        if children is None:
+            return jsonify({'error': 'Category not found'}), 404
+        return children
+    
+    return get_cache().respond(produce)
+
+@app.route('/api/products/batch')
+def products_batch_api():
+    """API для получения товаров по списку id и артикулов одним запросом.
+
+    Каждый id и артикул - отдельный параметр (id=1&id=2&article=A-1), так что
+    значения могут содержать запятые.
+    """
+    ids = [value for value in request.args.getlist('id') if value]
+    articles = [value for value in request.args.getlist('article') if value]
+    if not ids and not articles:
+        return jsonify({'error': 'id or article required'}), 400
+    if len(ids) + len(articles) > BATCH_MAX_PRODUCTS:
+        return jsonify({'error': f'Too many products, max {BATCH_MAX_PRODUCTS}'}), 400
+    
+    try:
+        return get_cache().respond(lambda: get_db().get_products_by_ids(ids, articles))
+    except Exception as e:
+        logger.error(f"Ошибка при получении товаров по списку: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/api/products/<category_id>')
 def get_products(category_id):
-    """Получение товаров по категории"""
+    """Получение товаров по категории.
+
+    С параметром cursor (пустым для первой страницы) товары отдаются
+    постранично по курсору, иначе - по номеру страницы.
+    """
     try:
         logger.debug(f"Получен запрос на товары для категории {category_id}")
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 30, type=int)
+        sort = request.args.get('sort', 'id')
+        order = request.args.get('order', 'asc')
+        cursor = request.args.get('cursor')
         
         if page < 1 or per_page < 1:
             logger.error(f"Некорректные параметры пагинации: page={page}, per_page={per_page}")
             return jsonify({'error': 'Invalid pagination parameters'}), 400
-            
-        logger.debug(f"Параметры пагинации: page={page}, per_page={per_page}")
+        if sort not in PRODUCT_SORTS or order not in ('asc', 'desc'):
+            return jsonify({'error': 'Invalid sort parameters'}), 400
         
-        products = get_db().get_products_by_category(category_id, page, per_page)
-        logger.debug(f"Получено {len(products['items'])} товаров")
+        def produce():
+            if cursor is not None:
+                include_total = request.args.get('total', '0') in ('1', 'true')
+                try:
+                    products = get_db().get_products_by_cursor(
+                        category_id, cursor, per_page, sort, order, include_total
+                    )
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+            else:
+                logger.debug(f"Параметры пагинации: page={page}, per_page={per_page}")
+                products = get_db().get_products_by_category(category_id, page, per_page, sort, order)
+            logger.debug(f"Получено {len(products['items'])} товаров")
+            return products
         
-        return jsonify(products)
+        return get_cache().respond(produce)
     except Exception as e:
         logger.error(f"Ошибка при получении товаров: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/export')
+def export_api():
+    """Потоковая выгрузка товаров каталога или поддерева категории.
+
+    format - ndjson (товар на строку) или csv, gzip=1 - сжатый ответ.
+    Товары читаются из одного снимка каталога пачками через серверный
+    курсор, поэтому память воркера не зависит от размера выгрузки.
+    """
+    category_id = request.args.get('category_id', type=int)
+    export_format = request.args.get('format', 'ndjson')
+    compress = request.args.get('gzip', '0') in ('1', 'true')
+    
+    if category_id is None and request.args.get('category_id'):
+        return jsonify({'error': 'Invalid category_id'}), 400
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'error': 'Invalid format'}), 400
+    
+    # Курсор открывается до ответа, чтобы ошибки вернулись статусом, а не
+    # оборванным потоком; закрывается, когда сервер закроет ответ
+    export = ExitStack()
+    try:
+        version, items = export.enter_context(get_db().export_products(category_id, EXPORT_BATCH_SIZE))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        logger.error(f"Ошибка при выгрузке товаров: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+    
+    def lines():
+        if export_format == 'ndjson':
+            for item in items:
+                yield json.dumps(item, ensure_ascii=False) + '\n'
+            return
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_CSV_COLUMNS)
+        for item in items:
+            item['category_paths'] = json.dumps(item['category_paths'], ensure_ascii=False)
+            writer.writerow([item[column] for column in EXPORT_CSV_COLUMNS])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    def chunks():
+        gzip = zlib.compressobj(wbits=31) if compress else None
+        chunk = []
+        size = 0
+        for line in lines():
+            chunk.append(line)
+            size += len(line)
+            if size >= EXPORT_CHUNK_BYTES:
+                data = ''.join(chunk).encode('utf-8')
+                chunk, size = [], 0
+                # Сжатый поток может копить данные без вывода
+                data = gzip.compress(data) if gzip else data
+                if data:
+                    yield data
+        data = ''.join(chunk).encode('utf-8')
+        if gzip:
+            yield gzip.compress(data) + gzip.flush()
+        elif data:
+            yield data
+    
+    mimetype = 'application/x-ndjson' if export_format == 'ndjson' else 'text/csv'
+    filename = f"catalog-{version}{f'-{category_id}' if category_id is not None else ''}.{export_format}"
+    headers = {
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'X-Catalog-Version': str(version)
+    }
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+    response = Response(chunks(), mimetype=mimetype, headers=headers)
+    response.call_on_close(export.close)
+    return response
+
+@app.route('/api/metrics')
+def metrics_api():
+    """API для получения счетчиков кэша ответов, объединения запросов, пула соединений и подготовленных запросов"""
+    metrics = {
+        'coalescing': get_db().get_coalescing_stats(),
+        'connection_pool': get_db().get_pool_stats(),
+        'prepared_statements': get_db().get_statement_stats(),
+        'response_cache': get_cache().stats()
+    }
+    if get_search_index() is not None:
+        metrics['search_index'] = get_search_index().stats()
+    return jsonify(metrics)
+
 @app.route('/restart')
 def restart_server():
     """Перезапускает сервер"""
@@ -232,6 +603,10 @@ def restart_server():
 
 if __name__ == '__main__':
     try:
+        # Локальный запуск сам применяет миграции; в развертывании это делает flask migrate
+        with CatalogDatabase(**get_db_params(), migrate=True):
+            pass
+        
         # Инициализируем базу данных
         if not init_database():
             logger.error("Не удалось инициализировать базу данных")
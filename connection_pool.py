@@ -0,0 +1,289 @@
+import logging
+import os
+import threading
+import time
+import weakref
+from typing import Dict, List
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+
+class PoolTimeout(PoolError):
+    """Свободное соединение не появилось за время ожидания"""
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений Postgres.
+
+    Если все max_size соединений заняты, getconn ждет освободившееся до
+    timeout секунд и только потом бросает PoolTimeout. Соединение, простоявшее
+    в пуле дольше check_idle секунд, перед выдачей проверяется запросом
+    SELECT 1; закрытые и оборвавшиеся соединения заменяются новыми.
+
+    Внутри области запроса (begin_scope/end_scope) соединение между
+    обращениями к базе не удерживается: оно сразу возвращается в пул, и
+    ожидание (например, ответа, который считает другой запрос) не занимает
+    соединение. Следующее обращение в той же области забирает прежнее
+    соединение, если оно еще свободно, иначе - любое свободное.
+
+    После fork (воркеры gunicorn, процессы нормализации) пул в дочернем
+    процессе пересоздается: унаследованные сокеты принадлежат родителю, и
+    закрывать их по протоколу Postgres из потомка нельзя.
+    """
+
+    def __init__(self, conn_params: Dict, min_size: int = 1, max_size: int = 20,
+                 timeout: float = 10.0, check_idle: float = 5.0):
+        self.conn_params = conn_params
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.logger = logging.getLogger(__name__)
+
+        self._reset()
+        self.warm()
+
+        # Пул пересоздается в потомке сразу после fork, пока в нем один поток
+        pool = weakref.ref(self)
+        os.register_at_fork(after_in_child=lambda: pool() is not None and pool()._check_fork())
+
+    def getconn(self, scoped: bool = True):
+        """Соединение из пула; ждет свободное не дольше timeout секунд.
+
+        scoped=False - отдельное соединение и внутри области запроса.
+        """
+        self._check_fork()
+        scope = getattr(self._scope, 'state', None) if scoped else None
+        if scope is None:
+            return self._checkout()
+        conn = self._checkout(scope['conn'])
+        scope['conn'] = conn
+        return conn
+
+    def putconn(self, conn, close: bool = False):
+        """Возврат соединения; close=True - закрыть его вместо возврата"""
+        self._checkin(conn, close)
+
+    def warm(self):
+        """Открытие соединений до min_size (после fork пул потомка пуст)"""
+        self._check_fork()
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                self._release_slot()
+                raise
+            self._checkin(conn)
+
+    def begin_scope(self):
+        """Начало области запроса: дальше поток по возможности получает одно соединение"""
+        self._scope.state = {'conn': None}
+
+    def end_scope(self):
+        """Конец области запроса"""
+        self._scope.state = None
+
+    def closeall(self):
+        """Закрытие пула: свободные соединения закрываются сразу, занятые - при возврате"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            # Ожидающие свободное соединение получают PoolError
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            checkouts = self._stats['checkouts']
+            return {
+                **self._stats,
+                'wait_ms_avg': round(self._stats['wait_ms_total'] / checkouts, 3) if checkouts else 0.0,
+                'wait_ms_total': round(self._stats['wait_ms_total'], 3),
+                'wait_ms_max': round(self._stats['wait_ms_max'], 3),
+                'size': self._size,
+                'in_use': self._size - len(self._idle),
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'timeout_seconds': self.timeout
+            }
+
+    def _checkout(self, preferred=None):
+        """Соединение из пула; свободное preferred отдается в первую очередь"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        while True:
+            with self._cond:
+                waited = False
+                while not self._closed and not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['exhausted'] += 1
+                        raise PoolTimeout(
+                            f'Нет свободных соединений с базой за {self.timeout} с '
+                            f'(занято {self._size} из {self.max_size})'
+                        )
+                    waited = True
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                if self._closed:
+                    raise PoolError('Пул соединений закрыт')
+                if self._idle:
+                    conn, returned_at = self._take_idle(preferred)
+                else:
+                    conn, returned_at = None, None
+                    self._size += 1
+                if waited:
+                    self._stats['waits'] += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+            elif not self._alive(conn, returned_at):
+                self._count('broken')
+                self._close(conn)
+                self._release_slot()
+                continue
+
+            wait_ms = (time.monotonic() - started) * 1000
+            with self._cond:
+                self._stats['checkouts'] += 1
+                self._stats['wait_ms_total'] += wait_ms
+                self._stats['wait_ms_max'] = max(self._stats['wait_ms_max'], wait_ms)
+            return conn
+
+    def _take_idle(self, preferred):
+        # Вызывается под self._cond
+        if preferred is not None:
+            for index, (conn, returned_at) in enumerate(self._idle):
+                if conn is preferred:
+                    del self._idle[index]
+                    self._stats['reused'] += 1
+                    return conn, returned_at
+        return self._idle.pop()
+
+    def _checkin(self, conn, close: bool = False):
+        if conn not in self._owned:
+            # Соединение родительского процесса, в пул потомка его не возвращаем
+            self._detach(conn)
+            return
+        if close or self._closed or not self._reset_transaction(conn):
+            self._close(conn)
+            self._release_slot()
+            return
+        with self._cond:
+            if not self._closed:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+                return
+        # Пул закрыли, пока откатывалась транзакция
+        self._close(conn)
+        self._release_slot()
+
+    def _reset_transaction(self, conn) -> bool:
+        """Откат незавершенной транзакции; False, если соединение непригодно"""
+        if conn.closed:
+            return False
+        status = conn.info.transaction_status
+        if status == extensions.TRANSACTION_STATUS_IDLE:
+            return True
+        if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        try:
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _alive(self, conn, returned_at: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.check_idle:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            self.logger.warning(f"Соединение с базой оборвано, открываем новое: {str(e)}")
+            return False
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.conn_params)
+        self._owned.add(conn)
+        self._count('created')
+        return conn
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _detach(self, conn):
+        """Закрытие унаследованного соединения без разрыва сессии родителя.
+
+        Сокет подменяется на /dev/null, поэтому сообщение о завершении
+        сессии уходит в никуда, а родитель продолжает работать со своим.
+        """
+        if not conn.closed:
+            try:
+                null = os.open(os.devnull, os.O_RDWR)
+                try:
+                    os.dup2(null, conn.fileno())
+                finally:
+                    os.close(null)
+            except (OSError, psycopg2.Error):
+                pass
+        self._close(conn)
+
+    def _check_fork(self):
+        if self._pid == os.getpid():
+            return
+        inherited = [conn for conn, _ in self._idle]
+        forks = self._stats['forks'] + 1
+        self._reset()
+        self._stats['forks'] = forks
+        for conn in inherited:
+            self._detach(conn)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle: List = []
+        # Соединения, открытые этим процессом
+        self._owned = weakref.WeakSet()
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+        self._scope = threading.local()
+        self._stats = {
+            'checkouts': 0, 'reused': 0, 'waits': 0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0,
+            'exhausted': 0, 'created': 0, 'broken': 0, 'forks': 0
+        }
+
+    def _count(self, name: str):
+        with self._cond:
+            self._stats[name] += 1
@@ -1,11 +1,594 @@
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from typing import List, Dict, Optional
+from psycopg2.extras import RealDictCursor, Json, execute_values
+from contextlib import contextmanager
+from typing import List, Dict, Optional, Sequence, Tuple
+import base64
+import hashlib
+import io
+import json
 import logging
 import os
+import re
+import threading
+
+from connection_pool import ConnectionPool
+from prepared_statements import PreparedStatements
+from single_flight import SingleFlight, coalesced
+
+
+# Ключ advisory-блокировки Postgres: одновременно выполняется только одна загрузка фида
+INGEST_LOCK_KEY = 72_001
+# Ключ advisory-блокировки миграций схемы
+MIGRATION_LOCK_KEY = 72_002
+
+# Поля задания загрузки, которые можно обновлять через update_ingest_job
+INGEST_JOB_FIELDS = (
+    'status', 'stage', 'processed', 'errors', 'skipped', 'bytes_read', 'bytes_total',
+    'offers_per_second', 'eta_seconds', 'summary', 'error', 'finished_at'
+)
+
+
+# Схема живой версии каталога. Новая версия собирается в схеме catalog_v{version}
+# и становится живой переименованием схем; предыдущие версии остаются под своими
+# номерами для отката
+LIVE_SCHEMA = 'catalog'
+
+# Таблицы, входящие в версию каталога
+CATALOG_TABLES = (
+    'categories', 'category_closure', 'category_product_counts', 'products', 'product_categories',
+    'catalog_stats'
+)
+
+# Запрос, похожий на артикул, штрихкод или id товара: одно слово с цифрами
+ARTICLE_QUERY = re.compile(r'^[\w./-]*\d[\w./-]*$')
+# Минимальная длина артикула для поиска по началу
+ARTICLE_PREFIX_MIN_LENGTH = 4
+
+# До скольких найденных товаров поиск считает общее число
+SEARCH_TOTAL_LIMIT = 1000
+
+# Сортировки товаров в категории (колонки products)
+PRODUCT_SORTS = ('id', 'price', 'name')
+
+# Внешние ключи таблиц каталога: (таблица, имя ограничения, определение)
+CATALOG_FOREIGN_KEYS = (
+    ('categories', 'categories_parent_id_fkey',
+     'FOREIGN KEY (parent_id) REFERENCES {schema}.categories(id)'),
+    ('product_categories', 'product_categories_product_id_fkey',
+     'FOREIGN KEY (product_id) REFERENCES {schema}.products(id) ON DELETE CASCADE'),
+    ('product_categories', 'product_categories_category_id_fkey',
+     'FOREIGN KEY (category_id) REFERENCES {schema}.categories(id) ON DELETE CASCADE'),
+)
+
+
+class BulkLoadError(Exception):
+    """Ошибка пакетной загрузки: транзакция загрузки отменена целиком"""
+
+
+class SchemaVersionError(Exception):
+    """Схема базы данных старее кода: миграции не применены"""
+
+
+def _copy_value(value) -> str:
+    """Экранирование значения для текстового формата COPY"""
+    if value is None:
+        return '\\N'
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+
+def _content_hash(article: str, name: str, price: float, url: Optional[str],
+                  picture: Optional[str], category_ids: Optional[List[int]]) -> str:
+    """Хэш содержимого товара для дельта-загрузки"""
+    categories = ','.join(str(c) for c in sorted(set(category_ids or ())))
+    payload = '\x1f'.join('' if v is None else str(v) for v in (article, name, price, url, picture, categories))
+    return hashlib.md5(payload.encode('utf-8')).hexdigest()
+
+
+def _version_schema(version: int) -> str:
+    """Имя схемы неживой версии каталога"""
+    return f"{LIVE_SCHEMA}_v{int(version)}"
+
+
+def _create_catalog_tables(cur, schema: str, constraints: bool = True):
+    """Создание таблиц каталога в схеме schema.
+
+    С constraints=False внешние ключи и вторичные индексы не создаются: при
+    сборке новой версии их дешевле построить один раз после заполнения таблиц.
+    """
+    cur.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.categories (
+            id INTEGER PRIMARY KEY,
+            parent_id INTEGER,
+            name TEXT NOT NULL
+        )
+    ''')
+    
+    cur.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.products (
+            id TEXT PRIMARY KEY,
+            article TEXT NOT NULL,
+            name TEXT NOT NULL,
+            price NUMERIC(10,2) NOT NULL,
+            url TEXT,
+            picture TEXT,
+            has_categories BOOLEAN DEFAULT FALSE,
+            search_vector tsvector GENERATED ALWAYS AS (
+                setweight(to_tsvector('russian', coalesce(article,'')), 'A') ||
+                setweight(to_tsvector('russian', coalesce(name,'')), 'B')
+            ) STORED
+        )
+    ''')
+    
+    cur.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.product_categories (
+            product_id TEXT,
+            category_id INTEGER,
+            PRIMARY KEY (product_id, category_id)
+        )
+    ''')
+    
+    # Хэш содержимого товара для дельта-загрузки
+    cur.execute(f'ALTER TABLE {schema}.products ADD COLUMN IF NOT EXISTS content_hash TEXT')
+    
+    # Пути категорий ("A > B > C") рассчитываются при загрузке, а не при каждом запросе
+    cur.execute(f'ALTER TABLE {schema}.categories ADD COLUMN IF NOT EXISTS path TEXT')
+    cur.execute(f'ALTER TABLE {schema}.products ADD COLUMN IF NOT EXISTS category_paths TEXT[]')
+    
+    # Замыкание дерева категорий: все пары предок-потомок (включая саму категорию
+    # с depth = 0). Поддерживается при загрузке, чтобы чтение обходилось без рекурсии
+    cur.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.category_closure (
+            ancestor_id INTEGER NOT NULL,
+            descendant_id INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        )
+    ''')
+    
+    # Число товаров категории: напрямую и во всем поддереве (без повторов)
+    cur.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.category_product_counts (
+            category_id INTEGER PRIMARY KEY,
+            direct_count INTEGER NOT NULL,
+            subtree_count INTEGER NOT NULL
+        )
+    ''')
+    # Цены товаров поддерева категории
+    for column in ('min_price', 'avg_price', 'max_price'):
+        cur.execute(f'ALTER TABLE {schema}.category_product_counts ADD COLUMN IF NOT EXISTS {column} NUMERIC')
+    
+    # Статистика каталога, рассчитанная при загрузке той версии, в которой она лежит
+    cur.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.catalog_stats (
+            version INTEGER PRIMARY KEY,
+            total_categories INTEGER NOT NULL,
+            total_products INTEGER NOT NULL,
+            products_with_images INTEGER NOT NULL,
+            categories_with_products INTEGER NOT NULL,
+            average_price NUMERIC,
+            min_price NUMERIC,
+            max_price NUMERIC,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    ''')
+    
+    if constraints:
+        _create_catalog_constraints(cur, schema)
+
+
+def _create_catalog_constraints(cur, schema: str):
+    """Внешние ключи и вторичные индексы таблиц каталога"""
+    for table, name, definition in CATALOG_FOREIGN_KEYS:
+        cur.execute(
+            'SELECT 1 FROM pg_constraint WHERE conrelid = %s::regclass AND conname = %s',
+            (f'{schema}.{table}', name)
+        )
+        if cur.fetchone() is None:
+            cur.execute(f'ALTER TABLE {schema}.{table} ADD CONSTRAINT {name} {definition.format(schema=schema)}')
+    
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_products_article ON {schema}.products(article)')
+    # Поиск артикула по началу (LIKE 'abc%') не зависит от правил сортировки базы
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_products_article_pattern ON {schema}.products(article text_pattern_ops)')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_products_name ON {schema}.products(name)')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_products_has_categories ON {schema}.products(has_categories)')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_product_categories_category ON {schema}.product_categories(category_id)')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_products_search ON {schema}.products USING GIN(search_vector)')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_category_closure_descendant ON {schema}.category_closure(descendant_id, depth)')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_category_closure_ancestor_depth ON {schema}.category_closure(ancestor_id, depth)')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_categories_parent ON {schema}.categories(parent_id)')
+    # Индексы для постраничного вывода по ключу сортировки
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_products_price_id ON {schema}.products(price, id)')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_products_name_id ON {schema}.products(name, id)')
+    # Триграммные индексы для подсказок и нечеткого поиска (pg_trgm установлен в public)
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_products_name_trgm ON {schema}.products USING GIN(name public.gin_trgm_ops)')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_products_article_trgm ON {schema}.products USING GIN(article public.gin_trgm_ops)')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_categories_name_trgm ON {schema}.categories USING GIN(name public.gin_trgm_ops)')
+
+
+def _switch_live_version(cur, version: int):
+    """Атомарное переключение живой версии каталога (в транзакции вызывающего).
+
+    Текущая живая схема уходит под свой номер версии, схема version становится
+    схемой catalog. Запросы читателей, начатые до фиксации, дорабатывают на
+    прежней версии, следующие запросы видят новую.
+    """
+    cur.execute("SELECT version FROM catalog_versions WHERE status = 'live' FOR UPDATE")
+    row = cur.fetchone()
+    if row is None:
+        raise RuntimeError("Не найдена живая версия каталога")
+    live_version = row[0]
+    cur.execute(f'ALTER SCHEMA {LIVE_SCHEMA} RENAME TO {_version_schema(live_version)}')
+    cur.execute(f'ALTER SCHEMA {_version_schema(version)} RENAME TO {LIVE_SCHEMA}')
+    cur.execute("UPDATE catalog_versions SET status = 'archived' WHERE version = %s", (live_version,))
+    cur.execute(
+        "UPDATE catalog_versions SET status = 'live', activated_at = now() WHERE version = %s",
+        (version,)
+    )
+
+
+def _rebuild_category_closure(cur):
+    """Пересчет замыкания дерева категорий по текущим категориям.
+
+    В замыкание попадают только категории, достижимые от корней: циклы
+    разрываются при разборе фида.
+    """
+    cur.execute('DELETE FROM category_closure')
+    cur.execute('''
+        INSERT INTO category_closure (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE tree AS (
+            SELECT id, ARRAY[id] as path
+            FROM categories
+            WHERE parent_id IS NULL
+            
+            UNION ALL
+            
+            SELECT c.id, t.path || c.id
+            FROM categories c
+            JOIN tree t ON c.parent_id = t.id
+        )
+        SELECT a.ancestor_id, t.id, cardinality(t.path) - a.position
+        FROM tree t, unnest(t.path) WITH ORDINALITY AS a(ancestor_id, position)
+    ''')
+
+
+def _refresh_category_tree(cur) -> bool:
+    """Пересчет замыкания и путей категорий; True, если изменился путь хотя бы одной категории"""
+    _rebuild_category_closure(cur)
+    cur.execute('''
+        UPDATE categories c SET path = t.path
+        FROM (
+            SELECT cl.descendant_id as id, string_agg(a.name, ' > ' ORDER BY cl.depth DESC) as path
+            FROM category_closure cl
+            JOIN categories a ON a.id = cl.ancestor_id
+            GROUP BY cl.descendant_id
+        ) t
+        WHERE c.id = t.id AND c.path IS DISTINCT FROM t.path
+    ''')
+    changed = cur.rowcount > 0
+    cur.execute('''
+        UPDATE categories c SET path = NULL
+        WHERE c.path IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM category_closure cl WHERE cl.descendant_id = c.id)
+    ''')
+    return changed or cur.rowcount > 0
+
+
+def _product_paths_query(links_table: str, links_filter: str = '') -> str:
+    """Подзапрос (product_id, category_paths) по таблице связей товаров с категориями"""
+    return f'''
+        SELECT l.product_id, array_agg(DISTINCT c.path ORDER BY c.path) as category_paths
+        FROM {links_table} l
+        JOIN categories c ON c.id = l.category_id
+        WHERE c.path IS NOT NULL {links_filter}
+        GROUP BY l.product_id
+    '''
+
+
+def _refresh_product_paths(cur, changed_only: bool = False):
+    """Пересчет путей категорий товаров.
+
+    С changed_only пересчитываются только товары из changed_products
+    текущей загрузки: пути остальных не могли измениться, если не менялись
+    пути категорий.
+    """
+    links_filter = 'AND l.product_id IN (SELECT id FROM changed_products)' if changed_only else ''
+    cur.execute(f'''
+        UPDATE products p SET category_paths = pp.category_paths
+        FROM ({_product_paths_query('product_categories', links_filter)}) pp
+        WHERE p.id = pp.product_id AND p.category_paths IS DISTINCT FROM pp.category_paths
+    ''')
+    if not changed_only:
+        cur.execute('''
+            UPDATE products p SET category_paths = NULL
+            WHERE p.category_paths IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM product_categories pc WHERE pc.product_id = p.id)
+        ''')
+
+
+def _refresh_category_counts(cur):
+    """Пересчет числа и цен товаров в категориях"""
+    cur.execute('DELETE FROM category_product_counts')
+    cur.execute('''
+        INSERT INTO category_product_counts (
+            category_id, direct_count, subtree_count, min_price, avg_price, max_price
+        )
+        SELECT c.id, COALESCE(d.product_count, 0), COALESCE(t.product_count, 0),
+               t.min_price, t.avg_price, t.max_price
+        FROM categories c
+        LEFT JOIN (
+            SELECT category_id, COUNT(*) as product_count
+            FROM product_categories
+            GROUP BY category_id
+        ) d ON d.category_id = c.id
+        LEFT JOIN (
+            SELECT st.ancestor_id, COUNT(*) as product_count,
+                   MIN(p.price) as min_price, AVG(p.price) as avg_price, MAX(p.price) as max_price
+            FROM (
+                -- Товар из нескольких категорий поддерева учитывается один раз
+                SELECT DISTINCT cl.ancestor_id, pc.product_id
+                FROM category_closure cl
+                JOIN product_categories pc ON pc.category_id = cl.descendant_id
+            ) st
+            JOIN products p ON p.id = st.product_id
+            GROUP BY st.ancestor_id
+        ) t ON t.ancestor_id = c.id
+    ''')
+
+
+def _refresh_catalog_stats(cur, version: int, changed: bool = True):
+    """Расчет статистики каталога для версии version.
+
+    Если данные каталога не менялись (changed=False), прежняя статистика
+    только привязывается к новой версии.
+    """
+    if not changed:
+        cur.execute('UPDATE catalog_stats SET version = %s', (version,))
+        if cur.rowcount:
+            return
+    cur.execute('DELETE FROM catalog_stats')
+    cur.execute('''
+        INSERT INTO catalog_stats (
+            version, total_categories, total_products, products_with_images,
+            categories_with_products, average_price, min_price, max_price
+        )
+        SELECT %s,
+               (SELECT COUNT(*) FROM categories),
+               COUNT(*), COUNT(picture),
+               (SELECT COUNT(*) FROM category_product_counts WHERE direct_count > 0),
+               AVG(price), MIN(price), MAX(price)
+        FROM products
+    ''', (version,))
+
+
+def _refresh_derived_data(cur, changed_only: bool = False, products_changed: bool = True) -> bool:
+    """Пересчет данных, производных от категорий и связей товаров.
+
+    changed_only - см. _refresh_product_paths. Если не изменились ни товары
+    (products_changed), ни пути категорий, пересчитывать товары и счетчики незачем.
+    Возвращает False, если каталог не изменился и пересчет пропущен.
+    """
+    paths_changed = _refresh_category_tree(cur)
+    if changed_only and not (paths_changed or products_changed):
+        return False
+    _refresh_product_paths(cur, changed_only and not paths_changed)
+    _refresh_category_counts(cur)
+    return True
+
+
+# Миграции идемпотентны: они же доводят до текущего вида базы, созданные
+# до появления версий схемы, и базы, где вся схема создавалась одной миграцией 1
+
+
+def _migrate_catalog(cur, logger: logging.Logger):
+    """Таблицы каталога в схеме catalog и производные данные дерева категорий"""
+    # Создаем расширение для полнотекстового поиска. Явно в public:
+    # схема каталога переименовывается при переключении версий
+    cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public')
+
+    # Таблицы каталога живут в схеме catalog. Старые базы хранили их в public
+    cur.execute('SELECT to_regnamespace(%s) IS NOT NULL', (LIVE_SCHEMA,))
+    if not cur.fetchone()[0]:
+        cur.execute(f'CREATE SCHEMA {LIVE_SCHEMA}')
+        for table in CATALOG_TABLES:
+            cur.execute('SELECT to_regclass(%s) IS NOT NULL', (f'public.{table}',))
+            if cur.fetchone()[0]:
+                logger.info(f"Перенос таблицы {table} в схему {LIVE_SCHEMA}")
+                cur.execute(f'ALTER TABLE public.{table} SET SCHEMA {LIVE_SCHEMA}')
+
+    # Создаем таблицы и индексы каталога
+    _create_catalog_tables(cur, LIVE_SCHEMA)
+    cur.execute('''
+        SELECT EXISTS (SELECT 1 FROM categories)
+           AND (NOT EXISTS (SELECT 1 FROM category_product_counts)
+                OR NOT EXISTS (SELECT 1 FROM categories WHERE path IS NOT NULL)
+                OR NOT EXISTS (SELECT 1 FROM catalog_stats))
+    ''')
+    if cur.fetchone()[0]:
+        logger.info("Расчет замыкания дерева, путей и счетчиков категорий")
+        _refresh_derived_data(cur)
+
+
+def _migrate_staging(cur, logger: logging.Logger):
+    """Нежурналируемые staging-таблицы для пакетной загрузки через COPY"""
+    cur.execute('''
+        CREATE UNLOGGED TABLE IF NOT EXISTS public.products_staging (
+            id TEXT,
+            article TEXT,
+            name TEXT,
+            price NUMERIC(10,2),
+            url TEXT,
+            picture TEXT,
+            has_categories BOOLEAN
+        )
+    ''')
+
+    # Хэш содержимого товара для дельта-загрузки
+    cur.execute('ALTER TABLE public.products_staging ADD COLUMN IF NOT EXISTS content_hash TEXT')
+
+    cur.execute('''
+        CREATE UNLOGGED TABLE IF NOT EXISTS public.product_categories_staging (
+            product_id TEXT,
+            category_id INTEGER
+        )
+    ''')
+
+
+
+def _migrate_ingest_jobs(cur, logger: logging.Logger):
+    """Фоновые задания загрузки фида"""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS public.ingest_jobs (
+            id SERIAL PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'running',
+            stage TEXT,
+            processed INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            bytes_read BIGINT,
+            bytes_total BIGINT,
+            offers_per_second REAL,
+            eta_seconds REAL,
+            summary JSONB,
+            error TEXT,
+            started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        )
+    ''')
+
+
+
+def _migrate_catalog_versions(cur, logger: logging.Logger):
+    """Версии каталога: live - схема catalog, archived - схема catalog_v{version}"""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS public.catalog_versions (
+            version SERIAL PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'building',
+            summary JSONB,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            activated_at TIMESTAMPTZ
+        )
+    ''')
+    # Живая версия одна; индекс заодно ускоряет чтение ее номера на каждый запрос
+    cur.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_catalog_versions_live
+        ON public.catalog_versions (status) WHERE status = 'live'
+    ''')
+    cur.execute('''
+        INSERT INTO public.catalog_versions (status, activated_at)
+        SELECT 'live', now()
+        WHERE NOT EXISTS (SELECT 1 FROM public.catalog_versions WHERE status = 'live')
+    ''')
+    cur.execute('SELECT EXISTS (SELECT 1 FROM catalog_stats)')
+    if not cur.fetchone()[0]:
+        logger.info("Расчет статистики каталога")
+        cur.execute("SELECT version FROM public.catalog_versions WHERE status = 'live'")
+        _refresh_catalog_stats(cur, cur.fetchone()[0])
+
+
+
+def _migrate_response_cache(cur, logger: logging.Logger):
+    """Общий для воркеров кэш ответов API (см. response_cache.py)"""
+    cur.execute('''
+        CREATE UNLOGGED TABLE IF NOT EXISTS public.response_cache (
+            key TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            body BYTEA NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    ''')
+
+
+# Миграции схемы: (версия, описание, функция(cur, logger)). Применяются по
+# порядку командой flask migrate; воркеры только проверяют версию схемы
+MIGRATIONS = (
+    (1, 'Каталог в схеме catalog', _migrate_catalog),
+    (2, 'Staging-таблицы пакетной загрузки', _migrate_staging),
+    (3, 'Задания загрузки фида', _migrate_ingest_jobs),
+    (4, 'Версии каталога', _migrate_catalog_versions),
+    (5, 'Общий кэш ответов', _migrate_response_cache),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _encode_cursor(sort: str, order: str, key, product_id: str) -> str:
+    """Непрозрачный курсор постраничного вывода: ключ сортировки последнего товара"""
+    payload = json.dumps([sort, order, None if key is None else str(key), product_id], ensure_ascii=False)
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor: str, sort: str, order: str) -> Tuple[Optional[str], str]:
+    """Разбор курсора; ValueError, если курсор поврежден или выдан для другой сортировки"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, cursor_order, key, product_id = json.loads(base64.urlsafe_b64decode(padded))
+    except Exception:
+        raise ValueError('Некорректный курсор')
+    if (cursor_sort, cursor_order) != (sort, order):
+        raise ValueError('Курсор выдан для другой сортировки')
+    return key, product_id
+
+
+def _search_filters(category_id: Optional[int] = None, min_price: Optional[float] = None,
+                    max_price: Optional[float] = None) -> Tuple[str, List]:
+    """Условия поиска по поддереву категории и диапазону цен (товар - p)"""
+    conditions = []
+    params = []
+    if category_id is not None:
+        conditions.append('''
+            p.id IN (
+                SELECT pc.product_id
+                FROM category_closure cl
+                JOIN product_categories pc ON pc.category_id = cl.descendant_id
+                WHERE cl.ancestor_id = %s
+            )
+        ''')
+        params.append(category_id)
+    if min_price is not None:
+        conditions.append('p.price >= %s')
+        params.append(min_price)
+    if max_price is not None:
+        conditions.append('p.price <= %s')
+        params.append(max_price)
+    return ''.join(f' AND {condition}' for condition in conditions), params
+
+
+def _like_pattern(text: str) -> str:
+    """Экранирование спецсимволов LIKE в пользовательском вводе"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _product_item(row: Dict) -> Dict:
+    """Товар в ответе API"""
+    return {
+        'id': row['id'],
+        'article': row['article'],
+        'name': row['name'],
+        'price': float(row['price']),
+        'url': row['url'],
+        'picture': row['picture'],
+        'category_paths': row['category_paths']
+    }
+
+
+def _upsert_categories(cur, categories: List[Tuple[int, str, Optional[int]]]):
+    """Пакетный upsert категорий; неизменные строки не перезаписываются"""
+    execute_values(cur, '''
+        INSERT INTO categories (id, name, parent_id) VALUES %s
+        ON CONFLICT (id) DO UPDATE SET name = EXCLUDED.name, parent_id = EXCLUDED.parent_id
+        WHERE categories.name IS DISTINCT FROM EXCLUDED.name
+           OR categories.parent_id IS DISTINCT FROM EXCLUDED.parent_id
+    ''', categories, page_size=1000)
+
 
 class CatalogDatabase:
-    def __init__(self, dbname='catalog', user='postgres', password='postgres', host='localhost', port=5432):
+    def __init__(self, dbname='catalog', user='postgres', password='postgres', host='localhost', port=5432,
+                 coalesce_timeout: float = 30.0, pool_min: int = 1, pool_max: int = 20, pool_timeout: float = 10.0,
+                 prepare_statements: bool = True, migrate: bool = False):
         self.conn_params = {
             'dbname': dbname,
             'user': user,
@@ -14,6 +597,14 @@ class CatalogDatabase:
             'port': str(port)  # Сохраняем как строку
         }
         self._pool = None
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        self.pool_timeout = pool_timeout
+        # Одинаковые одновременные запросы чтения выполняются один раз
+        self._flight = SingleFlight(coalesce_timeout)
+        # Горячие запросы чтения готовятся один раз на соединение
+        self._statements = PreparedStatements(prepare_statements)
+        self._live_version = None
         
         # Настройка логирования
         self.logger = logging.getLogger(__name__)
@@ -23,31 +614,42 @@ class CatalogDatabase:
             handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
             self.logger.addHandler(handler)
         
-        # Инициализация базы данных
-        self._init_database()
+        # Схему создает и обновляет migrate(); обычный процесс только проверяет ее версию
+        try:
+            if migrate:
+                self.migrate()
+            else:
+                self._check_schema()
+        except Exception:
+            self.close()
+            raise
 
-    def get_connection(self):
-        """Получение соединения из пула"""
+    def get_connection(self, scoped: bool = True):
+        """Получение соединения из пула.
+
+        scoped=False - отдельное соединение даже внутри HTTP-запроса, для
+        соединений, которые переживают запрос.
+        """
         if self._pool is None:
-            from psycopg2 import pool
-            
             # Преобразуем порт в число
             conn_params = self.conn_params.copy()
             conn_params['port'] = int(conn_params['port'])
+            # Читатели всегда видят живую версию каталога без лишних запросов:
+            # неквалифицированные имена таблиц разрешаются в схему catalog
+            conn_params['options'] = f"-c search_path={LIVE_SCHEMA},public"
             
             self.logger.info(f"Создание пула подключений с параметрами: host={conn_params['host']}, port={conn_params['port']}, dbname={conn_params['dbname']}, user={conn_params['user']}")
             
             try:
-                self._pool = pool.SimpleConnectionPool(1, 20, **conn_params)
+                # Пулом пользуются и обработчики запросов, и фоновая загрузка фида
+                self._pool = ConnectionPool(conn_params, self.pool_min, self.pool_max, self.pool_timeout)
                 self.logger.info("Пул подключений успешно создан")
             except Exception as e:
                 self.logger.error(f"Ошибка при создании пула подключений: {str(e)}")
                 raise
         
         try:
-            conn = self._pool.getconn()
-            self.logger.info("Получено подключение из пула")
-            return conn
+            return self._pool.getconn(scoped)
         except Exception as e:
             self.logger.error(f"Ошибка при получении подключения из пула: {str(e)}")
             raise
@@ -56,71 +658,98 @@ class CatalogDatabase:
         """Возврат соединения в пул"""
         self._pool.putconn(conn)
 
-    def _init_database(self):
-        """Инициализация базы данных"""
-        self.logger.info("Инициализация базы данных")
-        
+    def begin_request(self):
+        """Начало обработки HTTP-запроса: обращения к базе в этом потоке до
+        end_request по возможности идут через одно соединение, но между ними
+        оно не удерживается"""
+        if self._pool is not None:
+            self._pool.begin_scope()
+
+    def end_request(self):
+        """Конец обработки HTTP-запроса"""
+        if self._pool is not None:
+            self._pool.end_scope()
+
+    def get_pool_stats(self) -> Dict:
+        """Счетчики пула соединений"""
+        return self._pool.stats() if self._pool is not None else {}
+
+    def migrate(self) -> List[int]:
+        """Применение недостающих миграций схемы; возвращает номера примененных.
+
+        Выполняется отдельной командой (flask migrate) до запуска воркеров.
+        Каждая миграция - отдельная транзакция под advisory-блокировкой, так
+        что одновременные запуски ждут друг друга и не повторяют работу.
+        """
+        applied = []
+        conn = self.get_connection()
         try:
-            # Подключаемся к базе данных
-            conn = self.get_connection()
             cur = conn.cursor()
-            
-            # Создаем расширение для полнотекстового поиска
-            cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
-            
-            # Создаем таблицы
+            cur.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK_KEY,))
             cur.execute('''
-                CREATE TABLE IF NOT EXISTS categories (
-                    id INTEGER PRIMARY KEY,
-                    parent_id INTEGER REFERENCES categories(id),
-                    name TEXT NOT NULL
+                CREATE TABLE IF NOT EXISTS public.schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
                 )
             ''')
-            
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS products (
-                    id TEXT PRIMARY KEY,
-                    article TEXT NOT NULL,
-                    name TEXT NOT NULL,
-                    price NUMERIC(10,2) NOT NULL,
-                    url TEXT,
-                    picture TEXT,
-                    has_categories BOOLEAN DEFAULT FALSE,
-                    search_vector tsvector GENERATED ALWAYS AS (
-                        setweight(to_tsvector('russian', coalesce(article,'')), 'A') ||
-                        setweight(to_tsvector('russian', coalesce(name,'')), 'B')
-                    ) STORED
-                )
-            ''')
-            
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS product_categories (
-                    product_id TEXT REFERENCES products(id) ON DELETE CASCADE,
-                    category_id INTEGER REFERENCES categories(id) ON DELETE CASCADE,
-                    PRIMARY KEY (product_id, category_id)
-                )
-            ''')
-            
-            # Создаем индексы
-            cur.execute('CREATE INDEX IF NOT EXISTS idx_products_article ON products(article)')
-            cur.execute('CREATE INDEX IF NOT EXISTS idx_products_name ON products(name)')
-            cur.execute('CREATE INDEX IF NOT EXISTS idx_products_has_categories ON products(has_categories)')
-            cur.execute('CREATE INDEX IF NOT EXISTS idx_product_categories_category ON product_categories(category_id)')
-            cur.execute('CREATE INDEX IF NOT EXISTS idx_products_search ON products USING GIN(search_vector)')
-            
             conn.commit()
-            self.logger.info("Инициализация базы данных успешно завершена")
             
+            for version, description, migration in MIGRATIONS:
+                cur.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK_KEY,))
+                cur.execute('SELECT 1 FROM public.schema_migrations WHERE version = %s', (version,))
+                if cur.fetchone() is None:
+                    self.logger.info(f"Миграция схемы {version}: {description}")
+                    migration(cur, self.logger)
+                    cur.execute(
+                        'INSERT INTO public.schema_migrations (version, description) VALUES (%s, %s)',
+                        (version, description)
+                    )
+                    applied.append(version)
+                conn.commit()
         except Exception as e:
-            self.logger.error(f"Ошибка при инициализации базы данных: {str(e)}")
-            if 'conn' in locals():
-                conn.rollback()
+            self.logger.error(f"Ошибка при миграции схемы базы данных: {str(e)}")
+            conn.rollback()
             raise
         finally:
-            if 'cur' in locals():
-                cur.close()
-            if 'conn' in locals():
-                self.put_connection(conn)
+            cur.close()
+            self.put_connection(conn)
+        
+        self.logger.info(f"Схема базы данных версии {SCHEMA_VERSION}, применено миграций: {len(applied)}")
+        return applied
+
+    def get_schema_version(self) -> int:
+        """Номер последней примененной миграции схемы (0 - схема не создана)"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT to_regclass('public.schema_migrations') IS NOT NULL")
+            version = 0
+            if cur.fetchone()[0]:
+                cur.execute('SELECT COALESCE(MAX(version), 0) FROM public.schema_migrations')
+                version = cur.fetchone()[0]
+            conn.commit()
+            return version
+        finally:
+            cur.close()
+            self.put_connection(conn)
+
+    def _check_schema(self):
+        """Проверка, что миграции применены; DDL при старте воркера не выполняется"""
+        version = self.get_schema_version()
+        if version < SCHEMA_VERSION:
+            raise SchemaVersionError(
+                f"Схема базы данных версии {version}, требуется {SCHEMA_VERSION}: выполните flask migrate"
+            )
+        if version > SCHEMA_VERSION:
+            # Миграции новой версии приложения уже применены, а этот воркер еще старый
+            self.logger.warning(f"Схема базы данных версии {version} новее ожидаемой {SCHEMA_VERSION}")
+
+    def warm_up(self):
+        """Открытие соединений пула до минимального размера перед первым запросом"""
+        if self._pool is None:
+            self.put_connection(self.get_connection())
+        self._pool.warm()
 
     def close(self):
         """Закрытие пула соединений"""
@@ -153,6 +782,26 @@ class CatalogDatabase:
             cur.close()
             self.put_connection(conn)
 
+    def add_categories(self, categories: List[Tuple[int, str, Optional[int]]]):
+        """Добавление категорий одним пакетом.
+
+        categories - список (id, name, parent_id), родители должны идти раньше детей.
+        Замыкание дерева пересчитывается один раз в refresh_derived_data.
+        """
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            self.logger.debug(f"Добавляем {len(categories)} категорий")
+            _upsert_categories(cur, categories)
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Ошибка при добавлении категорий: {str(e)}")
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            self.put_connection(conn)
+
     def add_product(self, product_id: str, article: str, name: str, price: float, 
                    url: str, picture: Optional[str] = None, category_ids: List[int] = None):
         """Добавление товара"""
@@ -163,19 +812,21 @@ class CatalogDatabase:
             
             # Добавляем товар
             has_categories = bool(category_ids)
+            content_hash = _content_hash(article, name, price, url, picture, category_ids)
             cur.execute(
                 '''
-                INSERT INTO products (id, article, name, price, url, picture, has_categories) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                INSERT INTO products (id, article, name, price, url, picture, has_categories, content_hash) 
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
                 ON CONFLICT (id) DO UPDATE SET 
                     article = EXCLUDED.article,
                     name = EXCLUDED.name,
                     price = EXCLUDED.price,
                     url = EXCLUDED.url,
                     picture = EXCLUDED.picture,
-                    has_categories = EXCLUDED.has_categories
+                    has_categories = EXCLUDED.has_categories,
+                    content_hash = EXCLUDED.content_hash
                 ''',
-                (product_id, article, name, price, url, picture, has_categories)
+                (product_id, article, name, price, url, picture, has_categories, content_hash)
             )
             
             if category_ids:
@@ -195,293 +846,1279 @@ class CatalogDatabase:
             cur.close()
             self.put_connection(conn)
 
-    def get_products_by_category(self, category_id: int, page: int = 1, per_page: int = 30) -> Dict:
-        """Получение товаров по категории с пагинацией"""
+    def refresh_derived_data(self):
+        """Пересчет замыкания дерева и счетчиков категорий и публикация новой версии каталога.
+
+        Пакетная загрузка делает это сама; после построчных add_category и
+        add_product метод нужно вызвать один раз в конце загрузки, иначе
+        кэш ответов не узнает об изменениях.
+        """
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            _refresh_derived_data(cur)
+            cur.execute("UPDATE catalog_versions SET status = 'dropped' WHERE status = 'live'")
+            cur.execute("INSERT INTO catalog_versions (status, activated_at) VALUES ('live', now()) RETURNING version")
+            version = cur.fetchone()[0]
+            _refresh_catalog_stats(cur, version)
+            conn.commit()
+            self._on_live_version(version)
+        except Exception as e:
+            self.logger.error(f"Ошибка при пересчете счетчиков категорий: {str(e)}")
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            self.put_connection(conn)
+
+    def bulk_loader(self, batch_size: int = 10000, delta: bool = False, versioned: bool = False,
+                    keep_versions: int = 2) -> 'CatalogBulkLoader':
+        """Пакетный загрузчик товаров (COPY + set-based перенос)"""
+        return CatalogBulkLoader(self, batch_size, delta, versioned, keep_versions)
+
+    def get_catalog_versions(self) -> List[Dict]:
+        """Версии каталога, от новых к старым"""
         conn = self.get_connection()
         try:
             cur = conn.cursor(cursor_factory=RealDictCursor)
-            
-            # Получаем общее количество товаров
             cur.execute('''
-                WITH RECURSIVE subcategories AS (
-                    SELECT id FROM categories WHERE id = %s
-                    UNION ALL
-                    SELECT c.id FROM categories c
-                    INNER JOIN subcategories sc ON c.parent_id = sc.id
-                )
-                SELECT COUNT(DISTINCT p.id) as count
-                FROM products p
-                JOIN product_categories pc ON p.id = pc.product_id
-                WHERE pc.category_id IN (SELECT id FROM subcategories)
-            ''', (category_id,))
+                SELECT version, status, summary, created_at, activated_at
+                FROM catalog_versions
+                WHERE status <> 'building'
+                ORDER BY version DESC
+            ''')
+            versions = cur.fetchall()
+            conn.commit()
+        finally:
+            cur.close()
+            self.put_connection(conn)
+
+        return [{
+            **version,
+            'created_at': version['created_at'].isoformat(),
+            'activated_at': version['activated_at'].isoformat() if version['activated_at'] else None
+        } for version in versions]
+
+    def get_coalescing_stats(self) -> Dict:
+        """Счетчики объединения одинаковых одновременных запросов чтения"""
+        return self._flight.stats()
+
+    def get_statement_stats(self) -> Dict:
+        """Число выполнений, подготовок и время подготовленных запросов"""
+        return self._statements.stats()
+
+    def get_live_version(self) -> int:
+        """Номер живой версии каталога"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            self._statements.execute(cur, 'live_version', "SELECT version FROM catalog_versions WHERE status = 'live'")
+            row = cur.fetchone()
+            conn.commit()
+        finally:
+            cur.close()
+            self.put_connection(conn)
+        version = row[0] if row else 0
+        self._on_live_version(version)
+        return version
+
+    def _on_live_version(self, version: int):
+        """Учет смены живой версии: планы подготовленных запросов выбираются заново"""
+        if self._live_version is not None and self._live_version != version:
+            self._statements.invalidate()
+        self._live_version = version
+
+    def get_cached_response(self, key: str, version: int) -> Optional[bytes]:
+        """Тело ответа из общего кэша, если оно сохранено для этой версии каталога"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT body FROM response_cache WHERE key = %s AND version = %s', (key, version))
+            row = cur.fetchone()
+            conn.commit()
+            return bytes(row[0]) if row else None
+        finally:
+            cur.close()
+            self.put_connection(conn)
+
+    def store_cached_response(self, key: str, version: int, body: bytes):
+        """Сохранение тела ответа в общий кэш"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute('''
+                INSERT INTO response_cache (key, version, body) VALUES (%s, %s, %s)
+                ON CONFLICT (key) DO UPDATE SET version = EXCLUDED.version, body = EXCLUDED.body, created_at = now()
+            ''', (key, version, psycopg2.Binary(body)))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            self.put_connection(conn)
+
+    def prune_cached_responses(self, version: int):
+        """Удаление из общего кэша ответов прежних версий каталога"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute('DELETE FROM response_cache WHERE version <> %s', (version,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            self.put_connection(conn)
+
+    def rollback_catalog(self, version: int):
+        """Откат каталога на сохраненную предыдущую версию.
+
+        Переключение выполняется под блокировкой загрузки, чтобы не пересечься
+        с переключением версии в конце загрузки фида.
+        """
+        with self.ingest_lock():
+            conn = self.get_connection()
+            try:
+                cur = conn.cursor()
+                cur.execute('SELECT status FROM catalog_versions WHERE version = %s FOR UPDATE', (version,))
+                row = cur.fetchone()
+                if row is None or row[0] != 'archived':
+                    raise ValueError(f"Версия каталога {version} недоступна для отката")
+                _switch_live_version(cur, version)
+                # Версии, собранные до появления статистики, дополняем на месте
+                _create_catalog_tables(cur, LIVE_SCHEMA)
+                cur.execute('SELECT EXISTS (SELECT 1 FROM catalog_stats WHERE version = %s)', (version,))
+                if not cur.fetchone()[0]:
+                    _refresh_category_counts(cur)
+                    _refresh_catalog_stats(cur, version)
+                conn.commit()
+                self._on_live_version(version)
+                self.logger.info(f"Каталог откатен на версию {version}")
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+                self.put_connection(conn)
+
+    def prune_catalog_versions(self, keep: int):
+        """Удаление схем предыдущих версий сверх keep последних"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute('''
+                SELECT version FROM catalog_versions
+                WHERE status = 'archived'
+                ORDER BY version DESC
+                OFFSET %s
+            ''', (max(keep, 0),))
+            for (version,) in cur.fetchall():
+                cur.execute(f'DROP SCHEMA IF EXISTS {_version_schema(version)} CASCADE')
+                cur.execute("UPDATE catalog_versions SET status = 'dropped' WHERE version = %s", (version,))
+                conn.commit()
+                self.logger.info(f"Удалена предыдущая версия каталога {version}")
+        except Exception as e:
+            # Лишние версии будут удалены после следующей загрузки
+            self.logger.error(f"Ошибка при удалении старых версий каталога: {str(e)}")
+            conn.rollback()
+        finally:
+            cur.close()
+            self.put_connection(conn)
+
+    @coalesced
+    def get_products_by_category(self, category_id: int, page: int = 1, per_page: int = 30,
+                                 sort: str = 'id', order: str = 'asc') -> Dict:
+        """Получение товаров по категории с пагинацией"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
             
-            total_count = cur.fetchone()['count']
+            # Общее количество товаров берем из счетчиков, рассчитанных при загрузке
+            total_count = self._get_subtree_count(cur, category_id)
             
             # Получаем товары для текущей страницы
-            cur.execute('''
-                WITH RECURSIVE subcategories AS (
-                    SELECT id FROM categories WHERE id = %s
-                    UNION ALL
-                    SELECT c.id FROM categories c
-                    INNER JOIN subcategories sc ON c.parent_id = sc.id
-                ),
-                product_list AS (
-                    SELECT DISTINCT p.*
-                    FROM products p
-                    JOIN product_categories pc ON p.id = pc.product_id
-                    WHERE pc.category_id IN (SELECT id FROM subcategories)
-                    ORDER BY p.id
-                    LIMIT %s OFFSET %s
-                ),
-                category_paths AS (
-                    SELECT DISTINCT pc.product_id, 
-                           (
-                               WITH RECURSIVE path AS (
-                                   SELECT c.id, c.parent_id, c.name, 1 as level
-                                   FROM categories c
-                                   WHERE c.id = pc.category_id
-                                   UNION ALL
-                                   SELECT c.id, c.parent_id, c.name, p.level + 1
-                                   FROM categories c
-                                   JOIN path p ON c.id = p.parent_id
-                               )
-                               SELECT string_agg(name, ' > ' ORDER BY level DESC)
-                               FROM path
-                           ) as path
-                    FROM product_categories pc
-                    JOIN product_list pl ON pc.product_id = pl.id
-                    GROUP BY pc.product_id, pc.category_id
-                )
-                SELECT 
-                    pl.id,
-                    pl.article,
-                    pl.name,
-                    pl.price,
-                    pl.url,
-                    pl.picture,
-                    array_agg(cp.path) as category_paths
-                FROM product_list pl
-                LEFT JOIN category_paths cp ON pl.id = cp.product_id
-                GROUP BY pl.id, pl.article, pl.name, pl.price, pl.url, pl.picture
-                ORDER BY pl.id
-            ''', (category_id, per_page, (page - 1) * per_page))
-            
-            products = cur.fetchall()
+            products = self._fetch_category_products(
+                cur, category_id, sort, order, per_page, offset=(page - 1) * per_page
+            )
             
             return {
                 'total_count': total_count,
                 'page': page,
                 'per_page': per_page,
                 'total_pages': (total_count + per_page - 1) // per_page,
-                'items': [{
-                    'id': row['id'],
-                    'article': row['article'],
-                    'name': row['name'],
-                    'price': float(row['price']),
-                    'url': row['url'],
-                    'picture': row['picture'],
-                    'category_paths': row['category_paths']
-                } for row in products]
+                'items': [_product_item(row) for row in products]
+            }
+            
+        finally:
+            cur.close()
+            self.put_connection(conn)
+
+    @coalesced
+    def get_products_by_cursor(self, category_id: int, cursor: Optional[str] = None, per_page: int = 30,
+                               sort: str = 'id', order: str = 'asc', include_total: bool = False) -> Dict:
+        """Получение товаров по категории с пагинацией по курсору.
+
+        Страница начинается сразу после товара, закодированного в cursor,
+        поэтому стоимость не зависит от глубины страницы. next_cursor равен
+        None на последней странице. ValueError для некорректного курсора.
+        """
+        after = _decode_cursor(cursor, sort, order) if cursor else None
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            
+            # Берем на один товар больше, чтобы узнать, есть ли следующая страница
+            products = self._fetch_category_products(cur, category_id, sort, order, per_page + 1, after=after)
+            
+            next_cursor = None
+            if len(products) > per_page:
+                products = products[:per_page]
+                last = products[-1]
+                next_cursor = _encode_cursor(sort, order, last[sort], last['id'])
+            
+            result = {
+                'per_page': per_page,
+                'sort': sort,
+                'order': order,
+                'next_cursor': next_cursor,
+                'items': [_product_item(row) for row in products]
             }
+            if include_total:
+                result['total_count'] = self._get_subtree_count(cur, category_id)
+            return result
             
         finally:
             cur.close()
             self.put_connection(conn)
 
-    def search_products(self, query: str) -> List[Dict]:
-        """Поиск товаров"""
+    def get_products_by_ids(self, ids: Sequence[str] = (), articles: Sequence[str] = ()) -> Dict:
+        """Товары по списку id и артикулов одним запросом по индексам.
+
+        items - найденные товары в порядке запроса (сначала по id, затем по
+        артикулам) без повторов; missing_ids и missing_articles - то, чего
+        в каталоге нет. Артикулу может соответствовать несколько товаров.
+        """
+        ids = list(dict.fromkeys(ids))
+        articles = list(dict.fromkeys(articles))
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            self._statements.execute(cur, 'products_batch', '''
+                SELECT p.id, p.article, p.name, p.price, p.url, p.picture, p.category_paths
+                FROM products p
+                WHERE p.id = ANY(%s) OR p.article = ANY(%s)
+                ORDER BY p.id
+            ''', (ids, articles))
+            rows = cur.fetchall()
+            conn.commit()
+        finally:
+            cur.close()
+            self.put_connection(conn)
+        
+        by_id = {row['id']: row for row in rows}
+        by_article = {}
+        for row in rows:
+            by_article.setdefault(row['article'], []).append(row)
+        
+        items = {}
+        for product_id in ids:
+            if product_id in by_id:
+                items[product_id] = by_id[product_id]
+        for article in articles:
+            for row in by_article.get(article, []):
+                items.setdefault(row['id'], row)
+        
+        return {
+            'items': [_product_item(row) for row in items.values()],
+            'missing_ids': [product_id for product_id in ids if product_id not in by_id],
+            'missing_articles': [article for article in articles if article not in by_article]
+        }
+
+    def _get_subtree_count(self, cur, category_id: int) -> int:
+        self._statements.execute(
+            cur, 'subtree_count',
+            'SELECT subtree_count FROM category_product_counts WHERE category_id = %s',
+            (category_id,)
+        )
+        row = cur.fetchone()
+        return row['subtree_count'] if row else 0
+
+    def _fetch_category_products(self, cur, category_id: int, sort: str, order: str, limit: int,
+                                 offset: int = 0, after: Optional[Tuple[Optional[str], str]] = None) -> List[Dict]:
+        """Товары поддерева категории в порядке сортировки, начиная после ключа after"""
+        if sort not in PRODUCT_SORTS or order not in ('asc', 'desc'):
+            raise ValueError(f"Неизвестная сортировка: {sort} {order}")
+        direction = order.upper()
+        
+        # Уникальность порядка обеспечивает id товара
+        order_by = f'p.id {direction}' if sort == 'id' else f'p.{sort} {direction}, p.id {direction}'
+        
+        keyset = ''
+        params = [category_id]
+        if after is not None:
+            key, product_id = after
+            operator = '<' if order == 'desc' else '>'
+            if sort == 'id':
+                keyset = f'AND p.id {operator} %s'
+                params.append(product_id)
+            else:
+                keyset = f'AND (p.{sort}, p.id) {operator} (%s, %s)'
+                params.extend((key, product_id))
+        params.extend((limit, offset))
+        
+        self._statements.execute(cur, 'category_products', f'''
+            SELECT p.id, p.article, p.name, p.price, p.url, p.picture, p.category_paths
+            FROM products p
+            WHERE p.id IN (
+                SELECT pc.product_id
+                FROM category_closure cl
+                JOIN product_categories pc ON pc.category_id = cl.descendant_id
+                WHERE cl.ancestor_id = %s
+            )
+            {keyset}
+            ORDER BY {order_by}
+            LIMIT %s OFFSET %s
+        ''', params)
+        
+        return cur.fetchall()
+
+    @coalesced
+    def search_products(self, query: str, cursor: Optional[str] = None, per_page: int = 50,
+                        category_id: Optional[int] = None, min_price: Optional[float] = None,
+                        max_price: Optional[float] = None, include_total: bool = False) -> Dict:
+        """Поиск товаров, лучшие по релевантности первыми.
+
+        Артикулы и id (сканер штрихкодов, ввод SKU) ищутся точным совпадением
+        или по началу артикула, до полнотекстового поиска. Полнотекстовые
+        результаты отдаются постранично по курсору (релевантность, id); если
+        по словам ничего не найдено, ищутся похожие названия. Фильтры по
+        поддереву категории и цене применяются в том же запросе.
+        total_count - число найденных товаров, но не больше SEARCH_TOTAL_LIMIT.
+        ValueError для некорректного курсора.
+        """
+        after = _decode_cursor(cursor, 'rank', 'desc') if cursor else None
+        filters, filter_params = _search_filters(category_id, min_price, max_price)
         conn = self.get_connection()
         try:
             cur = conn.cursor(cursor_factory=RealDictCursor)
             
-            cur.execute('''
-                WITH RECURSIVE category_paths AS (
-                    SELECT pc.product_id,
-                           (
-                               WITH RECURSIVE path AS (
-                                   SELECT c.id, c.parent_id, c.name, 1 as level
-                                   FROM categories c
-                                   WHERE c.id = pc.category_id
-                                   UNION ALL
-                                   SELECT c.id, c.parent_id, c.name, p.level + 1
-                                   FROM categories c
-                                   JOIN path p ON c.id = p.parent_id
-                               )
-                               SELECT string_agg(name, ' > ' ORDER BY level DESC)
-                               FROM path
-                           ) as path
-                    FROM product_categories pc
-                ),
-                search_results AS (
-                    SELECT DISTINCT ON (p.id)
-                        p.*,
-                        array_agg(cp.path) OVER (PARTITION BY p.id) as category_paths,
-                        ts_rank(p.search_vector, plainto_tsquery('russian', %s)) as rank
+            # Берем на один товар больше, чтобы узнать, есть ли следующая страница
+            if after is not None:
+                products = self._fetch_ranked(cur, query, filters, filter_params, per_page + 1, after)
+                ranked = True
+            else:
+                products = []
+                if ARTICLE_QUERY.match(query):
+                    products = self._find_by_article(cur, query, filters, filter_params, per_page)
+                ranked = False
+                if not products:
+                    products = self._fetch_ranked(cur, query, filters, filter_params, per_page + 1)
+                    ranked = bool(products)
+                if not products:
+                    products = self._find_similar(cur, query, filters, filter_params, per_page)
+            
+            next_cursor = None
+            if ranked and len(products) > per_page:
+                products = products[:per_page]
+                last = products[-1]
+                next_cursor = _encode_cursor('rank', 'desc', last['rank'], last['id'])
+            
+            result = {
+                'per_page': per_page,
+                'next_cursor': next_cursor,
+                'items': [_product_item(row) for row in products]
+            }
+            if include_total:
+                if ranked:
+                    result['total_count'] = self._count_ranked(cur, query, filters, filter_params)
+                else:
+                    result['total_count'] = len(products)
+            return result
+            
+        finally:
+            cur.close()
+            self.put_connection(conn)
+
+    def _fetch_ranked(self, cur, query: str, filters: str, filter_params: List, limit: int,
+                      after: Optional[Tuple[Optional[str], str]] = None) -> List[Dict]:
+        """Полнотекстовый поиск в порядке релевантности, начиная после ключа after"""
+        keyset = ''
+        params = [query, query, *filter_params]
+        if after is not None:
+            rank, product_id = after
+            keyset = 'WHERE rank < %s::float8 OR (rank = %s::float8 AND id > %s)'
+            params.extend((rank, rank, product_id))
+        params.append(limit)
+        
+        # Релевантность считается один раз на товар; фильтры по категории и цене
+        # сужают выборку до ранжирования. Число совпадений зависит от запроса
+        # на порядки, поэтому запрос не готовится: общий план без знания слов
+        # недооценивает выборку
+        self._statements.execute(cur, 'search_ranked', f'''
+            SELECT *
+            FROM (
+                SELECT p.id, p.article, p.name, p.price, p.url, p.picture, p.category_paths,
+                       ts_rank(p.search_vector, plainto_tsquery('russian', %s))::float8 as rank
+                FROM products p
+                WHERE p.search_vector @@ plainto_tsquery('russian', %s)
+                {filters}
+            ) search_results
+            {keyset}
+            ORDER BY rank DESC, id
+            LIMIT %s
+        ''', params, prepare=False)
+        return cur.fetchall()
+
+    def _count_ranked(self, cur, query: str, filters: str, filter_params: List) -> int:
+        """Число найденных полнотекстовым поиском товаров, не больше SEARCH_TOTAL_LIMIT"""
+        self._statements.execute(cur, 'search_count', f'''
+            SELECT COUNT(*) as total_count
+            FROM (
+                SELECT 1
+                FROM products p
+                WHERE p.search_vector @@ plainto_tsquery('russian', %s)
+                {filters}
+                LIMIT %s
+            ) matches
+        ''', [query, *filter_params, SEARCH_TOTAL_LIMIT], prepare=False)
+        return cur.fetchone()['total_count']
+
+    def _find_similar(self, cur, query: str, filters: str, filter_params: List, limit: int) -> List[Dict]:
+        """Товары с похожими на query словами в названии (опечатки)"""
+        cur.execute(f'''
+            SELECT p.id, p.article, p.name, p.price, p.url, p.picture, p.category_paths,
+                   word_similarity(%s, p.name) as rank
+            FROM products p
+            WHERE %s <%% p.name
+            {filters}
+            ORDER BY rank DESC, p.id
+            LIMIT %s
+        ''', [query, query, *filter_params, limit])
+        return cur.fetchall()
+
+    def _find_by_article(self, cur, query: str, filters: str = '', filter_params: Optional[List] = None,
+                         limit: int = 50) -> List[Dict]:
+        """Товары с артикулом или id, равным query, иначе - с артикулом, начинающимся с query"""
+        filter_params = filter_params or []
+        cur.execute(f'''
+            SELECT p.id, p.article, p.name, p.price, p.url, p.picture, p.category_paths
+            FROM products p
+            WHERE (p.article = %s OR p.id = %s)
+            {filters}
+            ORDER BY p.id
+            LIMIT %s
+        ''', [query, query, *filter_params, limit])
+        products = cur.fetchall()
+        if products or len(query) < ARTICLE_PREFIX_MIN_LENGTH:
+            return products
+        
+        cur.execute(f'''
+            SELECT p.id, p.article, p.name, p.price, p.url, p.picture, p.category_paths
+            FROM products p
+            WHERE p.article LIKE %s
+            {filters}
+            ORDER BY p.article, p.id
+            LIMIT %s
+        ''', [f'{_like_pattern(query)}%', *filter_params, limit])
+        return cur.fetchall()
+
+    @contextmanager
+    def _snapshot(self):
+        """Соединение с транзакцией только для чтения в одном снимке базы и номер живой версии.
+
+        Соединение берется вне области HTTP-запроса: потоковая выдача
+        продолжается после завершения обработчика.
+        """
+        conn = self.get_connection(scoped=False)
+        try:
+            # Режим транзакции меняется только вне транзакции
+            conn.rollback()
+            conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+            with conn.cursor() as cur:
+                cur.execute("SELECT version FROM catalog_versions WHERE status = 'live'")
+                version = cur.fetchone()[0]
+            yield conn, version
+        finally:
+            conn.rollback()
+            conn.set_session(isolation_level='DEFAULT', readonly='DEFAULT')
+            self.put_connection(conn)
+
+    @contextmanager
+    def search_documents(self, batch_size: int = 10000):
+        """Номер живой версии и товары этой версии для индекса поиска в памяти.
+
+        Отдает (version, rows), rows - итератор кортежей (id, article, name,
+        price, url, picture, category_paths, id_rank, article_rank) в порядке
+        байтов id. id_rank и article_rank - место товара в выдаче ORDER BY id
+        и ORDER BY article, id по правилам сортировки базы. Версия и товары
+        читаются из одного снимка базы; строки подгружаются пачками через
+        серверный курсор, пока открыт контекст.
+        """
+        with self._snapshot() as (conn, version):
+            with conn.cursor(name='search_documents') as cur:
+                cur.itersize = batch_size
+                cur.execute('''
+                    SELECT id, article, name, price, url, picture, category_paths,
+                           row_number() OVER (ORDER BY id) - 1,
+                           row_number() OVER (ORDER BY article, id) - 1
+                    FROM products
+                    ORDER BY id COLLATE "C"
+                ''')
+                yield version, iter(cur)
+
+    @contextmanager
+    def export_products(self, category_id: Optional[int] = None, batch_size: int = 5000):
+        """Выгрузка товаров каталога или поддерева категории.
+
+        Отдает (version, items), items - итератор товаров в формате API в
+        порядке id. Товары читаются из одного снимка базы пачками по
+        batch_size через серверный курсор, так что память не зависит от
+        размера выгрузки. ValueError, если категории нет.
+        """
+        with self._snapshot() as (conn, version):
+            subtree = ''
+            params = []
+            if category_id is not None:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1 FROM categories WHERE id = %s', (category_id,))
+                    if cur.fetchone() is None:
+                        raise ValueError(f"Категория {category_id} не найдена")
+                subtree = '''
+                    WHERE p.id IN (
+                        SELECT pc.product_id
+                        FROM category_closure cl
+                        JOIN product_categories pc ON pc.category_id = cl.descendant_id
+                        WHERE cl.ancestor_id = %s
+                    )
+                '''
+                params.append(category_id)
+            
+            with conn.cursor(name='export_products', cursor_factory=RealDictCursor) as cur:
+                cur.itersize = batch_size
+                cur.execute(f'''
+                    SELECT p.id, p.article, p.name, p.price, p.url, p.picture, p.category_paths
                     FROM products p
-                    LEFT JOIN category_paths cp ON p.id = cp.product_id
-                    WHERE p.search_vector @@ plainto_tsquery('russian', %s)
-                    ORDER BY p.id, rank DESC
-                    LIMIT 50
-                )
-                SELECT *
-                FROM search_results
-                ORDER BY rank DESC
-            ''', (query, query))
+                    {subtree}
+                    ORDER BY p.id
+                ''', params)
+                yield version, (_product_item(row) for row in cur)
+
+    @coalesced
+    def suggest(self, query: str, limit: int = 10, timeout_ms: int = 200) -> Dict:
+        """Подсказки для строки поиска: товары и категории.
+
+        Ищется подстрока в названиях и начало артикула, при пустом результате -
+        похожие слова (опечатки). Запросы ограничены timeout_ms: подсказка,
+        не успевшая за это время, не нужна, поэтому при превышении
+        возвращается то, что успели найти, с признаком partial.
+        """
+        pattern = _like_pattern(query)
+        suggestions = {'products': [], 'categories': []}
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute('SET LOCAL statement_timeout = %s', (timeout_ms,))
             
+            # Порядок по названию, а не по похожести: для частых подстрок Postgres
+            # идет по индексу (name, id) и останавливается на первых limit строках
+            cur.execute('''
+                SELECT id, article, name
+                FROM products
+                WHERE name ILIKE %s OR article ILIKE %s
+                ORDER BY name, id
+                LIMIT %s
+            ''', (f'%{pattern}%', f'{pattern}%', limit))
             products = cur.fetchall()
+            if not products:
+                cur.execute('''
+                    SELECT id, article, name
+                    FROM products
+                    WHERE %s <%% name
+                    ORDER BY word_similarity(%s, name) DESC, name, id
+                    LIMIT %s
+                ''', (query, query, limit))
+                products = cur.fetchall()
+            suggestions['products'] = products
             
-            return [{
-                'id': row['id'],
-                'article': row['article'],
-                'name': row['name'],
-                'price': float(row['price']),
-                'url': row['url'],
-                'picture': row['picture'],
-                'category_paths': row['category_paths']
-            } for row in products]
-            
+            cur.execute('''
+                SELECT id, name, path
+                FROM categories
+                WHERE path IS NOT NULL AND (name ILIKE %s OR %s <%% name)
+                ORDER BY word_similarity(%s, name) DESC, path, id
+                LIMIT %s
+            ''', (f'%{pattern}%', query, query, limit))
+            suggestions['categories'] = cur.fetchall()
+        except psycopg2.errors.QueryCanceled:
+            self.logger.warning(f"Подсказки для '{query}' не уложились в {timeout_ms} мс")
+            suggestions['partial'] = True
+        finally:
+            # Транзакцию завершаем в любом случае, чтобы statement_timeout не достался следующему запросу
+            conn.rollback()
+            cur.close()
+            self.put_connection(conn)
+        
+        return suggestions
+
+    def acquire_ingest_lock(self):
+        """Захват блокировки загрузки фида.
+
+        Блокировка живет в сессии Postgres, поэтому действует для всех воркеров
+        и снимается автоматически, если процесс загрузки умер. Возвращает
+        соединение, держащее блокировку, или None, если загрузка уже идет.
+        """
+        # Соединение уходит в фоновое задание загрузки и переживает запрос
+        conn = self.get_connection(scoped=False)
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT pg_try_advisory_lock(%s)', (INGEST_LOCK_KEY,))
+            acquired = cur.fetchone()[0]
+            conn.commit()
+            cur.close()
+        except Exception:
+            self.put_connection(conn)
+            raise
+        if not acquired:
+            self.put_connection(conn)
+            return None
+        return conn
+
+    def release_ingest_lock(self, conn):
+        """Снятие блокировки загрузки фида"""
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT pg_advisory_unlock(%s)', (INGEST_LOCK_KEY,))
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            self.logger.error(f"Ошибка при снятии блокировки загрузки: {str(e)}")
+            # Закрываем соединение, чтобы Postgres гарантированно снял блокировку
+            self._pool.putconn(conn, close=True)
+            return
+        self.put_connection(conn)
+
+    @contextmanager
+    def ingest_lock(self):
+        """Блокировка загрузки фида; RuntimeError, если загрузка уже идет"""
+        conn = self.acquire_ingest_lock()
+        if conn is None:
+            raise RuntimeError('Обновление каталога уже выполняется')
+        try:
+            yield
+        finally:
+            self.release_ingest_lock(conn)
+
+    def create_ingest_job(self) -> int:
+        """Создание задания загрузки фида"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("INSERT INTO ingest_jobs (status, stage) VALUES ('running', 'queued') RETURNING id")
+            job_id = cur.fetchone()[0]
+            conn.commit()
+            return job_id
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            self.put_connection(conn)
+
+    def update_ingest_job(self, job_id: int, **fields):
+        """Обновление состояния задания загрузки"""
+        unknown = set(fields) - set(INGEST_JOB_FIELDS)
+        if unknown:
+            raise ValueError(f"Неизвестные поля задания: {', '.join(sorted(unknown))}")
+        if 'summary' in fields:
+            fields['summary'] = Json(fields['summary'])
+
+        assignments = ', '.join(f"{name} = %s" for name in fields)
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                f'UPDATE ingest_jobs SET {assignments}, updated_at = now() WHERE id = %s',
+                (*fields.values(), job_id)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
         finally:
             cur.close()
             self.put_connection(conn)
 
+    def get_ingest_job(self, job_id: int) -> Optional[Dict]:
+        """Состояние задания загрузки"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute('''
+                SELECT j.*,
+                       EXISTS (
+                           SELECT 1 FROM pg_locks
+                           WHERE locktype = 'advisory' AND classid = 0 AND objid = %s AND granted
+                       ) as lock_held
+                FROM ingest_jobs j
+                WHERE j.id = %s
+            ''', (INGEST_LOCK_KEY, job_id))
+            job = cur.fetchone()
+            conn.commit()
+        finally:
+            cur.close()
+            self.put_connection(conn)
+
+        if job is None:
+            return None
+
+        job = dict(job)
+        lock_held = job.pop('lock_held')
+        # Процесс загрузки умер, не успев записать итог: блокировку уже никто не держит
+        if job['status'] == 'running' and not lock_held:
+            job['status'] = 'failed'
+            job['error'] = job['error'] or 'Процесс загрузки был прерван'
+        for name in ('started_at', 'updated_at', 'finished_at'):
+            if job[name] is not None:
+                job[name] = job[name].isoformat()
+        return job
+
+    @coalesced
     def get_statistics(self) -> Dict:
-        """Получение статистики каталога"""
+        """Получение статистики каталога.
+
+        Статистика рассчитывается при загрузке фида и хранится в версии каталога
+        """
         conn = self.get_connection()
         try:
             cur = conn.cursor(cursor_factory=RealDictCursor)
-            
-            # Общая статистика
             cur.execute('''
-                SELECT 
-                    (SELECT COUNT(*) FROM categories) as total_categories,
-                    (SELECT COUNT(*) FROM products) as total_products,
-                    (SELECT COUNT(*) FROM products WHERE picture IS NOT NULL) as products_with_images,
-                    (SELECT COUNT(DISTINCT category_id) FROM product_categories) as categories_with_products,
-                    (SELECT AVG(price) FROM products) as average_price,
-                    (SELECT MIN(price) FROM products) as min_price,
-                    (SELECT MAX(price) FROM products) as max_price
+                SELECT total_categories, total_products, products_with_images, categories_with_products,
+                       average_price, min_price, max_price
+                FROM catalog_stats
+                WHERE version = (SELECT version FROM catalog_versions WHERE status = 'live')
             ''')
-            
             stats = cur.fetchone()
-            
-            return {
-                'total_categories': stats['total_categories'],
-                'total_products': stats['total_products'],
-                'products_with_images': stats['products_with_images'],
-                'categories_with_products': stats['categories_with_products'],
-                'average_price': round(float(stats['average_price']), 2) if stats['average_price'] else 0,
-                'min_price': round(float(stats['min_price']), 2) if stats['min_price'] else 0,
-                'max_price': round(float(stats['max_price']), 2) if stats['max_price'] else 0
-            }
-            
+            conn.commit()
         finally:
             cur.close()
             self.put_connection(conn)
+        
+        if stats is None:
+            # Каталог менялся построчно, без refresh_derived_data
+            self.logger.warning("Статистика текущей версии каталога не рассчитана")
+            return {}
+        
+        return {
+            'total_categories': stats['total_categories'],
+            'total_products': stats['total_products'],
+            'products_with_images': stats['products_with_images'],
+            'categories_with_products': stats['categories_with_products'],
+            'average_price': round(float(stats['average_price']), 2) if stats['average_price'] else 0,
+            'min_price': round(float(stats['min_price']), 2) if stats['min_price'] else 0,
+            'max_price': round(float(stats['max_price']), 2) if stats['max_price'] else 0
+        }
 
+    @coalesced
+    def get_category_statistics(self, category_id: int) -> Optional[Dict]:
+        """Число товаров и цены в поддереве категории; None, если категории нет"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute('''
+                SELECT direct_count, subtree_count, min_price, avg_price, max_price
+                FROM category_product_counts
+                WHERE category_id = %s
+            ''', (category_id,))
+            stats = cur.fetchone()
+            conn.commit()
+        finally:
+            cur.close()
+            self.put_connection(conn)
+        
+        if stats is None:
+            return None
+        
+        return {
+            'category_id': category_id,
+            'direct_products': stats['direct_count'],
+            'total_products': stats['subtree_count'],
+            'average_price': round(float(stats['avg_price']), 2) if stats['avg_price'] else 0,
+            'min_price': round(float(stats['min_price']), 2) if stats['min_price'] else 0,
+            'max_price': round(float(stats['max_price']), 2) if stats['max_price'] else 0
+        }
+
+    @coalesced
     def get_category_tree(self) -> List[Dict]:
         """Получение дерева категорий"""
         conn = self.get_connection()
         try:
             cur = conn.cursor(cursor_factory=RealDictCursor)
             
-            # Получаем все категории с количеством товаров, включая подкатегории
-            cur.execute('''
-                WITH RECURSIVE subcategories AS (
-                    SELECT c.id, c.name, c.parent_id, 1 as level, ARRAY[c.id] as path
-                    FROM categories c
-                    WHERE c.parent_id IS NULL
-                    
-                    UNION ALL
-                    
-                    SELECT c.id, c.name, c.parent_id, s.level + 1, s.path || c.id
-                    FROM categories c
-                    JOIN subcategories s ON c.parent_id = s.id
-                    WHERE NOT c.id = ANY(s.path)
-                ),
-                category_products AS (
-                    SELECT 
-                        c.id,
-                        COUNT(DISTINCT CASE WHEN pc.product_id IS NOT NULL AND p.id IS NOT NULL THEN pc.product_id END) as direct_count,
-                        (
-                            WITH RECURSIVE child_categories AS (
-                                SELECT id FROM categories WHERE id = c.id
-                                UNION ALL
-                                SELECT ch.id 
-                                FROM categories ch
-                                JOIN child_categories cc ON ch.parent_id = cc.id
-                            )
-                            SELECT COUNT(DISTINCT CASE WHEN pc2.product_id IS NOT NULL AND p2.id IS NOT NULL THEN pc2.product_id END)
-                            FROM product_categories pc2
-                            LEFT JOIN products p2 ON pc2.product_id = p2.id
-                            WHERE pc2.category_id IN (SELECT id FROM child_categories)
-                        ) as product_count,
-                        array_agg(DISTINCT CASE WHEN pc.product_id IS NOT NULL AND p.id IS NOT NULL THEN pc.product_id END) FILTER (WHERE pc.product_id IS NOT NULL AND p.id IS NOT NULL) as product_ids
-                    FROM categories c
-                    LEFT JOIN product_categories pc ON c.id = pc.category_id
-                    LEFT JOIN products p ON pc.product_id = p.id
-                    GROUP BY c.id
-                )
-                SELECT s.id, s.name, s.parent_id, s.level, s.path,
-                       COALESCE(cp.direct_count, 0) as direct_product_count,
-                       COALESCE(cp.product_count, 0) as product_count,
-                       cp.product_ids
-                FROM subcategories s
-                LEFT JOIN category_products cp ON s.id = cp.id
-                ORDER BY s.path;
+            # Категории с числом товаров в поддереве, рассчитанным при загрузке.
+            # Путь есть только у категорий, достижимых от корней
+            self._statements.execute(cur, 'category_tree', '''
+                SELECT c.id, c.name, c.parent_id,
+                       COALESCE(cnt.subtree_count, 0) as product_count
+                FROM categories c
+                LEFT JOIN category_product_counts cnt ON cnt.category_id = c.id
+                WHERE c.path IS NOT NULL
+                ORDER BY c.id
             ''')
             
             categories = cur.fetchall()
             
-            # Создаем словарь для быстрого доступа к категориям
-            categories_dict = {cat['id']: cat for cat in categories}
-            
-            # Функция для получения всех родительских категорий
-            def get_parent_categories(category_id):
-                parents = []
-                current_id = category_id
-                while current_id in categories_dict and categories_dict[current_id]['parent_id']:
-                    parent_id = categories_dict[current_id]['parent_id']
-                    if parent_id in categories_dict:
-                        parents.append(parent_id)
-                        current_id = parent_id
-                    else:
-                        break
-                return parents
-            
-            # Добавляем продукты в родительские категории
+            # Преобразуем плоский список в дерево за один проход:
+            # узлы по id, дети добавляются к родителю в порядке id
+            nodes = {
+                cat['id']: {
+                    'id': cat['id'],
+                    'name': cat['name'],
+                    'product_count': cat['product_count']
+                }
+                for cat in categories
+            }
+            root_categories = []
             for cat in categories:
-                if cat['product_ids'] and cat['product_ids'][0] is not None:  # Проверяем, что есть реальные товары
-                    parent_ids = get_parent_categories(cat['id'])
-                    for parent_id in parent_ids:
-                        if parent_id in categories_dict:
-                            parent = categories_dict[parent_id]
-                            if parent['product_ids'] is None:
-                                parent['product_ids'] = []
-                            elif parent['product_ids'][0] is None:
-                                parent['product_ids'] = []
-                            parent['product_ids'].extend(cat['product_ids'])
-            
-            # Преобразуем плоский список в дерево
-            def build_tree(categories_list, parent_id=None):
-                tree = []
-                for cat in categories_list:
-                    if cat['parent_id'] == parent_id:
-                        children = build_tree(categories_list, cat['id'])
-                        category = {
-                            'id': cat['id'],
-                            'name': cat['name'],
-                            'product_count': len(set(filter(None, cat['product_ids']))) if cat['product_ids'] else 0
-                        }
-                        if children:
-                            category['children'] = children
-                        tree.append(category)
-                return tree
-            
-            # Получаем корневые категории
-            root_categories = build_tree(categories)
+                node = nodes[cat['id']]
+                if cat['parent_id'] is None:
+                    root_categories.append(node)
+                elif cat['parent_id'] in nodes:
+                    nodes[cat['parent_id']].setdefault('children', []).append(node)
             
             return root_categories
             
         finally:
             cur.close()
-            self.put_connection(conn) 
\ No newline at end of file
+            self.put_connection(conn)
+
+
+    @coalesced
+    def get_category_children(self, parent_id: Optional[int] = None, depth: int = 1) -> Optional[List[Dict]]:
+        """Дочерние категории на depth уровней вниз (для parent_id=None - корневые).
+
+        Стоимость зависит только от числа возвращаемых категорий. У каждой
+        категории есть has_children; children заполнены только в пределах depth.
+        None, если категории parent_id нет.
+        """
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            
+            if parent_id is None:
+                # Корни и их потомки глубже корня не более чем на depth - 1 уровней
+                levels = 'r.parent_id IS NULL AND cl.depth < %s'
+                params = (depth,)
+            else:
+                cur.execute('SELECT 1 FROM categories WHERE id = %s', (parent_id,))
+                if cur.fetchone() is None:
+                    return None
+                levels = 'r.id = %s AND cl.depth BETWEEN 1 AND %s'
+                params = (parent_id, depth)
+            
+            self._statements.execute(cur, 'category_children', f'''
+                SELECT c.id, c.name, c.parent_id,
+                       COALESCE(cnt.subtree_count, 0) as product_count,
+                       EXISTS (SELECT 1 FROM categories ch WHERE ch.parent_id = c.id) as has_children
+                FROM categories r
+                JOIN category_closure cl ON cl.ancestor_id = r.id
+                JOIN categories c ON c.id = cl.descendant_id
+                LEFT JOIN category_product_counts cnt ON cnt.category_id = c.id
+                WHERE {levels}
+                ORDER BY cl.depth, c.id
+            ''', params)
+            
+            categories = cur.fetchall()
+            
+            # Родитель всегда идет раньше потомков: строки упорядочены по глубине
+            nodes = {}
+            children = []
+            for cat in categories:
+                node = {
+                    'id': cat['id'],
+                    'name': cat['name'],
+                    'product_count': cat['product_count'],
+                    'has_children': cat['has_children']
+                }
+                nodes[cat['id']] = node
+                if cat['parent_id'] == parent_id:
+                    children.append(node)
+                elif cat['parent_id'] in nodes:
+                    nodes[cat['parent_id']].setdefault('children', []).append(node)
+            
+            return children
+            
+        finally:
+            cur.close()
+            self.put_connection(conn)
+
+class CatalogBulkLoader:
+    """Пакетная загрузка товаров.
+
+    Товары и связи с категориями буферизуются и пачками передаются через
+    COPY FROM STDIN в нежурналируемые staging-таблицы, а затем переносятся в
+    products/product_categories несколькими SQL-операторами. Вся загрузка
+    выполняется в одной транзакции: при ошибке каталог остается прежним.
+    Идентификаторы товаров в пределах одной загрузки должны быть уникальны.
+
+    В дельта-режиме (delta=True) перезаписываются только товары с изменившимся
+    хэшем содержимого, а товары, отсутствующие в текущем фиде, удаляются.
+    Товары, которые в фиде есть, но отклонены при разборе (keep_product),
+    не удаляются и остаются в прежнем виде. Итоги загрузки доступны в summary.
+
+    Пачки товаров можно копировать в staging и через другие соединения
+    (copy_batch), например из потоков конвейерной загрузки.
+
+    Каждая загрузка создает новую версию каталога. С versioned=True версия
+    собирается целиком в отдельной схеме catalog_v{version}, которую читатели
+    не видят, и в конце атомарно подменяет живую схему catalog. Прежняя версия
+    остается доступной для отката, хранятся keep_versions предыдущих версий.
+    Без versioned изменения переносятся прямо в живые таблицы.
+    """
+
+    def __init__(self, db: 'CatalogDatabase', batch_size: int = 10000, delta: bool = False,
+                 versioned: bool = False, keep_versions: int = 2):
+        self.db = db
+        self.batch_size = batch_size
+        self.delta = delta
+        self.versioned = versioned
+        self.keep_versions = keep_versions
+        self.summary = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0}
+        self.logger = db.logger
+        self.conn = None
+        self.version = None
+        self.staged_count = 0
+        # Товары фида, отклоненные при разборе: в дельта-режиме их не удаляем
+        self._kept_ids = set()
+        self._products = io.StringIO()
+        self._links = io.StringIO()
+        self._buffered = 0
+        self._staged_lock = threading.Lock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.abort()
+
+    def open(self):
+        """Начало загрузки: очистка staging-таблиц и создание новой версии каталога"""
+        self.conn = self.db.get_connection()
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute('TRUNCATE products_staging, product_categories_staging')
+            # Фиксируем сразу, иначе блокировка TRUNCATE не даст писать в staging из других соединений
+            self.conn.commit()
+
+            with self.conn.cursor() as cur:
+                cur.execute("INSERT INTO catalog_versions (status) VALUES ('building') RETURNING version")
+                self.version = cur.fetchone()[0]
+                if self.versioned:
+                    schema = _version_schema(self.version)
+                    cur.execute(f'CREATE SCHEMA {schema}')
+                    _create_catalog_tables(cur, schema, constraints=False)
+                    # До конца транзакции загрузки таблицы каталога - это таблицы новой версии
+                    cur.execute(f'SET LOCAL search_path = {schema}, public')
+        except Exception as e:
+            self.abort()
+            raise BulkLoadError(f"Не удалось подготовить загрузку: {str(e)}") from e
+
+    def add_categories(self, categories: List[Tuple[int, str, Optional[int]]]):
+        """Добавление категорий в транзакции загрузки (до переноса товаров)"""
+        try:
+            with self.conn.cursor() as cur:
+                _upsert_categories(cur, categories)
+        except Exception as e:
+            raise BulkLoadError(f"Ошибка при добавлении категорий: {str(e)}") from e
+
+    def add_product(self, product_id: str, article: str, name: str, price: float,
+                    url: str, picture: Optional[str] = None, category_ids: List[int] = None):
+        """Добавление товара в буфер загрузки"""
+        self._encode(self._products, self._links, product_id, article, name, price, url, picture, category_ids)
+        self._buffered += 1
+        if self._buffered >= self.batch_size:
+            self.flush()
+
+    def keep_product(self, product_id: str):
+        """Товар есть в фиде, но отклонен при разборе: прежняя версия товара сохраняется"""
+        self._kept_ids.add(product_id)
+
+    def flush(self):
+        """Передача буфера в staging-таблицы через COPY"""
+        if not self._buffered:
+            return
+        self._copy(self.conn, self._products, self._links, self._buffered)
+        self._products = io.StringIO()
+        self._links = io.StringIO()
+        self._buffered = 0
+
+    def copy_batch(self, conn, products: List[Dict]):
+        """Копирование пачки товаров в staging через отдельное соединение.
+
+        products - словари с аргументами add_product. Пачка фиксируется сразу,
+        чтобы стать видимой соединению загрузчика при переносе.
+        """
+        products_buffer = io.StringIO()
+        links_buffer = io.StringIO()
+        for product in products:
+            self._encode(products_buffer, links_buffer, **product)
+        self._copy(conn, products_buffer, links_buffer, len(products))
+        try:
+            conn.commit()
+        except Exception as e:
+            raise BulkLoadError(f"Ошибка при фиксации пачки товаров: {str(e)}") from e
+
+    @staticmethod
+    def _encode(products_buffer, links_buffer, product_id: str, article: str, name: str, price: float,
+                url: str, picture: Optional[str] = None, category_ids: List[int] = None):
+        content_hash = _content_hash(article, name, price, url, picture, category_ids)
+        products_buffer.write('\t'.join(_copy_value(v) for v in (
+            product_id, article, name, price, url, picture, bool(category_ids), content_hash
+        )) + '\n')
+        for category_id in category_ids or ():
+            links_buffer.write(f"{_copy_value(product_id)}\t{int(category_id)}\n")
+
+    def _copy(self, conn, products_buffer, links_buffer, count: int):
+        try:
+            with conn.cursor() as cur:
+                products_buffer.seek(0)
+                cur.copy_expert(
+                    'COPY products_staging (id, article, name, price, url, picture, has_categories, content_hash) FROM STDIN',
+                    products_buffer
+                )
+                links_buffer.seek(0)
+                cur.copy_expert(
+                    'COPY product_categories_staging (product_id, category_id) FROM STDIN',
+                    links_buffer
+                )
+        except Exception as e:
+            raise BulkLoadError(f"Ошибка при копировании товаров в staging: {str(e)}") from e
+
+        with self._staged_lock:
+            self.staged_count += count
+            staged_count = self.staged_count
+        self.logger.debug(f"Скопировано в staging {staged_count} товаров")
+
+    def finish(self):
+        """Перенос staging-таблиц в каталог и фиксация транзакции"""
+        try:
+            self.flush()
+            with self.conn.cursor() as cur:
+                cur.execute('ANALYZE products_staging')
+                cur.execute('ANALYZE product_categories_staging')
+
+                # Товары, которых нет в живой версии каталога или у которых изменилось содержимое
+                cur.execute(f'''
+                    CREATE TEMP TABLE changed_products ON COMMIT DROP AS
+                    SELECT s.id, p.id IS NULL AS is_new
+                    FROM products_staging s
+                    LEFT JOIN {LIVE_SCHEMA}.products p ON p.id = s.id
+                    WHERE p.id IS NULL OR p.content_hash IS DISTINCT FROM s.content_hash
+                ''')
+                cur.execute('SELECT COUNT(*) FILTER (WHERE is_new), COUNT(*) FILTER (WHERE NOT is_new) FROM changed_products')
+                inserted, updated = cur.fetchone()
+                self.summary.update(
+                    inserted=inserted,
+                    updated=updated,
+                    unchanged=self.staged_count - inserted - updated
+                )
+
+                if self.versioned:
+                    self._build_version(cur)
+                    _refresh_category_counts(cur)
+                    _refresh_catalog_stats(cur, self.version)
+                    for table in CATALOG_TABLES:
+                        cur.execute(f'ANALYZE {table}')
+                else:
+                    self._merge_in_place(cur)
+                    changed = _refresh_derived_data(
+                        cur,
+                        changed_only=True,
+                        products_changed=any(self.summary[k] for k in ('inserted', 'updated', 'deleted'))
+                    )
+                    _refresh_catalog_stats(cur, self.version, changed)
+                self._activate_version(cur)
+                # staging-таблицы очищаются в начале следующей загрузки
+            self.conn.commit()
+            self.db._on_live_version(self.version)
+            self.logger.info(
+                f"Пакетная загрузка завершена, версия каталога {self.version}: {self.staged_count} товаров "
+                f"(новых: {self.summary['inserted']}, изменено: {self.summary['updated']}, "
+                f"без изменений: {self.summary['unchanged']}, удалено: {self.summary['deleted']})"
+            )
+        except BulkLoadError:
+            self.abort()
+            raise
+        except Exception as e:
+            self.abort()
+            raise BulkLoadError(f"Ошибка при переносе товаров из staging: {str(e)}") from e
+        finally:
+            self._release()
+
+        if self.versioned:
+            self.db.prune_catalog_versions(self.keep_versions)
+
+    def _merge_in_place(self, cur):
+        """Перенос изменений прямо в живые таблицы каталога"""
+        # В дельта-режиме переносим только изменившиеся товары
+        product_filter = link_filter = ''
+        if self.delta:
+            product_filter = 'JOIN changed_products ch ON ch.id = s.id'
+            link_filter = 'JOIN changed_products ch ON ch.id = st.product_id'
+        cur.execute(f'''
+            INSERT INTO products (id, article, name, price, url, picture, has_categories, content_hash)
+            SELECT s.id, s.article, s.name, s.price, s.url, s.picture, s.has_categories, s.content_hash
+            FROM products_staging s
+            {product_filter}
+            ON CONFLICT (id) DO UPDATE SET
+                article = EXCLUDED.article,
+                name = EXCLUDED.name,
+                price = EXCLUDED.price,
+                url = EXCLUDED.url,
+                picture = EXCLUDED.picture,
+                has_categories = EXCLUDED.has_categories,
+                content_hash = EXCLUDED.content_hash
+        ''')
+        # Связи заменяются только у товаров, для которых пришли категории.
+        # Удаляем и вставляем только разницу, чтобы не перезаписывать неизменные связи
+        cur.execute(f'''
+            DELETE FROM product_categories pc
+            USING products_staging s
+            {product_filter}
+            WHERE pc.product_id = s.id AND s.has_categories
+              AND NOT EXISTS (
+                  SELECT 1 FROM product_categories_staging st
+                  WHERE st.product_id = pc.product_id AND st.category_id = pc.category_id
+              )
+        ''')
+        cur.execute(f'''
+            INSERT INTO product_categories (product_id, category_id)
+            SELECT DISTINCT st.product_id, st.category_id
+            FROM product_categories_staging st
+            {link_filter}
+            WHERE NOT EXISTS (
+                SELECT 1 FROM product_categories pc
+                WHERE pc.product_id = st.product_id AND pc.category_id = st.category_id
+            )
+            ON CONFLICT DO NOTHING
+        ''')
+
+        if self.delta:
+            self._sweep_stale_products(cur)
+
+    def _build_version(self, cur):
+        """Заполнение таблиц новой версии каталога.
+
+        Категории фида уже добавлены в новую версию. В дельта-режиме версия
+        содержит только товары текущего фида (из отклоненных при разборе -
+        прежние версии), иначе товары и категории живой версии, которых нет
+        в фиде, переносятся в новую версию без изменений.
+        """
+        carry_over = not self.delta
+        if self.delta and not self.staged_count:
+            # Пустой фид скорее означает ошибку выгрузки, чем пустой каталог
+            self.logger.warning("В фиде нет товаров, удаление устаревших товаров пропущено")
+            carry_over = True
+
+        if carry_over:
+            cur.execute(f'''
+                INSERT INTO categories (id, name, parent_id)
+                SELECT c.id, c.name, c.parent_id
+                FROM {LIVE_SCHEMA}.categories c
+                WHERE NOT EXISTS (SELECT 1 FROM categories n WHERE n.id = c.id)
+            ''')
+        # Пути категорий нужны до вставки товаров: товары вставляются сразу с путями
+        _refresh_category_tree(cur)
+
+        cur.execute(f'''
+            INSERT INTO products (id, article, name, price, url, picture, has_categories, content_hash,
+                                  category_paths)
+            SELECT s.id, s.article, s.name, s.price, s.url, s.picture, s.has_categories, s.content_hash,
+                   pp.category_paths
+            FROM products_staging s
+            LEFT JOIN ({_product_paths_query('product_categories_staging')}) pp ON pp.product_id = s.id
+        ''')
+        cur.execute('''
+            INSERT INTO product_categories (product_id, category_id)
+            SELECT DISTINCT product_id, category_id
+            FROM product_categories_staging
+        ''')
+
+        if carry_over or self._kept_ids:
+            # В дельта-режиме переносятся только товары, отклоненные при разборе фида
+            kept_filter, kept_params = '', []
+            if not carry_over:
+                kept_filter, kept_params = 'AND {} = ANY(%s)', [list(self._kept_ids)]
+            carried_filter = 'AND NOT EXISTS (SELECT 1 FROM products_staging s WHERE s.id = l.product_id) ' \
+                + kept_filter.format('l.product_id')
+            cur.execute(f'''
+                INSERT INTO products (id, article, name, price, url, picture, has_categories, content_hash,
+                                      category_paths)
+                SELECT p.id, p.article, p.name, p.price, p.url, p.picture, p.has_categories, p.content_hash,
+                       pp.category_paths
+                FROM {LIVE_SCHEMA}.products p
+                LEFT JOIN ({_product_paths_query(f'{LIVE_SCHEMA}.product_categories', carried_filter)}) pp
+                       ON pp.product_id = p.id
+                WHERE NOT EXISTS (SELECT 1 FROM products_staging s WHERE s.id = p.id)
+                {kept_filter.format('p.id')}
+            ''', kept_params * 2)
+            cur.execute(f'''
+                INSERT INTO product_categories (product_id, category_id)
+                SELECT pc.product_id, pc.category_id
+                FROM {LIVE_SCHEMA}.product_categories pc
+                WHERE NOT EXISTS (SELECT 1 FROM products_staging s WHERE s.id = pc.product_id)
+                {kept_filter.format('pc.product_id')}
+            ''', kept_params)
+        if not carry_over:
+            cur.execute(f'''
+                SELECT COUNT(*) FROM {LIVE_SCHEMA}.products p
+                WHERE NOT EXISTS (SELECT 1 FROM products_staging s WHERE s.id = p.id)
+                  AND p.id <> ALL(%s)
+            ''', (list(self._kept_ids),))
+            self.summary['deleted'] = cur.fetchone()[0]
+
+        _create_catalog_constraints(cur, _version_schema(self.version))
+
+    def _activate_version(self, cur):
+        """Объявление собранной версии живой"""
+        if self.versioned:
+            _switch_live_version(cur, self.version)
+        else:
+            # Прежняя версия перезаписана на месте, откатиться на нее нельзя
+            cur.execute("UPDATE catalog_versions SET status = 'dropped' WHERE status = 'live'")
+            cur.execute(
+                "UPDATE catalog_versions SET status = 'live', activated_at = now() WHERE version = %s",
+                (self.version,)
+            )
+        cur.execute('UPDATE catalog_versions SET summary = %s WHERE version = %s', (Json(self.summary), self.version))
+
+    def _sweep_stale_products(self, cur):
+        """Удаление товаров, отсутствующих в текущем фиде"""
+        if not self.staged_count:
+            # Пустой фид скорее означает ошибку выгрузки, чем пустой каталог
+            self.logger.warning("В фиде нет товаров, удаление устаревших товаров пропущено")
+            return
+        # Отклоненные при разборе товары есть в фиде, их прежние версии остаются
+        cur.execute('''
+            DELETE FROM products p
+            WHERE NOT EXISTS (SELECT 1 FROM products_staging s WHERE s.id = p.id)
+              AND p.id <> ALL(%s)
+        ''', (list(self._kept_ids),))
+        self.summary['deleted'] = cur.rowcount
+
+    def abort(self):
+        """Отмена загрузки"""
+        if self.conn is not None:
+            try:
+                self.conn.rollback()
+            finally:
+                self._release()
+
+    def _release(self):
+        if self.conn is not None:
+            self.db.put_connection(self.conn)
+            self.conn = None
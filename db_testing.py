@@ -0,0 +1,42 @@
+"""Отдельная база Postgres для тестов, которым нужна настоящая база.
+
+Имя базы задает TEST_DB_NAME, остальные параметры подключения - те же
+переменные DB_*, что и у приложения. Схемы этой базы пересоздаются, поэтому
+рабочую базу указывать нельзя; без TEST_DB_NAME такие тесты пропускаются.
+"""
+import os
+import unittest
+from typing import Dict
+
+import psycopg2
+
+requires_database = unittest.skipUnless(
+    os.getenv('TEST_DB_NAME'), 'TEST_DB_NAME - отдельная база для тестов, ее схемы пересоздаются'
+)
+
+
+def database_params() -> Dict:
+    return {
+        'dbname': os.environ['TEST_DB_NAME'],
+        'user': os.getenv('DB_USER', 'postgres'),
+        'password': os.getenv('DB_PASSWORD', 'postgres'),
+        'host': os.getenv('DB_HOST', 'localhost'),
+        'port': os.getenv('DB_PORT', '5432')
+    }
+
+
+def reset_database() -> Dict:
+    """Удаление схем каталога (живой, версий и public); возвращает параметры подключения"""
+    params = database_params()
+    conn = psycopg2.connect(**params)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT nspname FROM pg_namespace WHERE nspname = 'catalog' OR nspname LIKE 'catalog\\_v%'")
+            for (schema,) in cur.fetchall():
+                cur.execute(f'DROP SCHEMA {schema} CASCADE')
+            cur.execute('DROP SCHEMA IF EXISTS public CASCADE')
+            cur.execute('CREATE SCHEMA public')
+    finally:
+        conn.close()
+    return params
@@ -1,18 +1,60 @@
 import xml.etree.ElementTree as ET
-from typing import Dict, Set
-from database import CatalogDatabase
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from database import CatalogDatabase, BulkLoadError
+from ingest_pipeline import IngestPipeline
 import logging
+import math
+import multiprocessing
+import os
+import re
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 
 class FeedParser:
-    def __init__(self, xml_file: str, db: CatalogDatabase):
+    def __init__(self, xml_file: str, db: CatalogDatabase, streaming: bool = True, bulk: bool = True,
+                 delta: bool = False, versioned: bool = False, keep_versions: int = 2,
+                 writers: int = 0, processes: int = 0, chunk_size: int = 1024 * 1024,
+                 progress: Optional[Callable[[Dict], None]] = None, progress_interval: float = 1.0):
         self.xml_file = xml_file
         self.db = db
+        # Потоковый режим: фид читается через iterparse, память не растет с размером файла
+        self.streaming = streaming
+        # Пакетная загрузка товаров через COPY вместо построчных INSERT
+        self.bulk = bulk
+        # Дельта-режим: перезаписываются только изменившиеся товары, отсутствующие в фиде удаляются
+        self.delta = delta
+        if delta and not bulk:
+            raise ValueError("Дельта-режим доступен только при пакетной загрузке")
+        # Сборка новой версии каталога в отдельной схеме с атомарным переключением
+        self.versioned = versioned
+        self.keep_versions = keep_versions
+        if versioned and not bulk:
+            raise ValueError("Версионная загрузка доступна только при пакетной загрузке")
+        # Число потоков записи для конвейерной загрузки (0 - запись в потоке разбора)
+        self.writers = writers
+        if writers and not bulk:
+            raise ValueError("Конвейерная загрузка доступна только при пакетной загрузке")
+        # Число процессов нормализации товаров (0 - в текущем процессе) и размер фрагмента фида
+        self.processes = processes
+        self.chunk_size = chunk_size
+        # Обратный вызов для отчета о ходе загрузки (не чаще раза в progress_interval секунд)
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self._progress_state = {}
+        self._progress_reported_at = 0.0
+        self._started_at = None
+        self._feed_file = None
+        self.loader = None
+        self.pipeline = None
+        # Итоги последнего запуска
+        self.summary = {}
         self.processed_categories: Set[int] = set()
         self.processed_products: Set[str] = set()
         self.category_tree = {}
         self.all_categories = {}
+        # Предки каждой категории (от корня), вычисляются один раз при загрузке категорий
+        self.category_ancestors: Dict[int, Tuple[int, ...]] = {}
         
         # Настройка логирования
         self.logger = logging.getLogger(__name__)
@@ -32,9 +74,9 @@ class FeedParser:
         # Первый проход: собираем все категории и ссылки на родителей
         for category in categories_element.findall('category'):
             try:
-                category_id = int(category.get('id'))
+                category_id = _check_category_id(int(category.get('id')))
                 parent_id = category.get('parentId')
-                parent_id = int(parent_id) if parent_id is not None else None
+                parent_id = _check_category_id(int(parent_id)) if parent_id is not None else None
                 name = category.text.strip() if category.text else ''
 
                 categories[category_id] = {
@@ -71,74 +113,240 @@ class FeedParser:
 
         return categories
 
+    def _order_categories(self) -> List[int]:
+        """Топологическая сортировка категорий (родители раньше детей).
+
+        Обход итеративный, поэтому глубина дерева не ограничена стеком.
+        Попутно для каждой категории вычисляется набор предков. Если категории
+        образуют цикл, одна из них отвязывается от родителя и становится корневой.
+        """
+        order = []
+        self.category_ancestors = {}
+
+        def visit(root_id):
+            self.category_ancestors[root_id] = ()
+            queue = deque([root_id])
+            while queue:
+                category_id = queue.popleft()
+                order.append(category_id)
+                ancestors = self.category_ancestors[category_id] + (category_id,)
+                for child_id in sorted(self.all_categories[category_id]['children']):
+                    if child_id not in self.category_ancestors:
+                        self.category_ancestors[child_id] = ancestors
+                        queue.append(child_id)
+
+        for category_id, category in self.all_categories.items():
+            if category['parent_id'] is None:
+                visit(category_id)
+
+        # Оставшиеся категории недостижимы от корней, то есть входят в цикл или лежат под ним
+        for category_id in sorted(self.all_categories):
+            if category_id in self.category_ancestors:
+                continue
+
+            chain = []
+            seen = set()
+            current_id = category_id
+            while current_id not in seen and current_id not in self.category_ancestors:
+                seen.add(current_id)
+                chain.append(current_id)
+                current_id = self.all_categories[current_id]['parent_id']
+
+            if current_id in self.category_ancestors:
+                continue
+
+            cycle = chain[chain.index(current_id):]
+            self.logger.error(f"Обнаружен цикл в дереве категорий: {' -> '.join(map(str, cycle))}; "
+                              f"категория {current_id} становится корневой")
+            category = self.all_categories[current_id]
+            self.all_categories[category['parent_id']]['children'].discard(current_id)
+            category['parent_id'] = None
+            visit(current_id)
+
+        return order
+
     def _process_categories(self):
-        """Рекурсивная обработка категорий"""
-        def process_category(category_id):
-            if category_id in self.processed_categories:
-                return
+        """Сохранение категорий одним пакетом в топологическом порядке"""
+        order = self._order_categories()
+        rows = [
+            (category_id, self.all_categories[category_id]['name'], self.all_categories[category_id]['parent_id'])
+            for category_id in order
+        ]
+        self.logger.debug(f"Добавляем {len(rows)} категорий")
+        (self.loader or self.db).add_categories(rows)
+        self.processed_categories.update(order)
 
-            category = self.all_categories[category_id]
-            
-            # Сначала обрабатываем родительскую категорию
-            if category['parent_id'] is not None:
-                process_category(category['parent_id'])
-            
-            # Добавляем текущую категорию
+    def _load_categories(self, categories_element):
+        """Сбор и сохранение категорий фида"""
+        self.all_categories = self._collect_all_categories(categories_element)
+        self.logger.info(f"Найдено {len(self.all_categories)} категорий")
+
+        self._process_categories()
+        self.logger.info(f"Обработано {len(self.processed_categories)} категорий")
+        self._report_progress('products')
+
+    def _parse_tree(self):
+        """Разбор фида целиком в памяти (DOM)"""
+        tree = ET.parse(self.xml_file)
+        root = tree.getroot()
+        shop = root.find('shop')
+
+        if shop is None:
+            raise ValueError("Не найден элемент shop в XML")
+
+        categories = shop.find('categories')
+        offers = shop.find('offers')
+
+        if categories is None:
+            raise ValueError("Не найден элемент categories в XML")
+        if offers is None:
+            raise ValueError("Не найден элемент offers в XML")
+
+        self._load_categories(categories)
+        self._process_products(offers.iterfind('offer'))
+
+    def _iter_offers(self, categories_only: bool = False):
+        """Потоковый разбор фида.
+
+        Категории обрабатываются, как только закрывается тег <categories>,
+        затем товары отдаются по одному. Каждый обработанный <offer>
+        удаляется из дерева, поэтому потребление памяти не зависит от размера фида.
+        При categories_only разбор останавливается на открытии <offers>.
+        Если <offers> идет раньше <categories>, бросает _CategoriesAfterOffers.
+        """
+        with open(self.xml_file, 'rb') as feed_file:
+            # Позиция в файле нужна для оценки прогресса
+            self._feed_file = feed_file
             try:
-                self.logger.debug(f"Добавляем категорию: id={category_id}, name='{category['name']}', parent_id={category['parent_id']}")
-                self.db.add_category(
-                    category_id=category_id,
-                    name=category['name'],
-                    parent_id=category['parent_id']
-                )
-                self.processed_categories.add(category_id)
-                
-                # Обрабатываем дочерние категории
-                for child_id in category['children']:
-                    process_category(child_id)
-            
-            except Exception as e:
-                self.logger.error(f"Ошибка при добавлении категории {category_id}: {str(e)}")
+                yield from self._iter_feed_events(ET.iterparse(feed_file, events=('start', 'end')), categories_only)
+            finally:
+                self._feed_file = None
+
+    def _iter_feed_events(self, events, categories_only: bool):
+        depth = 0
+        shop_found = categories_found = offers_found = False
+        in_shop = in_offers = False
+        offers_element = None
+
+        for event, element in events:
+            if event == 'start':
+                depth += 1
+                if depth == 2 and element.tag == 'shop' and not shop_found:
+                    shop_found = in_shop = True
+                elif in_shop and depth == 3 and element.tag == 'offers' and not offers_found:
+                    if not categories_found:
+                        raise _CategoriesAfterOffers()
+                    if categories_only:
+                        return
+                    offers_found = in_offers = True
+                    offers_element = element
+                continue
+
+            if in_offers and depth == 4 and element.tag == 'offer':
+                yield element
+                # Освобождаем уже обработанные товары
+                offers_element.clear()
+            elif in_shop and depth == 3:
+                if element.tag == 'categories' and not categories_found:
+                    categories_found = True
+                    self._load_categories(element)
+                    element.clear()
+                elif element is offers_element:
+                    in_offers = False
+                    element.clear()
+            elif in_shop and depth == 2:
+                in_shop = False
+            depth -= 1
+
+        if not shop_found:
+            raise ValueError("Не найден элемент shop в XML")
+        if not categories_found:
+            raise ValueError("Не найден элемент categories в XML")
+        if not offers_found:
+            raise ValueError("Не найден элемент offers в XML")
+
+    def _parse_feed(self):
+        if not (self.streaming or self.processes > 1):
+            self._parse_tree()
+            return
+        try:
+            if self.processes > 1:
+                self._process_products_parallel()
+            else:
+                self._process_products(self._iter_offers())
+        except _CategoriesAfterOffers:
+            # Товары не нормализовать без категорий, а дойти до категорий
+            # потоково можно, только пропустив товары. Ни одного товара еще не записано
+            self.logger.warning("Категории в фиде идут после товаров, фид разбирается целиком в памяти")
+            self._parse_tree()
+
+    def _report_progress(self, stage: Optional[str] = None, **counters):
+        """Передача состояния загрузки в обратный вызов progress.
 
-        # Обрабатываем все категории
-        for category_id in self.all_categories:
-            if category_id not in self.processed_categories:
-                process_category(category_id)
+        Смена стадии передается сразу, остальные обновления - не чаще progress_interval.
+        """
+        if self.progress is None:
+            return
+        self._progress_state.update(counters)
+        now = time.monotonic()
+        if stage is not None:
+            self._progress_state['stage'] = stage
+        elif now - self._progress_reported_at < self.progress_interval:
+            return
+        self._progress_reported_at = now
 
-    def parse(self):
-        """Парсинг XML-фида"""
+        if self._feed_file is not None and not self._feed_file.closed:
+            self._progress_state['bytes_read'] = self._feed_file.tell()
+        self._progress_state['elapsed'] = now - self._started_at
+        try:
+            self.progress(dict(self._progress_state))
+        except Exception as e:
+            self.logger.error(f"Ошибка при передаче прогресса загрузки: {str(e)}")
+
+    def parse(self) -> Dict:
+        """Парсинг XML-фида, возвращает итоги загрузки"""
         self.logger.info("Начинаем парсинг XML...")
         start_time = time.time()
+        self._started_at = time.monotonic()
+        self._progress_state = {
+            'processed': 0,
+            'errors': 0,
+            'skipped': 0,
+            'bytes_read': 0,
+            'bytes_total': os.path.getsize(self.xml_file) if os.path.exists(self.xml_file) else None
+        }
+        self._report_progress('categories')
         
         try:
-            tree = ET.parse(self.xml_file)
-            root = tree.getroot()
-            shop = root.find('shop')
-            
-            if shop is None:
-                raise ValueError("Не найден элемент shop в XML")
-            
-            categories = shop.find('categories')
-            offers = shop.find('offers')
-            
-            if categories is None:
-                raise ValueError("Не найден элемент categories в XML")
-            if offers is None:
-                raise ValueError("Не найден элемент offers в XML")
-            
-            # Собираем все категории
-            self.all_categories = self._collect_all_categories(categories)
-            self.logger.info(f"Найдено {len(self.all_categories)} категорий")
-            
-            # Обрабатываем категории
-            self._process_categories()
-            self.logger.info(f"Обработано {len(self.processed_categories)} категорий")
-            
-            # Обрабатываем товары
-            self._process_products(offers)
+            if self.bulk:
+                self.loader = self.db.bulk_loader(
+                    delta=self.delta,
+                    versioned=self.versioned,
+                    keep_versions=self.keep_versions
+                )
+                try:
+                    with self.loader:
+                        if self.writers:
+                            self.pipeline = IngestPipeline(self.loader, self.writers)
+                            with self.pipeline:
+                                self._parse_feed()
+                            self.summary['pipeline'] = self.pipeline.stats()
+                        else:
+                            self._parse_feed()
+                        self._report_progress('merge')
+                    self.summary.update(self.loader.summary)
+                finally:
+                    self.loader = None
+                    self.pipeline = None
+            else:
+                self._parse_feed()
+                self._report_progress('merge')
+                self.db.refresh_derived_data()
             
             end_time = time.time()
             self.logger.info(f"Парсинг завершен за {end_time - start_time:.2f} секунд")
+            self._report_progress('done', bytes_read=self._progress_state['bytes_total'])
+            return self.summary
         
         except ET.ParseError as e:
             self.logger.error(f"Ошибка при парсинге XML файла: {str(e)}")
@@ -147,120 +355,315 @@ class FeedParser:
             self.logger.error(f"Неожиданная ошибка при парсинге: {str(e)}")
             raise
 
-    def _process_products(self, offers_element):
+    def _process_products(self, offers):
         """Обработка товаров"""
-        if offers_element is None:
-            return
-        
+        self._store_products(
+            _normalize_result(offer, self.category_ancestors, self.processed_products) for offer in offers
+        )
+
+    def _process_products_parallel(self):
+        """Обработка товаров в пуле процессов.
+
+        Раздел <offers> нарезается на фрагменты из целых <offer>, фрагменты
+        разбираются и нормализуются в процессах пула. Результаты принимаются
+        в исходном порядке, поэтому дедупликация и счетчики совпадают
+        с последовательной обработкой.
+        """
+        # Категории читаются потоково, чтение останавливается на <offers>
+        for _ in self._iter_offers(categories_only=True):
+            pass
+        encoding = self._detect_encoding()
+
+        # Загрузка идет в потоке многопоточного воркера с открытыми соединениями и
+        # блокировками логирования, поэтому процессы пула не форкаются от него,
+        # а запускаются чистыми
+        executor = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context(_POOL_START_METHOD),
+            initializer=_init_normalize_worker,
+            initargs=(self.category_ancestors,)
+        )
+
+        def results():
+            pending = deque()
+            for chunk in self._iter_offer_chunks():
+                pending.append(executor.submit(_normalize_chunk, chunk, encoding))
+                # Ограничиваем число фрагментов в работе, чтобы не читать весь файл в память
+                if len(pending) >= self.processes * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+        try:
+            self._store_products(results())
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _detect_encoding(self) -> str:
+        """Кодировка из XML-декларации фида"""
+        with open(self.xml_file, 'rb') as f:
+            match = _ENCODING_RE.search(f.read(256))
+        return match.group(1).decode('ascii') if match else 'utf-8'
+
+    def _iter_offer_chunks(self):
+        """Нарезка содержимого <offers> на фрагменты, содержащие целые <offer>.
+
+        Фрагмент режется перед открывающим тегом <offer> (в том числе
+        самозакрытым), так что все, что до него, - целые товары. Комментарии,
+        CDATA и инструкции обработки пропускаются целиком: теги внутри них
+        не считаются. Фрагмент без единой границы длиннее _MAX_CHUNK_BLOCKS
+        блоков (незакрытый комментарий или CDATA) - ошибка фида.
+        """
+        chunk_size = self.chunk_size
+        with open(self.xml_file, 'rb') as f:
+            self._feed_file = f
+            buffer = b''
+            # Позиция разбора, начало текущего фрагмента (None - до <offers>)
+            position = 0
+            chunk_start = None
+            while True:
+                match = _CHUNK_TOKEN_RE.search(buffer, position)
+                token = match.group(1) if match else None
+                if token in _SKIPPED_SECTIONS:
+                    end = buffer.find(_SKIPPED_SECTIONS[token], match.end())
+                    if end != -1:
+                        position = end + len(_SKIPPED_SECTIONS[token])
+                        continue
+                    position = match.start()
+                elif token == b'<offers' and chunk_start is None:
+                    opening = _OFFERS_OPEN_RE.match(buffer, match.start())
+                    if opening:
+                        if opening.group(1):
+                            return  # <offers/>
+                        position = chunk_start = opening.end()
+                        continue
+                    position = match.start()
+                elif token == b'<offer' and chunk_start is not None:
+                    if match.start() - chunk_start >= chunk_size:
+                        yield buffer[chunk_start:match.start()]
+                        chunk_start = match.start()
+                    position = match.end()
+                    continue
+                elif token == b'</offers' and chunk_start is not None:
+                    if buffer[chunk_start:match.start()].strip():
+                        yield buffer[chunk_start:match.start()]
+                    return
+                elif match:
+                    position = match.end()
+                    continue
+                else:
+                    # Хвост сохраняем на случай, если тег разрезан границей блока
+                    position = max(position, len(buffer) - 64)
+
+                # Нужны следующие данные: уже разобранное начало буфера больше не нужно
+                keep = position if chunk_start is None else chunk_start
+                buffer = buffer[keep:]
+                position -= keep
+                if chunk_start is not None:
+                    chunk_start = 0
+                    if len(buffer) > chunk_size * _MAX_CHUNK_BLOCKS:
+                        raise ValueError("Не удалось разбить offers на фрагменты: не закрыт комментарий, "
+                                         "CDATA или товар слишком большой")
+                block = f.read(chunk_size)
+                if not block:
+                    if chunk_start is None:
+                        raise ValueError("Не найден элемент offers в XML")
+                    raise ValueError("Не закрыт элемент offers в XML")
+                buffer += block
+
+    def _store_products(self, results):
+        """Запись нормализованных товаров и подсчет итогов.
+
+        results - последовательность (product_id, product, failed), см. _normalize_result.
+        """
         processed_count = 0
         error_count = 0
         skipped_count = 0
+        writer = self.pipeline or self.loader or self.db
         
-        for offer in offers_element.findall('offer'):
-            try:
-                product_id = offer.get('id')
-                if not product_id:
-                    self.logger.warning("Пропущен товар без ID")
-                    skipped_count += 1
-                    continue
-                
-                if product_id in self.processed_products:
-                    continue
-                
-                # Получаем основные данные товара
-                article = offer.find('vendorCode')
-                article = article.text if article is not None else product_id
-                
-                name = offer.find('name')
-                if name is None or not name.text:
-                    self.logger.warning(f"Пропускаем товар {product_id}: отсутствует название")
-                    skipped_count += 1
-                    continue
-                name = name.text.strip()
-                
-                price = offer.find('price')
-                if price is None or not price.text:
-                    self.logger.warning(f"Пропускаем товар {product_id}: отсутствует цена")
-                    skipped_count += 1
-                    continue
-                try:
-                    price = float(price.text)
-                except (ValueError, TypeError):
-                    self.logger.warning(f"Пропускаем товар {product_id}: некорректная цена")
-                    skipped_count += 1
-                    continue
-                
-                url = offer.find('url')
-                url = url.text.strip() if url is not None and url.text else None
-                
-                picture = offer.find('picture')
-                picture = picture.text.strip() if picture is not None and picture.text else None
-                
-                # Получаем категории товара
-                category_ids = set()  # Используем set для уникальных категорий
-                
-                # Проверяем оба варианта указания категорий
-                # Вариант 1: категории внутри тега categories
-                categories_element = offer.find('categories')
-                if categories_element is not None:
-                    for category in categories_element.findall('categoryId'):
-                        try:
-                            category_id = int(category.text)
-                            if category_id in self.all_categories:
-                                category_ids.add(category_id)
-                        except (ValueError, TypeError):
-                            continue
-                
-                # Вариант 2: categoryId напрямую в offer
-                category = offer.find('categoryId')
-                if category is not None and category.text:
-                    try:
-                        category_id = int(category.text)
-                        if category_id in self.all_categories:
-                            category_ids.add(category_id)
-                    except (ValueError, TypeError):
-                        pass
-                
-                # Добавляем родительские категории
-                parent_categories = set()
-                for category_id in category_ids.copy():
-                    current_id = category_id
-                    while current_id is not None:
-                        category = self.all_categories.get(current_id)
-                        if category and category['parent_id']:
-                            parent_categories.add(category['parent_id'])
-                            current_id = category['parent_id']
-                        else:
-                            break
-                
-                # Объединяем прямые и родительские категории
-                category_ids.update(parent_categories)
-                
-                if not category_ids:
-                    self.logger.warning(f"Пропускаем товар {product_id}: нет действительных категорий")
-                    skipped_count += 1
-                    continue
-                
-                # Добавляем товар в базу
-                self.db.add_product(
-                    product_id=product_id,
-                    article=article,
-                    name=name,
-                    price=price,
-                    url=url,
-                    picture=picture,
-                    category_ids=list(category_ids)
-                )
-                
-                self.processed_products.add(product_id)
-                processed_count += 1
-                
-                if processed_count % 1000 == 0:
-                    self.logger.info(f"Обработано {processed_count} товаров (ошибок: {error_count}, пропущено: {skipped_count})")
+        for index, (product_id, product, failed) in enumerate(results, 1):
+            if self.progress is not None and index % 500 == 0:
+                self._report_progress(processed=processed_count, errors=error_count, skipped=skipped_count)
+            
+            if not product_id:
+                self.logger.warning("Пропущен товар без ID")
+                skipped_count += 1
+                continue
+            
+            if product_id in self.processed_products:
+                continue
+            
+            if failed:
+                error_count += 1
+                self._keep_rejected(product_id)
+                continue
             
+            if product is None:
+                skipped_count += 1
+                self._keep_rejected(product_id)
+                continue
+            
+            try:
+                # Добавляем товар в базу (или в буфер пакетной загрузки)
+                writer.add_product(**product)
+            except BulkLoadError:
+                raise
             except Exception as e:
                 error_count += 1
-                self.logger.error(f"Ошибка при обработке товара {offer.get('id')}: {str(e)}")
+                self.logger.error(f"Ошибка при обработке товара {product_id}: {str(e)}")
+                self._keep_rejected(product_id)
                 continue
+            
+            self.processed_products.add(product_id)
+            processed_count += 1
+            
+            if processed_count % 1000 == 0:
+                self.logger.info(f"Обработано {processed_count} товаров (ошибок: {error_count}, пропущено: {skipped_count})")
         
-        self.logger.info(f"Обработка товаров завершена. Всего: {processed_count}, ошибок: {error_count}, пропущено: {skipped_count}") 
\ No newline at end of file
+        self.logger.info(f"Обработка товаров завершена. Всего: {processed_count}, ошибок: {error_count}, пропущено: {skipped_count}")
+        self.summary.update(processed=processed_count, errors=error_count, skipped=skipped_count)
+        self._report_progress(processed=processed_count, errors=error_count, skipped=skipped_count)
+
+    def _keep_rejected(self, product_id: str):
+        # Товар есть в фиде: дельта-загрузка не должна удалять его прежнюю версию
+        if self.loader is not None:
+            self.loader.keep_product(product_id)
+
+
+class _CategoriesAfterOffers(Exception):
+    """<offers> в фиде раньше <categories>: потоковый разбор невозможен"""
+
+
+_ENCODING_RE = re.compile(rb'<\?xml[^>]*encoding=["\']([A-Za-z0-9._-]+)["\']')
+_OFFERS_OPEN_RE = re.compile(rb'<offers(?:\s[^>]*?)?(/?)>')
+# Разметка, важная для нарезки фида: начала комментариев, CDATA и инструкций
+# обработки (пропускаются до конца) и теги offers и offer
+_CHUNK_TOKEN_RE = re.compile(rb'(<!--|<!\[CDATA\[|<\?|</offers|<offers|<offer)(?=[\s/>]|(?<=[-\[?]))')
+_SKIPPED_SECTIONS = {b'<!--': b'-->', b'<![CDATA[': b']]>', b'<?': b'?>'}
+_MAX_CHUNK_BLOCKS = 64
+_POOL_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+# Цены по модулю не меньше этой не помещаются в колонку products.price NUMERIC(10,2)
+_PRICE_LIMIT = 10 ** 8
+# id категорий - INTEGER в базе
+_CATEGORY_ID_LIMIT = 2 ** 31
+
+# Предки категорий в процессе пула нормализации
+_worker_category_ancestors: Dict[int, Tuple[int, ...]] = {}
+
+
+def normalize_offer(offer, product_id: str, category_ancestors: Dict[int, Tuple[int, ...]]) -> Optional[Dict]:
+    """Извлечение данных товара из <offer>.
+
+    Возвращает аргументы для add_product или None, если товар пропускается
+    (причина пишется в лог). category_ancestors - предки каждой известной категории.
+    Для данных, которые база не примет (бесконечная или слишком большая цена,
+    id категории вне диапазона INTEGER), бросает ValueError: товар считается ошибкой, как отказ базы при построчной
+    записи, и не прерывает пакетную загрузку.
+    """
+    logger = logging.getLogger(__name__)
+
+    # Получаем основные данные товара
+    article = offer.find('vendorCode')
+    article = article.text if article is not None and article.text else product_id
+    
+    name = offer.find('name')
+    if name is None or not name.text:
+        logger.warning(f"Пропускаем товар {product_id}: отсутствует название")
+        return None
+    name = name.text.strip()
+    
+    price = offer.find('price')
+    if price is None or not price.text:
+        logger.warning(f"Пропускаем товар {product_id}: отсутствует цена")
+        return None
+    try:
+        price_text = price.text.strip()
+        price = float(price_text)
+    except (ValueError, TypeError):
+        logger.warning(f"Пропускаем товар {product_id}: некорректная цена")
+        return None
+    if not math.isfinite(price) or abs(round(price, 2)) >= _PRICE_LIMIT:
+        raise ValueError(f"цена {price_text} вне допустимого диапазона")
+    
+    url = offer.find('url')
+    url = url.text.strip() if url is not None and url.text else None
+    
+    picture = offer.find('picture')
+    picture = picture.text.strip() if picture is not None and picture.text else None
+    
+    # Получаем категории товара
+    category_ids = set()  # Используем set для уникальных категорий
+    
+    # Проверяем оба варианта указания категорий
+    # Вариант 1: категории внутри тега categories
+    categories_element = offer.find('categories')
+    if categories_element is not None:
+        for category in categories_element.findall('categoryId'):
+            try:
+                category_id = int(category.text)
+            except (ValueError, TypeError):
+                continue
+            if _check_category_id(category_id) in category_ancestors:
+                category_ids.add(category_id)
+    
+    # Вариант 2: categoryId напрямую в offer
+    category = offer.find('categoryId')
+    if category is not None and category.text:
+        try:
+            category_id = int(category.text)
+        except (ValueError, TypeError):
+            category_id = None
+        if category_id is not None and _check_category_id(category_id) in category_ancestors:
+            category_ids.add(category_id)
+    
+    # Добавляем родительские категории
+    for category_id in list(category_ids):
+        category_ids.update(category_ancestors[category_id])
+    
+    if not category_ids:
+        logger.warning(f"Пропускаем товар {product_id}: нет действительных категорий")
+        return None
+    
+    return {
+        'product_id': product_id,
+        'article': article,
+        'name': name,
+        'price': price,
+        'url': url,
+        'picture': picture,
+        'category_ids': list(category_ids)
+    }
+
+
+def _check_category_id(category_id: int) -> int:
+    """id категории; ValueError, если он не помещается в INTEGER"""
+    if not -_CATEGORY_ID_LIMIT <= category_id < _CATEGORY_ID_LIMIT:
+        raise ValueError(f"id категории {category_id} вне допустимого диапазона")
+    return category_id
+
+
+def _normalize_result(offer, category_ancestors, processed_products=()) -> Tuple[Optional[str], Optional[Dict], bool]:
+    """Нормализация <offer> в кортеж (product_id, product, failed).
+
+    Товары без ID и уже обработанные не нормализуются: их отсеивает _store_products.
+    """
+    product_id = offer.get('id')
+    if not product_id or product_id in processed_products:
+        return product_id, None, False
+    try:
+        return product_id, normalize_offer(offer, product_id, category_ancestors), False
+    except Exception as e:
+        logging.getLogger(__name__).error(f"Ошибка при обработке товара {product_id}: {str(e)}")
+        return product_id, None, True
+
+
+def _init_normalize_worker(category_ancestors: Dict[int, Tuple[int, ...]]):
+    global _worker_category_ancestors
+    _worker_category_ancestors = category_ancestors
+
+
+def _normalize_chunk(chunk: bytes, encoding: str) -> List[Tuple[Optional[str], Optional[Dict], bool]]:
+    """Разбор и нормализация фрагмента раздела <offers> в процессе пула"""
+    document = b'<?xml version="1.0" encoding="' + encoding.encode('ascii') + b'"?><offers>' + chunk + b'</offers>'
+    root = ET.fromstring(document)
+    return [_normalize_result(offer, _worker_category_ancestors) for offer in root.iterfind('offer')]
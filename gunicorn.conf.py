@@ -0,0 +1,24 @@
+# Настройки gunicorn: gunicorn -c gunicorn.conf.py app:app
+# Схема базы данных обновляется до запуска отдельной командой flask --app app migrate
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5003')}"
+
+# Приложение импортируется один раз в мастере, воркеры получают его готовым через fork
+preload_app = True
+
+
+def when_ready(server):
+    # Версия схемы проверяется один раз в мастере, до запуска воркеров.
+    # Соединения мастера закрываются: воркеры открывают свои
+    if server.cfg.preload_app:
+        import app
+        if not app.init_database():
+            raise SystemExit('Не удалось инициализировать базу данных')
+        app.db.close()
+
+
+def post_worker_init(worker):
+    # Соединения пула открываются до первого запроса
+    import app
+    app.warm_up()
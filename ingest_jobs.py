@@ -0,0 +1,101 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional
+
+from database import CatalogDatabase
+
+
+class IngestJobManager:
+    """Фоновые задания загрузки фида.
+
+    Задание запускается в отдельном потоке воркера, а его состояние
+    хранится в таблице ingest_jobs, поэтому доступно из любого воркера.
+    Одновременно выполняется только одна загрузка: блокировка берется
+    в Postgres (advisory lock) до создания задания.
+    """
+
+    def __init__(self, db: CatalogDatabase, run: Callable[[Callable[[Dict], None]], Dict]):
+        self.db = db
+        # run(progress) выполняет загрузку и возвращает ее итоги
+        self.run = run
+        self.logger = logging.getLogger(__name__)
+
+    def start(self) -> int:
+        """Запуск загрузки в фоне; RuntimeError, если загрузка уже идет"""
+        lock_conn = self.db.acquire_ingest_lock()
+        if lock_conn is None:
+            raise RuntimeError('Обновление каталога уже выполняется')
+
+        try:
+            job_id = self.db.create_ingest_job()
+            thread = threading.Thread(
+                target=self._run_job,
+                args=(job_id, lock_conn),
+                name=f"ingest-job-{job_id}",
+                daemon=True
+            )
+            thread.start()
+        except Exception:
+            self.db.release_ingest_lock(lock_conn)
+            raise
+
+        self.logger.info(f"Запущено задание загрузки {job_id}")
+        return job_id
+
+    def get(self, job_id: int) -> Optional[Dict]:
+        """Состояние задания"""
+        return self.db.get_ingest_job(job_id)
+
+    def _run_job(self, job_id: int, lock_conn):
+        started_at = time.monotonic()
+        try:
+            summary = self.run(lambda progress: self._on_progress(job_id, progress))
+            self.db.update_ingest_job(
+                job_id,
+                status='succeeded',
+                stage='done',
+                summary={**summary, 'execution_time': round(time.monotonic() - started_at, 3)},
+                eta_seconds=0,
+                finished_at=datetime.now(timezone.utc)
+            )
+            self.logger.info(f"Задание загрузки {job_id} завершено")
+        except Exception as e:
+            self.logger.error(f"Задание загрузки {job_id} завершилось ошибкой: {str(e)}", exc_info=True)
+            try:
+                self.db.update_ingest_job(
+                    job_id,
+                    status='failed',
+                    error=str(e),
+                    finished_at=datetime.now(timezone.utc)
+                )
+            except Exception as update_error:
+                self.logger.error(f"Не удалось сохранить ошибку задания {job_id}: {str(update_error)}")
+        finally:
+            self.db.release_ingest_lock(lock_conn)
+
+    def _on_progress(self, job_id: int, progress: Dict):
+        """Сохранение прогресса загрузки со скоростью и оценкой оставшегося времени"""
+        elapsed = progress.get('elapsed') or 0
+        processed = progress.get('processed', 0)
+        bytes_read = progress.get('bytes_read')
+        bytes_total = progress.get('bytes_total')
+
+        offers_per_second = processed / elapsed if elapsed else None
+        eta_seconds = None
+        # Оценка по доле прочитанного файла: число товаров в фиде заранее неизвестно
+        if bytes_read and bytes_total and progress.get('stage') == 'products':
+            eta_seconds = elapsed * (bytes_total - bytes_read) / bytes_read
+
+        self.db.update_ingest_job(
+            job_id,
+            stage=progress.get('stage'),
+            processed=processed,
+            errors=progress.get('errors', 0),
+            skipped=progress.get('skipped', 0),
+            bytes_read=bytes_read,
+            bytes_total=bytes_total,
+            offers_per_second=round(offers_per_second, 1) if offers_per_second is not None else None,
+            eta_seconds=round(eta_seconds, 1) if eta_seconds is not None else None
+        )
@@ -0,0 +1,231 @@
+import logging
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+
+from database import CatalogBulkLoader, BulkLoadError
+
+
+class StageStats:
+    """Счетчики одной стадии конвейера"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.batches = 0
+        # Время полезной работы и время ожидания соседней стадии
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items: int = 0, batches: int = 0, busy: float = 0.0, wait: float = 0.0):
+        with self._lock:
+            self.items += items
+            self.batches += batches
+            self.busy_seconds += busy
+            self.wait_seconds += wait
+
+    def to_dict(self, elapsed: float) -> Dict:
+        return {
+            'items': self.items,
+            'batches': self.batches,
+            'busy_seconds': round(self.busy_seconds, 3),
+            'wait_seconds': round(self.wait_seconds, 3),
+            # Пропускная способность стадии, если бы она не ждала соседнюю
+            'items_per_second': round(self.items / self.busy_seconds, 1) if self.busy_seconds else 0,
+            'utilization': round(self.busy_seconds / elapsed, 3) if elapsed else 0
+        }
+
+
+class IngestPipeline:
+    """Конвейерная загрузка товаров: разбор фида и запись в БД идут параллельно.
+
+    Разбор фида (вызывающий поток) собирает нормализованные товары в пачки
+    фиксированного размера и кладет их в ограниченную очередь. Потоки-писатели,
+    каждый со своим соединением из пула, копируют пачки в staging-таблицы
+    загрузчика. Заполненная очередь тормозит разбор, ошибка писателя
+    пробрасывается в вызывающий поток как BulkLoadError.
+    """
+
+    def __init__(self, loader: CatalogBulkLoader, writers: int = 2, batch_size: int = 5000,
+                 queue_size: Optional[int] = None):
+        self.loader = loader
+        self.db = loader.db
+        self.writers = writers
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size or writers * 2)
+        self.parse_stats = StageStats('parse')
+        self.write_stats = StageStats('write')
+
+        self.logger = logging.getLogger(__name__)
+
+        self._batch: List[Dict] = []
+        self._threads: List[threading.Thread] = []
+        self._connections = []
+        self._error: Optional[BaseException] = None
+        self._stop = threading.Event()
+        self._started_at = None
+        self._last_put_at = None
+        self._elapsed = 0.0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def start(self):
+        """Запуск потоков-писателей"""
+        # Соединения берем заранее: каждый писатель держит свое соединение до конца загрузки
+        try:
+            for _ in range(self.writers):
+                self._connections.append(self.db.get_connection())
+        except Exception:
+            self._release_connections()
+            raise
+
+        for index, conn in enumerate(self._connections):
+            thread = threading.Thread(
+                target=self._write_loop,
+                args=(conn,),
+                name=f"ingest-writer-{index}",
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+        self._started_at = self._last_put_at = time.monotonic()
+        self.logger.info(f"Конвейерная загрузка: {self.writers} писателей, пачки по {self.batch_size} товаров")
+
+    def add_product(self, **product):
+        """Добавление нормализованного товара (аргументы как у CatalogDatabase.add_product)"""
+        self._batch.append(product)
+        if len(self._batch) >= self.batch_size:
+            self._put(self._batch)
+            self._batch = []
+
+    def close(self):
+        """Отправка остатка, ожидание писателей и проверка ошибок"""
+        try:
+            if self._batch:
+                self._put(self._batch)
+                self._batch = []
+            self._finish_parse_stage()
+            for _ in self._threads:
+                self._put(None)
+        except BaseException:
+            self.abort()
+            raise
+        self._join()
+        self._release_connections()
+        self._raise_if_failed()
+        self._elapsed = time.monotonic() - self._started_at
+        self.logger.info(f"Конвейерная загрузка завершена: {self.stats()}")
+
+    def abort(self):
+        """Остановка писателей без записи оставшихся пачек"""
+        self._stop.set()
+        self._batch = []
+        self._drain()
+        for _ in self._threads:
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                break
+        self._join()
+        self._release_connections()
+        if self._started_at is not None:
+            self._elapsed = time.monotonic() - self._started_at
+
+    def stats(self) -> Dict:
+        """Пропускная способность стадий; узкое место - стадия с большей utilization"""
+        elapsed = self._elapsed or (time.monotonic() - self._started_at if self._started_at else 0)
+        return {
+            'elapsed_seconds': round(elapsed, 3),
+            'writers': self.writers,
+            'parse': self.parse_stats.to_dict(elapsed),
+            # Время писателей суммируется по потокам, поэтому нормируем на их число
+            'write': self.write_stats.to_dict(elapsed * self.writers)
+        }
+
+    def _put(self, batch: Optional[List[Dict]]):
+        now = time.monotonic()
+        if batch is not None:
+            self.parse_stats.add(items=len(batch), batches=1, busy=now - self._last_put_at)
+
+        while True:
+            self._raise_if_failed()
+            try:
+                self.queue.put(batch, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+
+        self._last_put_at = time.monotonic()
+        self.parse_stats.add(wait=self._last_put_at - now)
+
+    def _finish_parse_stage(self):
+        self.parse_stats.add(busy=time.monotonic() - self._last_put_at)
+        self._last_put_at = time.monotonic()
+
+    def _write_loop(self, conn):
+        while not self._stop.is_set():
+            wait_started = time.monotonic()
+            batch = self.queue.get()
+            started = time.monotonic()
+            self.write_stats.add(wait=started - wait_started)
+            if batch is None or self._stop.is_set():
+                break
+            try:
+                self.loader.copy_batch(conn, batch)
+            except BaseException as e:
+                self._fail(e)
+                break
+            self.write_stats.add(items=len(batch), batches=1, busy=time.monotonic() - started)
+
+    def _fail(self, error: BaseException):
+        if self._error is None:
+            self._error = error
+            self.logger.error(f"Ошибка в потоке записи: {str(error)}")
+        self._stop.set()
+        # Освобождаем место в очереди, чтобы разбор не ждал вечно
+        self._drain()
+
+    def _drain(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def _join(self):
+        for thread in self._threads:
+            while thread.is_alive():
+                thread.join(timeout=0.5)
+                # Писатель мог остаться без стоп-сигнала, если очередь была переполнена
+                if thread.is_alive() and self._stop.is_set():
+                    try:
+                        self.queue.put_nowait(None)
+                    except queue.Full:
+                        self._drain()
+        self._threads = []
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            if isinstance(self._error, BulkLoadError):
+                raise self._error
+            raise BulkLoadError(f"Ошибка в потоке записи: {str(self._error)}") from self._error
+
+    def _release_connections(self):
+        for conn in self._connections:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            self.db.put_connection(conn)
+        self._connections = []
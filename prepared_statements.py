@@ -0,0 +1,141 @@
+import hashlib
+import itertools
+import logging
+import re
+import threading
+import time
+import weakref
+from typing import Dict, Sequence
+
+from psycopg2 import errors
+
+# Плейсхолдеры psycopg2 в тексте запроса; %% - экранированный знак процента
+_PLACEHOLDER = re.compile(r'%[s%]')
+
+
+class PreparedStatements:
+    """Серверные подготовленные запросы (PREPARE/EXECUTE) для горячих запросов чтения.
+
+    Запрос готовится один раз на соединение пула при первом выполнении и
+    дальше выполняется по имени, без повторного разбора и, когда Postgres
+    выбирает общий план, без повторного планирования. Имя запроса - метка
+    и хэш текста, так что варианты одного запроса (сортировки, фильтры)
+    готовятся отдельно, а статистика собирается по метке.
+
+    Postgres сам перепланирует подготовленный запрос после DDL и смены
+    схем при переключении версий каталога. invalidate() сбрасывает
+    подготовленные запросы всех соединений (DEALLOCATE ALL при следующем
+    использовании), чтобы выбор общего плана делался заново на данных
+    новой версии. Если изменился состав колонок результата, Postgres
+    отказывается выполнять старый запрос - тогда он готовится заново.
+
+    Запросы выполняются в начале транзакции чтения: при повторной
+    подготовке транзакция откатывается.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._generation = 0
+        # Соединение -> [поколение, имена подготовленных запросов]
+        self._connections = weakref.WeakKeyDictionary()
+        self._texts: Dict[str, str] = {}
+        self._stats: Dict[str, Dict] = {}
+        self._invalidations = 0
+
+    def execute(self, cur, label: str, sql: str, params: Sequence = (), prepare: bool = True):
+        """Выполнение запроса sql с плейсхолдерами %s как подготовленного.
+
+        prepare=False - обычное выполнение с учетом в статистике, для запросов,
+        план которых сильно зависит от параметров: общий план для них хуже
+        экономии на планировании.
+        """
+        started = time.perf_counter()
+        prepared = False
+        if not (self.enabled and prepare):
+            cur.execute(sql, params)
+        else:
+            name = f"{label}_{hashlib.sha1(sql.encode('utf-8')).hexdigest()[:12]}"
+            try:
+                prepared = self._prepare(cur, name, sql)
+                self._execute(cur, name, params)
+            except (errors.FeatureNotSupported, errors.InvalidSqlStatementName) as e:
+                # "cached plan must not change result type" после миграции или
+                # запрос, сброшенный в обход кэша (DISCARD ALL)
+                self.logger.warning(f"Подготовленный запрос {name} устарел, готовим заново: {str(e)}")
+                cur.connection.rollback()
+                self._reset(cur)
+                prepared = self._prepare(cur, name, sql)
+                self._execute(cur, name, params)
+        self._record(label, (time.perf_counter() - started) * 1000, prepared)
+
+    def invalidate(self):
+        """Сброс подготовленных запросов всех соединений при следующем использовании"""
+        with self._lock:
+            self._generation += 1
+            self._invalidations += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'invalidations': self._invalidations,
+                'statements': {
+                    label: {
+                        **stats,
+                        'total_ms': round(stats['total_ms'], 3),
+                        'avg_ms': round(stats['total_ms'] / stats['calls'], 3),
+                        'max_ms': round(stats['max_ms'], 3)
+                    }
+                    for label, stats in sorted(self._stats.items())
+                }
+            }
+
+    def _prepare(self, cur, name: str, sql: str) -> bool:
+        """Подготовка запроса на соединении курсора; False, если он уже готов"""
+        with self._lock:
+            state = self._connections.get(cur.connection)
+            if state is None:
+                state = self._connections[cur.connection] = [self._generation, set()]
+            stale = state[0] != self._generation
+        if stale:
+            state = self._reset(cur)
+        if name in state[1]:
+            return False
+        cur.execute(f'PREPARE {name} AS {self._text(name, sql)}')
+        state[1].add(name)
+        return True
+
+    def _execute(self, cur, name: str, params: Sequence):
+        if params:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        else:
+            cur.execute(f'EXECUTE {name}')
+
+    def _text(self, name: str, sql: str) -> str:
+        """Текст запроса с позиционными параметрами $1, $2, ..."""
+        text = self._texts.get(name)
+        if text is None:
+            numbers = itertools.count(1)
+            text = _PLACEHOLDER.sub(lambda m: '%' if m.group() == '%%' else f'${next(numbers)}', sql)
+            self._texts[name] = text
+        return text
+
+    def _reset(self, cur) -> list:
+        """Удаление всех подготовленных запросов соединения курсора"""
+        cur.execute('DEALLOCATE ALL')
+        with self._lock:
+            state = self._connections[cur.connection] = [self._generation, set()]
+        return state
+
+    def _record(self, label: str, elapsed_ms: float, prepared: bool):
+        with self._lock:
+            stats = self._stats.get(label)
+            if stats is None:
+                stats = self._stats[label] = {'calls': 0, 'prepares': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+            stats['calls'] += 1
+            stats['prepares'] += prepared
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
@@ -0,0 +1,160 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import urlencode
+
+from flask import Response, jsonify, request
+
+from database import CatalogDatabase
+
+
+class ResponseCache:
+    """Кэш ответов API, привязанный к версии каталога.
+
+    Ключ - путь и нормализованные параметры запроса, значение действительно
+    только для версии каталога, при которой оно получено. Версия меняется
+    в той же транзакции, что и данные каталога, поэтому после загрузки
+    фида или отката старые ответы больше не отдаются. Каждый запрос стоит
+    одного чтения номера версии; при совпадении If-None-Match клиент
+    получает 304 без обращения к данным.
+
+    Первый уровень - LRU в памяти воркера, ограниченный числом записей и
+    объемом. Второй, необязательный (shared=True), - таблица response_cache
+    в Postgres, общая для всех воркеров.
+    """
+
+    def __init__(self, db: CatalogDatabase, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024,
+                 shared: bool = False):
+        self.db = db
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.logger = logging.getLogger(__name__)
+
+        self._entries: 'OrderedDict[str, Tuple[int, bytes]]' = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._seen_version = None
+        self._stats = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'not_modified': 0}
+
+    def respond(self, produce: Callable[[], object]):
+        """Ответ на текущий запрос из кэша или через produce().
+
+        produce возвращает данные для JSON-ответа. Готовый ответ Flask
+        (например, ошибку) produce может вернуть как есть - он не кэшируется.
+        """
+        version = self.db.get_live_version()
+        self._on_version(version)
+        key = self._key()
+        # Тело ответа однозначно определяется ключом и версией каталога,
+        # поэтому ETag строгий и считается без самого тела
+        etag = f"{version}-{hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]}"
+
+        if request.if_none_match.contains(etag):
+            self._count('not_modified')
+            return self._response(b'', etag, status=304)
+
+        body = self._get(key, version)
+        if body is not None:
+            self._count('hits')
+            return self._response(body, etag)
+
+        if self.shared:
+            body = self._get_shared(key, version)
+            if body is not None:
+                self._count('shared_hits')
+                self._put(key, version, body)
+                return self._response(body, etag)
+
+        self._count('misses')
+        result = produce()
+        if isinstance(result, (Response, tuple)):
+            return result
+        body = jsonify(result).get_data()
+
+        # Если версия сменилась, пока считался ответ, он мог прочитать уже новые данные
+        if self.db.get_live_version() == version:
+            self._put(key, version, body)
+            if self.shared:
+                self._put_shared(key, version, body)
+        return self._response(body, etag)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                **self._stats,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'version': self._seen_version
+            }
+
+    def _key(self) -> str:
+        # Параметры сортируются по имени, а повторы одного параметра сохраняют
+        # порядок: от него зависит ответ (например, порядок товаров в /api/products/batch)
+        args = [(name, value) for name, values in sorted(request.args.lists()) for value in values]
+        return f"{request.path}?{urlencode(args)}"
+
+    def _response(self, body: bytes, etag: str, status: int = 200) -> Response:
+        response = Response(body, status=status, mimetype='application/json')
+        response.set_etag(etag)
+        # Клиент может хранить ответ, но обязан сверить ETag перед использованием
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def _on_version(self, version: int):
+        with self._lock:
+            if self._seen_version == version:
+                return
+            previous = self._seen_version
+            self._seen_version = version
+            # Ответы прежних версий больше не нужны
+            self._entries.clear()
+            self._size = 0
+        self.logger.info(f"Версия каталога сменилась: {previous} -> {version}, кэш ответов очищен")
+        if self.shared:
+            try:
+                self.db.prune_cached_responses(version)
+            except Exception as e:
+                self.logger.error(f"Ошибка при очистке общего кэша ответов: {str(e)}")
+
+    def _get(self, key: str, version: int) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _put(self, key: str, version: int, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if version != self._seen_version:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[1])
+            self._entries[key] = (version, body)
+            self._size += len(body)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _get_shared(self, key: str, version: int) -> Optional[bytes]:
+        try:
+            return self.db.get_cached_response(key, version)
+        except Exception as e:
+            self.logger.error(f"Ошибка чтения общего кэша ответов: {str(e)}")
+            return None
+
+    def _put_shared(self, key: str, version: int, body: bytes):
+        try:
+            self.db.store_cached_response(key, version, body)
+        except Exception as e:
+            self.logger.error(f"Ошибка записи в общий кэш ответов: {str(e)}")
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
@@ -0,0 +1,433 @@
+import fcntl
+import heapq
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from database import CatalogDatabase, ARTICLE_QUERY, ARTICLE_PREFIX_MIN_LENGTH
+
+# Формат файла снимка: заголовок, таблица секций (смещение, длина), секции,
+# выровненные по 8 байт. Числа - в порядке байтов машины, собравшей снимок
+MAGIC = b'CFSI'
+FORMAT_VERSION = 2
+_HEADER = struct.Struct('=4sIII')
+_SECTION = struct.Struct('=QQ')
+
+# Строковые колонки таблицы товаров: смещения uint32 и общий буфер UTF-8.
+# extra - JSON [url, picture, category_paths], нужен только для выдачи
+TEXT_COLUMNS = ('id', 'article', 'name', 'extra')
+# id_rank, article_rank - место товара в порядке id и (article, id) по правилам
+# сортировки базы; article_order - строки в порядке байтов артикула
+SECTIONS = ('price', 'id_rank', 'article_rank', 'article_order') + tuple(
+    section for column in TEXT_COLUMNS for section in (f'{column}_offsets', column)
+)
+
+CURRENT_FILE = 'CURRENT'
+# Блокировка сборки снимка: одновременно собирает один процесс на машине
+BUILD_LOCK_FILE = 'build.lock'
+
+
+def snapshot_path(directory: str, version: int) -> str:
+    return os.path.join(directory, f'search-{version}.idx')
+
+
+def read_current_version(directory: str) -> Optional[int]:
+    """Версия каталога актуального снимка или None, если снимков еще нет"""
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+class _StringColumn:
+    def __init__(self):
+        self.offsets = array('I', [0])
+        self.data = bytearray()
+
+    def append(self, value: str):
+        self.data += value.encode('utf-8')
+        if len(self.data) > 0xFFFFFFFF:
+            raise ValueError('Колонка снимка поиска больше 4 ГБ')
+        self.offsets.append(len(self.data))
+
+
+def build_snapshot(db: CatalogDatabase, directory: str) -> int:
+    """Сборка снимка индекса поиска для живой версии каталога.
+
+    Снимок пишется во временный файл и переименовывается, затем файл CURRENT
+    переключается на новую версию - воркеры подхватывают ее сами. Снимок
+    версии неизменен, поэтому уже собранный (например, при откате) не
+    пересобирается. Возвращает номер версии.
+    """
+    os.makedirs(directory, exist_ok=True)
+    logger = logging.getLogger(__name__)
+    started = time.monotonic()
+
+    with db.search_documents() as (version, rows):
+        path = snapshot_path(directory, version)
+        if _has_current_format(path):
+            _write_current(directory, version)
+            return version
+
+        columns = {column: _StringColumn() for column in TEXT_COLUMNS}
+        prices = array('d')
+        id_ranks = array('I')
+        article_ranks = array('I')
+        articles = []
+        for product_id, article, name, price, url, picture, category_paths, id_rank, article_rank in rows:
+            columns['id'].append(product_id)
+            columns['article'].append(article)
+            columns['name'].append(name)
+            columns['extra'].append(json.dumps([url, picture, category_paths or []], ensure_ascii=False))
+            prices.append(float(price))
+            id_ranks.append(id_rank)
+            article_ranks.append(article_rank)
+            articles.append(article.encode('utf-8'))
+
+    count = len(articles)
+    # Порядок байтов UTF-8 совпадает с порядком символов, по нему ищем начало артикула
+    article_order = array('I', sorted(range(count), key=articles.__getitem__))
+
+    sections = {'price': prices, 'id_rank': id_ranks, 'article_rank': article_ranks,
+                'article_order': article_order}
+    for column, values in columns.items():
+        sections[f'{column}_offsets'] = values.offsets
+        sections[column] = values.data
+
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, version, count))
+        offset = _HEADER.size + _SECTION.size * len(SECTIONS)
+        layout = []
+        for name in SECTIONS:
+            offset += -offset % 8
+            length = len(memoryview(sections[name]).cast('B'))
+            layout.append((offset, length))
+            offset += length
+        for section in layout:
+            f.write(_SECTION.pack(*section))
+        for name, (offset, _) in zip(SECTIONS, layout):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(memoryview(sections[name]).cast('B'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    _write_current(directory, version)
+
+    logger.info(
+        f"Снимок поиска версии {version}: {count} товаров, "
+        f"{os.path.getsize(path) // 1024} КБ за {time.monotonic() - started:.1f} с"
+    )
+    return version
+
+
+def prune_snapshots(directory: str, keep: int):
+    """Удаление снимков сверх keep последних (актуальный не удаляется)"""
+    current = read_current_version(directory)
+    versions = []
+    for filename in os.listdir(directory):
+        match = re.fullmatch(r'search-(\d+)\.idx', filename)
+        if match:
+            versions.append(int(match.group(1)))
+    for version in sorted(versions, reverse=True)[max(keep, 1):]:
+        if version != current:
+            try:
+                # Воркеры, которые еще держат снимок в памяти, дочитают его из mmap
+                os.remove(snapshot_path(directory, version))
+            except OSError:
+                pass
+
+
+def _has_current_format(path: str) -> bool:
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER.size)
+    except OSError:
+        return False
+    return len(header) == _HEADER.size and _HEADER.unpack(header)[:2] == (MAGIC, FORMAT_VERSION)
+
+
+def _write_current(directory: str, version: int):
+    temp_path = os.path.join(directory, f'{CURRENT_FILE}.{os.getpid()}.tmp')
+    with open(temp_path, 'w') as f:
+        f.write(str(version))
+    os.replace(temp_path, os.path.join(directory, CURRENT_FILE))
+
+
+class SearchIndex:
+    """Снимок индекса поиска по артикулам и id, отображенный в память.
+
+    Снимок повторяет быстрый путь поиска в базе (CatalogDatabase.search_products)
+    для запросов-артикулов: товары с артикулом или id, равным запросу, в
+    порядке id, а если таких нет - товары с артикулом, начинающимся с
+    запроса, в порядке артикула. Порядок берется из рангов, посчитанных
+    базой при сборке, поэтому ответ совпадает с ответом базы. Полнотекстовый
+    поиск, похожие названия и постраничный вывод по релевантности остаются
+    за базой.
+
+    Товары хранятся по колонкам в порядке байтов id. Файл отображается через
+    mmap только на чтение, так что воркеры на одной машине делят страницы снимка.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+
+        magic, format_version, self.version, self.product_count = _HEADER.unpack_from(buffer)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f"Неизвестный формат снимка поиска: {path}")
+
+        sections = {}
+        for index, name in enumerate(SECTIONS):
+            offset, length = _SECTION.unpack_from(buffer, _HEADER.size + index * _SECTION.size)
+            sections[name] = buffer[offset:offset + length]
+
+        self._price = sections['price'].cast('d')
+        self._id_rank = sections['id_rank'].cast('I')
+        self._article_rank = sections['article_rank'].cast('I')
+        self._article_order = sections['article_order'].cast('I')
+        self._columns = {
+            column: (sections[f'{column}_offsets'].cast('I'), sections[column]) for column in TEXT_COLUMNS
+        }
+
+    def search(self, query: str, cursor: Optional[str] = None, per_page: int = 50,
+               min_price: Optional[float] = None, max_price: Optional[float] = None,
+               include_total: bool = False, max_candidates: Optional[int] = None) -> Optional[Dict]:
+        """Поиск по артикулу или id; ответ в формате CatalogDatabase.search_products.
+
+        None, если ответить должна база: запрос не похож на артикул, задан
+        курсор (он выдается только полнотекстовым поиском), совпадений нет
+        (база ищет по словам) или товаров с таким началом артикула больше
+        max_candidates.
+        """
+        if cursor or not ARTICLE_QUERY.match(query):
+            return None
+        key = query.encode('utf-8')
+
+        start, end = self._article_range(key, key + b'\0')
+        rows = set(self._article_order[start:end])
+        row = self._find_row(query)
+        if row < self.product_count and self._text('id', row) == query:
+            rows.add(row)
+        page = heapq.nsmallest(per_page, self._filter(rows, min_price, max_price), key=self._id_rank.__getitem__)
+
+        if not page and len(query) >= ARTICLE_PREFIX_MIN_LENGTH:
+            # 0xFF не встречается в UTF-8, поэтому все артикулы с этим началом меньше key + 0xFF
+            start, end = self._article_range(key, key + b'\xff')
+            if max_candidates is not None and end - start > max_candidates:
+                return None
+            rows = self._filter(self._article_order[start:end], min_price, max_price)
+            page = heapq.nsmallest(per_page, rows, key=self._article_rank.__getitem__)
+
+        if not page:
+            return None
+        result = {
+            'per_page': per_page,
+            'next_cursor': None,
+            'items': [self._item(row) for row in page]
+        }
+        if include_total:
+            result['total_count'] = len(page)
+        return result
+
+    def _filter(self, rows: Iterable[int], min_price: Optional[float], max_price: Optional[float]) -> List[int]:
+        return [
+            row for row in rows
+            if (min_price is None or self._price[row] >= min_price)
+            and (max_price is None or self._price[row] <= max_price)
+        ]
+
+    def _article_range(self, low_key: bytes, high_key: bytes) -> Tuple[int, int]:
+        """Диапазон article_order с артикулами от low_key (включительно) до high_key"""
+        return self._article_bound(low_key), self._article_bound(high_key)
+
+    def _article_bound(self, key: bytes) -> int:
+        low, high = 0, self.product_count
+        offsets, data = self._columns['article']
+        while low < high:
+            middle = (low + high) // 2
+            row = self._article_order[middle]
+            if data[offsets[row]:offsets[row + 1]].tobytes() < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _find_row(self, product_id: str) -> int:
+        """Первая строка с id не меньше product_id"""
+        key = product_id.encode('utf-8')
+        offsets, data = self._columns['id']
+        low, high = 0, self.product_count
+        while low < high:
+            middle = (low + high) // 2
+            if data[offsets[middle]:offsets[middle + 1]].tobytes() < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _text(self, column: str, row: int) -> str:
+        offsets, data = self._columns[column]
+        return str(data[offsets[row]:offsets[row + 1]], 'utf-8')
+
+    def _item(self, row: int) -> Dict:
+        url, picture, category_paths = json.loads(self._text('extra', row))
+        return {
+            'id': self._text('id', row),
+            'article': self._text('article', row),
+            'name': self._text('name', row),
+            'price': self._price[row],
+            'url': url,
+            'picture': picture,
+            'category_paths': category_paths
+        }
+
+
+class SearchIndexManager:
+    """Снимок поиска воркера с подменой на лету.
+
+    Не чаще раза в check_interval секунд сверяет файл CURRENT в каталоге
+    снимков и, если версия сменилась, открывает новый снимок. Запросы,
+    начатые на старом снимке, дочитывают его: память освобождается, когда
+    на снимок не остается ссылок.
+
+    Снимок отвечает, только если его версия совпадает с живой версией
+    каталога, иначе поиск идет через базу. Снимок живой версии собирает
+    загрузка фида или откат (publish). Если его нет совсем (первый запуск)
+    или он так и не появился за rebuild_delay секунд (сборка после загрузки
+    не удалась, каталог обновили на другой машине), воркер собирает его в
+    фоновом потоке. Запрос сборку не ждет, а сборки разных воркеров
+    исключают друг друга блокировкой файла в каталоге снимков.
+    """
+
+    def __init__(self, db: CatalogDatabase, directory: str, check_interval: float = 1.0,
+                 max_candidates: int = 20000, keep: int = 2, rebuild_delay: float = 60.0):
+        self.db = db
+        self.directory = directory
+        self.check_interval = check_interval
+        self.max_candidates = max_candidates
+        self.keep = keep
+        self.rebuild_delay = rebuild_delay
+        self.logger = logging.getLogger(__name__)
+
+        self._index: Optional[SearchIndex] = None
+        self._checked_at = None
+        # С какого момента снимок отстает от живой версии
+        self._stale_since = None
+        self._builder: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'searches': 0, 'fallbacks': 0, 'stale': 0, 'swaps': 0, 'rebuilds': 0}
+
+    def search(self, query: str, cursor: Optional[str] = None, per_page: int = 50,
+               min_price: Optional[float] = None, max_price: Optional[float] = None,
+               include_total: bool = False) -> Optional[Dict]:
+        """Поиск в текущем снимке; None - отвечать должна база"""
+        index = self.get(self.db.get_live_version())
+        result = None
+        if index is not None:
+            result = index.search(query, cursor, per_page, min_price, max_price, include_total,
+                                  self.max_candidates)
+        self._count('searches' if result is not None else 'fallbacks')
+        return result
+
+    def get(self, live_version: int) -> Optional[SearchIndex]:
+        """Снимок живой версии каталога или None, если его еще нет"""
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= self.check_interval:
+            # Проверяет один поток, остальные пока работают с текущим снимком
+            if self._lock.acquire(blocking=False):
+                try:
+                    self._checked_at = now
+                    self._refresh(live_version, now)
+                finally:
+                    self._lock.release()
+        index = self._index
+        if index is None or index.version != live_version:
+            if index is not None:
+                self._count('stale')
+            return None
+        return index
+
+    def publish(self, wait: bool = True):
+        """Сборка снимка живой версии каталога (после загрузки фида или отката).
+
+        wait=False - не ждать, если снимок уже собирает другой процесс;
+        тогда возвращает None.
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, BUILD_LOCK_FILE), 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    return None
+                # Снимок этой версии мог собрать процесс, державший блокировку
+                version = build_snapshot(self.db, self.directory)
+                prune_snapshots(self.directory, self.keep)
+        except Exception as e:
+            # Без снимка поиск продолжит работать через базу
+            self.logger.error(f"Ошибка при сборке снимка поиска: {str(e)}")
+            return None
+        self._checked_at = None
+        return version
+
+    def stats(self) -> Dict:
+        index = self._index
+        with self._stats_lock:
+            return {
+                **self._stats,
+                'version': index.version if index else None,
+                'products': index.product_count if index else 0
+            }
+
+    def _refresh(self, live_version: int, now: float):
+        version = read_current_version(self.directory)
+        if version is not None and (self._index is None or self._index.version != version):
+            self._open(version)
+        if self._index is not None and self._index.version == live_version:
+            self._stale_since = None
+        elif self._stale_since is None:
+            if self._index is None or self._index.version != version:
+                # Снимка еще нет (первый запуск) или его не удалось открыть (другой формат)
+                self._rebuild(now)
+            else:
+                # Снимок живой версии обычно собирает загрузивший ее воркер, ждем его
+                self._stale_since = now
+        elif now - self._stale_since >= self.rebuild_delay:
+            self.logger.warning(f"Снимок поиска версии {version} отстает от живой версии {live_version}, собираем заново")
+            self._rebuild(now)
+
+    def _open(self, version: int):
+        try:
+            index = SearchIndex(snapshot_path(self.directory, version))
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Не удалось открыть снимок поиска версии {version}: {str(e)}")
+            return
+        previous = self._index.version if self._index else None
+        self._index = index
+        self._count('swaps')
+        self.logger.info(f"Снимок поиска: версия {previous} -> {version}, {index.product_count} товаров")
+
+    def _rebuild(self, now: float):
+        # Неудачная сборка повторяется не раньше чем через rebuild_delay
+        self._stale_since = now
+        if self._builder is not None and self._builder.is_alive():
+            return
+        self._count('rebuilds')
+        self._builder = threading.Thread(target=self.publish, kwargs={'wait': False},
+                                         name='search-index-build', daemon=True)
+        self._builder.start()
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
@@ -0,0 +1,105 @@
+import functools
+import inspect
+import logging
+import threading
+from typing import Callable, Dict, Hashable
+
+
+class _Call:
+    """Выполняющийся вызов, результат которого ждут остальные"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Объединение одинаковых одновременных вызовов.
+
+    Первый вызов с данным ключом выполняется, остальные с тем же ключом
+    ждут его и получают тот же результат (или то же исключение). Если
+    ожидание дольше timeout секунд, вызов выполняется самостоятельно,
+    чтобы один зависший запрос не тянул за собой остальные. timeout <= 0
+    отключает объединение.
+    """
+
+    def __init__(self, timeout: float = 30.0):
+        self.timeout = timeout
+        self.logger = logging.getLogger(__name__)
+
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'executed': 0, 'coalesced': 0, 'timeouts': 0, 'max_waiters': 0}
+
+    def do(self, key: Hashable, fn: Callable[[], object]):
+        if self.timeout <= 0:
+            self._count('calls', 'executed')
+            return fn()
+
+        with self._lock:
+            self._stats['calls'] += 1
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                call.waiters += 1
+                self._stats['max_waiters'] = max(self._stats['max_waiters'], call.waiters)
+                leader = False
+
+        if not leader:
+            if call.done.wait(self.timeout):
+                self._count('coalesced')
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            self.logger.warning(f"Ожидание объединенного вызова {key!r} превысило {self.timeout} с")
+            self._count('timeouts', 'executed')
+            return fn()
+
+        self._count('executed')
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                **self._stats,
+                'in_flight': len(self._calls),
+                'timeout_seconds': self.timeout
+            }
+
+    def _count(self, *names: str):
+        with self._lock:
+            for name in names:
+                self._stats[name] += 1
+
+
+def coalesced(method):
+    """Объединение одинаковых одновременных вызовов метода чтения.
+
+    Объект должен хранить SingleFlight в атрибуте _flight. Ключ - имя метода
+    и аргументы с подставленными значениями по умолчанию, так что вызовы
+    get(1) и get(1, page=1) считаются одинаковыми. Результат общий для всех
+    ожидавших, поэтому изменять его вызывающим нельзя.
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        key = (method.__name__,) + tuple(bound.arguments.values())[1:]
+        return self._flight.do(key, lambda: method(self, *args, **kwargs))
+
+    return wrapper
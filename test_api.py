@@ -0,0 +1,167 @@
+import csv
+import gzip
+import io
+import json
+import logging
+import unittest
+from contextlib import contextmanager
+from unittest import mock
+
+import app as catalog_app
+
+logging.disable(logging.CRITICAL)
+
+PRODUCTS = [
+    {'id': str(i), 'article': f'A-{i}', 'name': f'Товар "{i}", сорт', 'price': i + 0.5,
+     'url': f'https://example.com/{i}', 'picture': None,
+     'category_paths': ['Корень > Подкатегория'] if i % 2 else []}
+    for i in range(1, 41)
+]
+
+
+class StubCatalog:
+    """CatalogDatabase без базы: каталог версии version из PRODUCTS"""
+
+    def __init__(self, version=7):
+        self.version = version
+        self.exports = []
+        self.batches = []
+
+    def begin_request(self):
+        pass
+
+    def end_request(self):
+        pass
+
+    def get_live_version(self):
+        return self.version
+
+    @contextmanager
+    def export_products(self, category_id=None, batch_size=5000):
+        if category_id not in (None, 3):
+            raise ValueError(f"Категория {category_id} не найдена")
+        export = {'category_id': category_id, 'closed': False}
+        self.exports.append(export)
+        products = PRODUCTS if category_id is None else PRODUCTS[:3]
+        try:
+            yield self.version, (dict(product) for product in products)
+        finally:
+            export['closed'] = True
+
+    def get_products_by_ids(self, ids=(), articles=()):
+        self.batches.append((list(ids), list(articles)))
+        by_id = {product['id']: product for product in PRODUCTS}
+        found = [by_id[product_id] for product_id in ids if product_id in by_id]
+        found += [product for article in articles for product in PRODUCTS if product['article'] == article]
+        return {
+            'items': list({product['id']: product for product in found}.values()),
+            'missing_ids': [product_id for product_id in ids if product_id not in by_id],
+            'missing_articles': [article for article in articles
+                                 if not any(product['article'] == article for product in PRODUCTS)]
+        }
+
+
+class ApiTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = StubCatalog()
+        patcher = mock.patch.multiple(catalog_app, db=self.db, cache=None, search_index=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = catalog_app.app.test_client()
+
+
+class ExportApiTest(ApiTestCase):
+
+    def export(self, **params):
+        response = self.client.get('/api/export', query_string=params)
+        data = response.get_data()
+        response.close()
+        return response, data
+
+    def test_ndjson(self):
+        response, data = self.export()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(response.headers['X-Catalog-Version'], '7')
+        self.assertIn('filename="catalog-7.ndjson"', response.headers['Content-Disposition'])
+        self.assertEqual([json.loads(line) for line in data.decode('utf-8').splitlines()], PRODUCTS)
+        self.assertTrue(self.db.exports[0]['closed'])
+
+    def test_csv(self):
+        response, data = self.export(format='csv', category_id=3)
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertIn('filename="catalog-7-3.csv"', response.headers['Content-Disposition'])
+        rows = list(csv.reader(io.StringIO(data.decode('utf-8'))))
+        self.assertEqual(rows[0], list(catalog_app.EXPORT_CSV_COLUMNS))
+        self.assertEqual([row[0] for row in rows[1:]], ['1', '2', '3'])
+        self.assertEqual(rows[1][2], 'Товар "1", сорт')
+        self.assertEqual(json.loads(rows[1][6]), ['Корень > Подкатегория'])
+        self.assertEqual(rows[1][5], '')
+        self.assertEqual(self.db.exports[0]['category_id'], 3)
+
+    def test_gzip_matches_plain_output(self):
+        # Маленькие куски: сжатый поток собирается из нескольких частей
+        with mock.patch.object(catalog_app, 'EXPORT_CHUNK_BYTES', 256):
+            plain = self.export()[1]
+            for format_ in ('ndjson', 'csv'):
+                with self.subTest(format=format_):
+                    response, data = self.export(gzip=1, format=format_)
+                    self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                    self.assertEqual(response.headers['X-Catalog-Version'], '7')
+                    if format_ == 'ndjson':
+                        self.assertEqual(gzip.decompress(data), plain)
+                    else:
+                        self.assertEqual(gzip.decompress(data), self.export(format='csv')[1])
+
+    def test_errors(self):
+        self.assertEqual(self.export(format='xml')[0].status_code, 400)
+        self.assertEqual(self.export(category_id='abc')[0].status_code, 400)
+        response = self.export(category_id=5)[0]
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('5', response.get_json()['error'])
+
+
+class BatchApiTest(ApiTestCase):
+
+    def batch(self, query):
+        return self.client.get(f'/api/products/batch?{query}')
+
+    def test_repeated_parameters(self):
+        response = self.batch('id=2&id=1&id=&article=A-3&article=A-3%2CB')
+        self.assertEqual(response.status_code, 200)
+        # Запятая - часть значения, пустые значения отбрасываются
+        self.assertEqual(self.db.batches, [(['2', '1'], ['A-3', 'A-3,B'])])
+        result = response.get_json()
+        self.assertEqual([item['id'] for item in result['items']], ['2', '1', '3'])
+        self.assertEqual((result['missing_ids'], result['missing_articles']), ([], ['A-3,B']))
+
+    def test_missing_products(self):
+        result = self.batch('id=1&id=999&article=NO-SUCH').get_json()
+        self.assertEqual([item['id'] for item in result['items']], ['1'])
+        self.assertEqual((result['missing_ids'], result['missing_articles']), (['999'], ['NO-SUCH']))
+
+    def test_required_and_cap(self):
+        for query in ('', 'id=&article='):
+            with self.subTest(query=query):
+                response = self.batch(query)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.get_json()['error'], 'id or article required')
+
+        with mock.patch.object(catalog_app, 'BATCH_MAX_PRODUCTS', 3):
+            self.assertEqual(self.batch('id=1&id=2&article=A-3').status_code, 200)
+            response = self.batch('id=1&id=2&article=A-3&article=A-4')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()['error'], 'Too many products, max 3')
+        self.assertEqual(len(self.db.batches), 1)
+
+    def test_cached_per_parameter_order(self):
+        first = self.batch('id=1&id=2').get_json()
+        self.assertEqual(self.batch('id=1&id=2').get_json(), first)
+        reversed_order = self.batch('id=2&id=1').get_json()
+        self.assertEqual([item['id'] for item in reversed_order['items']], ['2', '1'])
+        self.assertEqual(len(self.db.batches), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
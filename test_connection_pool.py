@@ -0,0 +1,219 @@
+import logging
+import os
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+from connection_pool import ConnectionPool, PoolTimeout
+
+logging.disable(logging.CRITICAL)
+
+
+class FakeConnection:
+    """Соединение psycopg2 без сервера; сокет - открытый /dev/null"""
+
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.rollbacks = 0
+        self.queries = []
+        self.info = mock.Mock(transaction_status=extensions.TRANSACTION_STATUS_IDLE)
+        self._fd = os.open(os.devnull, os.O_RDWR)
+
+    def cursor(self):
+        connection = self
+
+        class Cursor:
+            def execute(self, query, params=None):
+                if connection.broken:
+                    raise psycopg2.OperationalError('server closed the connection unexpectedly')
+                connection.queries.append(query)
+
+            def close(self):
+                pass
+
+        return Cursor()
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.info.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if not self.closed:
+            self.closed = 1
+            os.close(self._fd)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+        patcher = mock.patch('connection_pool.psycopg2.connect', side_effect=self.connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self, **params):
+        conn = FakeConnection()
+        self.connections.append(conn)
+        self.addCleanup(conn.close)
+        return conn
+
+    def make_pool(self, **options):
+        pool = ConnectionPool({'dbname': 'test'}, **options)
+        self.addCleanup(pool.closeall)
+        return pool
+
+    def test_warm_opens_min_size(self):
+        pool = self.make_pool(min_size=2, max_size=4)
+        self.assertEqual(len(self.connections), 2)
+        stats = pool.stats()
+        self.assertEqual((stats['size'], stats['idle'], stats['in_use']), (2, 2, 0))
+
+    def test_timeout_when_exhausted(self):
+        pool = self.make_pool(min_size=0, max_size=2, timeout=0.05)
+        first, second = pool.getconn(), pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        self.assertEqual(pool.stats()['exhausted'], 1)
+
+        # Ожидающий получает возвращенное соединение
+        pool.timeout = 5
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            waiting = executor.submit(pool.getconn)
+            for _ in range(500):
+                if pool.stats()['waiting']:
+                    break
+                threading.Event().wait(0.01)
+            pool.putconn(second)
+            self.assertIs(waiting.result(5), second)
+        self.assertEqual((pool.stats()['waits'], len(self.connections)), (1, 2))
+        pool.putconn(first)
+
+    def test_returned_transaction_is_rolled_back(self):
+        pool = self.make_pool(min_size=0)
+        conn = pool.getconn()
+        conn.info.transaction_status = extensions.TRANSACTION_STATUS_INTRANS
+        pool.putconn(conn)
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertIs(pool.getconn(), conn)
+
+        conn.info.transaction_status = extensions.TRANSACTION_STATUS_UNKNOWN
+        pool.putconn(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_idle_connection_checked_after_check_idle(self):
+        pool = self.make_pool(min_size=1, check_idle=5.0)
+        conn = self.connections[0]
+        self.assertIs(pool.getconn(), conn)
+        pool.putconn(conn)
+        # Только что возвращенное соединение не проверяется
+        self.assertIs(pool.getconn(), conn)
+        self.assertEqual(conn.queries, [])
+        pool.putconn(conn)
+
+        pool._idle = [(conn, returned_at - 6) for conn, returned_at in pool._idle]
+        self.assertIs(pool.getconn(), conn)
+        self.assertEqual(conn.queries, ['SELECT 1'])
+        pool.putconn(conn)
+
+        conn.broken = True
+        pool._idle = [(conn, returned_at - 6) for conn, returned_at in pool._idle]
+        replacement = pool.getconn()
+        self.assertIsNot(replacement, conn)
+        self.assertTrue(conn.closed)
+        stats = pool.stats()
+        self.assertEqual((stats['broken'], stats['created'], stats['size']), (1, 2, 1))
+
+    def test_scope_prefers_previous_connection(self):
+        pool = self.make_pool(min_size=2)
+        pool.begin_scope()
+        try:
+            scoped = pool.getconn()
+            other = pool.getconn(scoped=False)
+            pool.putconn(scoped)
+            # Другое соединение возвращено позже и выдалось бы первым
+            pool.putconn(other)
+            self.assertIs(pool.getconn(), scoped)
+            self.assertEqual(pool.stats()['reused'], 1)
+        finally:
+            pool.end_scope()
+        self.assertIs(pool.getconn(), other)
+
+    def test_scope_takes_any_when_previous_is_busy(self):
+        pool = self.make_pool(min_size=2)
+        pool.begin_scope()
+        try:
+            scoped = pool.getconn()
+            pool.putconn(scoped)
+            busy = pool.getconn(scoped=False)
+            self.assertIs(busy, scoped)
+            self.assertIsNot(pool.getconn(), scoped)
+            self.assertEqual(pool.stats()['reused'], 0)
+        finally:
+            pool.end_scope()
+
+    def test_fork_detaches_inherited_connections(self):
+        pool = self.make_pool(min_size=2)
+        inherited_busy = pool.getconn()
+        inherited_idle = [conn for conn, _ in pool._idle]
+        descriptors = [conn.fileno() for conn in self.connections]
+
+        # Пул считает себя унаследованным, как в процессе после fork
+        pool._pid = -1
+        with mock.patch('connection_pool.os.dup2', wraps=os.dup2) as dup2:
+            conn = pool.getconn()
+            self.assertNotIn(conn, self.connections[:2])
+            self.assertTrue(all(idle.closed for idle in inherited_idle))
+            self.assertEqual([call.args[1] for call in dup2.call_args_list], [idle.fileno() for idle in inherited_idle])
+
+            pool.putconn(inherited_busy)
+            self.assertTrue(inherited_busy.closed)
+            self.assertEqual(dup2.call_count, 2)
+        self.assertEqual(set(call.args[1] for call in dup2.call_args_list), set(descriptors))
+
+        stats = pool.stats()
+        self.assertEqual((stats['forks'], stats['size'], stats['created']), (1, 1, 1))
+
+    def test_closeall(self):
+        pool = self.make_pool(min_size=2, timeout=5)
+        busy = pool.getconn()
+        idle = self.connections[0]
+        pool.closeall()
+        self.assertTrue(idle.closed)
+        self.assertFalse(busy.closed)
+        with self.assertRaises(PoolError):
+            pool.getconn()
+
+        # Занятое соединение закрывается при возврате, а не возвращается в пул
+        pool.putconn(busy)
+        self.assertTrue(busy.closed)
+        stats = pool.stats()
+        self.assertEqual((stats['size'], stats['idle']), (0, 0))
+
+    def test_closeall_wakes_waiters(self):
+        pool = self.make_pool(min_size=0, max_size=1, timeout=5)
+        busy = pool.getconn()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            waiting = executor.submit(pool.getconn)
+            for _ in range(500):
+                if pool.stats()['waiting']:
+                    break
+                threading.Event().wait(0.01)
+            pool.closeall()
+            with self.assertRaises(PoolError):
+                waiting.result(1)
+        pool.putconn(busy)
+        self.assertTrue(busy.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,234 @@
+import logging
+import os
+import tempfile
+import unittest
+import shutil
+import xml.etree.ElementTree as ET
+
+from database import CatalogDatabase
+from db_testing import requires_database, reset_database
+from feed_parser import FeedParser, normalize_offer, _normalize_result
+
+logging.disable(logging.CRITICAL)
+
+# Предки категорий: 2 - подкатегория 1
+CATEGORY_ANCESTORS = {1: (), 2: (1,)}
+
+
+def make_offer(xml: str):
+    return ET.fromstring(xml)
+
+
+class NormalizeOfferTest(unittest.TestCase):
+    """Проверка нормализации <offer>: плохие данные стоят одной строки, а не всей загрузки"""
+
+    def test_valid_offer(self):
+        offer = make_offer(
+            '<offer id="10"><vendorCode>A-10</vendorCode><name> Товар </name>'
+            '<price>99.90</price><categoryId>2</categoryId></offer>'
+        )
+        product = normalize_offer(offer, '10', CATEGORY_ANCESTORS)
+        self.assertEqual(product['article'], 'A-10')
+        self.assertEqual(product['name'], 'Товар')
+        self.assertEqual(product['price'], 99.9)
+        self.assertEqual(sorted(product['category_ids']), [1, 2])
+
+    def test_empty_vendor_code_falls_back_to_id(self):
+        for vendor_code in ('<vendorCode/>', '<vendorCode></vendorCode>', ''):
+            offer = make_offer(
+                f'<offer id="11">{vendor_code}<name>Товар</name><price>1</price><categoryId>1</categoryId></offer>'
+            )
+            self.assertEqual(normalize_offer(offer, '11', CATEGORY_ANCESTORS)['article'], '11')
+
+    def test_price_out_of_range_is_error(self):
+        for price in ('1e12', 'inf', '-inf', 'nan', '100000000', '-100000000', '99999999.999'):
+            offer = make_offer(
+                f'<offer id="12"><name>Товар</name><price>{price}</price><categoryId>1</categoryId></offer>'
+            )
+            with self.subTest(price=price):
+                with self.assertRaises(ValueError):
+                    normalize_offer(offer, '12', CATEGORY_ANCESTORS)
+                self.assertEqual(_normalize_result(offer, CATEGORY_ANCESTORS), ('12', None, True))
+
+    def test_price_at_limit_is_accepted(self):
+        offer = make_offer(
+            '<offer id="13"><name>Товар</name><price>99999999.99</price><categoryId>1</categoryId></offer>'
+        )
+        self.assertEqual(normalize_offer(offer, '13', CATEGORY_ANCESTORS)['price'], 99999999.99)
+
+    def test_category_id_out_of_range_is_error(self):
+        for categories in ('<categoryId>2147483648</categoryId>',
+                           '<categories><categoryId>1</categoryId><categoryId>-2147483649</categoryId></categories>'):
+            offer = make_offer(f'<offer id="15"><name>Товар</name><price>1</price>{categories}</offer>')
+            with self.subTest(categories=categories):
+                with self.assertRaises(ValueError):
+                    normalize_offer(offer, '15', CATEGORY_ANCESTORS)
+                self.assertEqual(_normalize_result(offer, CATEGORY_ANCESTORS), ('15', None, True))
+
+        offer = make_offer('<offer id="16"><name>Товар</name><price>1</price><categoryId>2147483647</categoryId>'
+                           '<categories><categoryId>x</categoryId><categoryId>2</categoryId></categories></offer>')
+        self.assertEqual(sorted(normalize_offer(offer, '16', CATEGORY_ANCESTORS)['category_ids']), [1, 2])
+
+    def test_out_of_range_categories_are_not_collected(self):
+        parser = FeedParser('feed.xml', RecordingCatalog(), bulk=False)
+        categories = parser._collect_all_categories(ET.fromstring(
+            '<categories><category id="1">Корень</category><category id="4294967296">Большой id</category>'
+            '<category id="3" parentId="2147483648">Большой родитель</category>'
+            '<category id="2147483647" parentId="1">Последний id</category></categories>'
+        ))
+        self.assertEqual(sorted(categories), [1, 2147483647])
+
+    def test_unparsable_price_is_skipped(self):
+        offer = make_offer('<offer id="14"><name>Товар</name><price>abc</price><categoryId>1</categoryId></offer>')
+        self.assertIsNone(normalize_offer(offer, '14', CATEGORY_ANCESTORS))
+        self.assertEqual(_normalize_result(offer, CATEGORY_ANCESTORS), ('14', None, False))
+
+
+# Фид с разметкой, на которой ломается наивная нарезка по </offer>: теги в
+# комментариях и CDATA, самозакрытые товары, повторы, товары без id и с ошибками
+FEED = """<?xml version="1.0" encoding="utf-8"?>
+<yml_catalog><shop>
+<!-- <offers> в комментарии до категорий -->
+<categories>
+<category id="1">Корень</category>
+<category id="2" parentId="1">Подкатегория</category>
+</categories>
+<offers>
+<offer id="1"><name><![CDATA[Товар </offer><offer id="99"> в CDATA]]></name><price>10</price><categoryId>2</categoryId></offer>
+<!-- <offer id="98"><name>Закомментирован</name></offer> -->
+<offer id="2"/>
+<offer id="3" available="true"><vendorCode/><name>Пустой артикул</name><price>5.5</price><categoryId>1</categoryId></offer>
+<?processing </offer> ?>
+<offer id="4"><name>Большая цена</name><price>1e12</price><categoryId>1</categoryId></offer>
+<offer><name>Без id</name><price>1</price><categoryId>1</categoryId></offer>
+<offer id="1"><name>Повтор</name><price>1</price><categoryId>1</categoryId></offer>
+""" + "".join(
+    f'<offer id="{i}"><vendorCode>A-{i}</vendorCode><name>Товар {i}</name><price>{i}.5</price>'
+    f'<categories><categoryId>{1 + i % 2}</categoryId></categories></offer>\n'
+    for i in range(10, 60)
+) + """</offers>
+</shop></yml_catalog>
+"""
+
+
+class RecordingCatalog:
+    """Запись вызовов построчной загрузки вместо базы"""
+
+    def __init__(self):
+        self.categories = []
+        self.products = []
+
+    def add_categories(self, categories):
+        self.categories.extend(categories)
+
+    def add_product(self, **product):
+        self.products.append({**product, 'category_ids': sorted(product['category_ids'])})
+
+    def refresh_derived_data(self):
+        pass
+
+
+class FeedModesTest(unittest.TestCase):
+    """Разбор в памяти, потоковый и в пуле процессов дают одинаковый результат"""
+
+    @classmethod
+    def setUpClass(cls):
+        handle, cls.path = tempfile.mkstemp(suffix='.xml')
+        with os.fdopen(handle, 'w', encoding='utf-8') as f:
+            f.write(FEED)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.path)
+
+    def parse(self, **options):
+        catalog = RecordingCatalog()
+        summary = FeedParser(self.path, catalog, bulk=False, **options).parse()
+        return catalog, summary
+
+    def test_modes_are_identical(self):
+        expected_catalog, expected_summary = self.parse(streaming=False)
+        self.assertEqual(expected_summary, {'processed': 52, 'errors': 1, 'skipped': 2})
+        self.assertEqual([product['product_id'] for product in expected_catalog.products][:2], ['1', '3'])
+        self.assertIn('</offer><offer id="99">', expected_catalog.products[0]['name'])
+
+        for options in ({'streaming': True}, {'processes': 2, 'chunk_size': 64}, {'processes': 3, 'chunk_size': 4096}):
+            with self.subTest(**options):
+                catalog, summary = self.parse(**options)
+                self.assertEqual(summary, expected_summary)
+                self.assertEqual(catalog.categories, expected_catalog.categories)
+                self.assertEqual(catalog.products, expected_catalog.products)
+
+    def test_categories_after_offers(self):
+        expected_catalog, expected_summary = self.parse(streaming=False)
+        categories = FEED[FEED.index('<categories>'):FEED.index('</categories>') + len('</categories>')]
+        reordered = FEED.replace(categories, '').replace('</offers>', '</offers>\n' + categories)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(reordered)
+        try:
+            for options in ({'streaming': True}, {'processes': 2, 'chunk_size': 64}):
+                with self.subTest(**options):
+                    catalog, summary = self.parse(**options)
+                    self.assertEqual(summary, expected_summary)
+                    self.assertEqual(catalog.categories, expected_catalog.categories)
+                    self.assertEqual(catalog.products, expected_catalog.products)
+        finally:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.write(FEED)
+
+    def test_offer_chunks_split_before_offers(self):
+        parser = FeedParser(self.path, RecordingCatalog(), bulk=False, chunk_size=64)
+        chunks = list(parser._iter_offer_chunks())
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            ET.fromstring(b'<offers>' + chunk + b'</offers>')
+        self.assertTrue(all(chunk.lstrip().startswith((b'<offer', b'<!--', b'<?')) for chunk in chunks))
+
+
+@requires_database
+class DeltaSweepTest(unittest.TestCase):
+    """Дельта-загрузка удаляет товары, которых нет в фиде, но не отклоненные при разборе"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db = CatalogDatabase(migrate=True, **reset_database())
+        cls.directory = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.directory)
+
+    def load(self, prices, **options):
+        path = os.path.join(self.directory, 'feed.xml')
+        offers = ''.join(
+            f'<offer id="{product_id}"><name>Товар {product_id}</name><price>{price}</price>'
+            f'<categoryId>1</categoryId></offer>'
+            for product_id, price in prices.items()
+        )
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(
+                '<?xml version="1.0" encoding="utf-8"?><yml_catalog><shop>'
+                '<categories><category id="1">Корень</category></categories>'
+                f'<offers>{offers}</offers></shop></yml_catalog>'
+            )
+        return FeedParser(path, self.db, delta=True, **options).parse()
+
+    def test_rejected_offers_are_kept(self):
+        for options in ({}, {'versioned': True}):
+            with self.subTest(**options):
+                self.load({'1': '10', '2': '20', '3': '30', '4': '40'}, **options)
+                # 2 - ошибка (цена вне диапазона), 3 - пропущен (цена не число), 4 - исчез из фида
+                summary = self.load({'1': '11', '2': '1e12', '3': 'abc'}, **options)
+                self.assertEqual((summary['errors'], summary['skipped'], summary['deleted']), (1, 1, 1))
+
+                result = self.db.get_products_by_ids(['1', '2', '3', '4'], [])
+                self.assertEqual({item['id']: item['price'] for item in result['items']},
+                                 {'1': 11.0, '2': 20.0, '3': 30.0})
+                self.assertEqual(result['missing_ids'], ['4'])
+                # Отклоненные товары сохраняют и связи с категориями
+                self.assertTrue(all(item['category_paths'] for item in result['items']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+import unittest
+from unittest import mock
+
+import app as catalog_app
+from database import CatalogDatabase
+from db_testing import requires_database, reset_database
+from ingest_jobs import IngestJobManager
+
+logging.disable(logging.CRITICAL)
+
+
+class IngestJobStartTest(unittest.TestCase):
+    """Порядок захвата блокировки и создания задания, без базы"""
+
+    def setUp(self):
+        self.db = mock.Mock()
+        self.db.create_ingest_job.return_value = 1
+        self.finished = threading.Event()
+        self.manager = IngestJobManager(self.db, lambda progress: self.finished.set() or {})
+
+    def test_lock_taken_before_job_row(self):
+        self.assertEqual(self.manager.start(), 1)
+        self.assertTrue(self.finished.wait(5))
+        calls = [name for name, _, _ in self.db.method_calls]
+        self.assertEqual(calls[:2], ['acquire_ingest_lock', 'create_ingest_job'])
+
+    def test_busy_lock_creates_no_job(self):
+        self.db.acquire_ingest_lock.return_value = None
+        with self.assertRaises(RuntimeError):
+            self.manager.start()
+        self.db.create_ingest_job.assert_not_called()
+
+    def test_lock_released_when_job_row_fails(self):
+        self.db.create_ingest_job.side_effect = RuntimeError('нет базы')
+        with self.assertRaises(RuntimeError):
+            self.manager.start()
+        self.db.release_ingest_lock.assert_called_once_with(self.db.acquire_ingest_lock.return_value)
+
+
+@requires_database
+class IngestJobDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        params = reset_database()
+        with mock.patch.object(CatalogDatabase, '_check_schema'):
+            self.db = CatalogDatabase(**params)
+        self.addCleanup(self.db.close)
+        self.db.migrate()
+
+        # Загрузка ждет разрешения, чтобы задание можно было застать выполняющимся
+        self.proceed = threading.Event()
+        self.manager = IngestJobManager(self.db, self.load_feed)
+
+    def load_feed(self, progress):
+        progress({'stage': 'products', 'elapsed': 2, 'processed': 10, 'bytes_read': 25, 'bytes_total': 100})
+        self.proceed.wait(5)
+        return {'products': 10}
+
+    def lock_free(self):
+        conn = self.db.acquire_ingest_lock()
+        if conn is None:
+            return False
+        self.db.release_ingest_lock(conn)
+        return True
+
+    def wait_finished(self, job_id):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            job = self.manager.get(job_id)
+            if job['status'] != 'running' and self.lock_free():
+                return job
+            time.sleep(0.02)
+        self.fail(f"Задание {job_id} не завершилось")
+
+    def wait_stage(self, job_id, stage):
+        deadline = time.monotonic() + 5
+        while self.manager.get(job_id)['stage'] != stage:
+            if time.monotonic() > deadline:
+                self.fail(f"Задание {job_id} не дошло до стадии {stage}")
+            time.sleep(0.02)
+
+    def test_single_running_job(self):
+        job_id = self.manager.start()
+        with self.assertRaises(RuntimeError):
+            self.manager.start()
+
+        job = self.manager.get(job_id)
+        self.assertEqual(job['status'], 'running')
+
+        self.proceed.set()
+        job = self.wait_finished(job_id)
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual(job['summary']['products'], 10)
+        # Блокировка снята: следующая загрузка запускается
+        self.wait_finished(self.manager.start())
+
+    def test_stale_lock_recovery(self):
+        # Процесс загрузки умер: задание осталось running, соединение с блокировкой закрыто
+        lock_conn = self.db.acquire_ingest_lock()
+        job_id = self.db.create_ingest_job()
+        self.assertEqual(self.manager.get(job_id)['status'], 'running')
+        self.db._pool.putconn(lock_conn, close=True)
+
+        job = self.manager.get(job_id)
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['error'], 'Процесс загрузки был прерван')
+
+        self.proceed.set()
+        self.assertEqual(self.wait_finished(self.manager.start())['status'], 'succeeded')
+
+    def test_update_route_and_job_status(self):
+        patcher = mock.patch.multiple(
+            catalog_app, db=self.db, jobs=self.manager, cache=None, search_index=None, XML_FILE=__file__
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        env = mock.patch.dict('os.environ', {'AUTH_USERNAME': 'admin', 'AUTH_PASSWORD': 'password'})
+        env.start()
+        self.addCleanup(env.stop)
+        client = catalog_app.app.test_client()
+        auth = ('admin', 'password')
+
+        response = client.get('/update', auth=auth)
+        self.assertEqual(response.status_code, 202)
+        started = response.get_json()
+        self.assertEqual(started['status_url'], f"/api/jobs/{started['job_id']}")
+        self.assertEqual(client.get('/update', auth=auth).status_code, 409)
+
+        # Прогресс записывает поток задания
+        self.wait_stage(started['job_id'], 'products')
+        job = client.get(started['status_url']).get_json()
+        self.assertEqual((job['status'], job['stage'], job['processed']), ('running', 'products', 10))
+        self.assertEqual(job['offers_per_second'], 5.0)
+        self.assertEqual(job['eta_seconds'], 6.0)
+
+        self.proceed.set()
+        self.wait_finished(started['job_id'])
+        job = client.get(started['status_url']).get_json()
+        self.assertEqual((job['status'], job['stage']), ('succeeded', 'done'))
+        self.assertEqual(client.get('/api/jobs/999999').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import logging
+import unittest
+from unittest import mock
+
+import psycopg2
+
+from database import CatalogDatabase, MIGRATIONS, SCHEMA_VERSION
+from db_testing import requires_database, reset_database
+
+logging.disable(logging.CRITICAL)
+
+# Схема до появления версий схемы: таблицы каталога в public
+LEGACY_SCHEMA = '''
+    CREATE TABLE categories (
+        id INTEGER PRIMARY KEY,
+        parent_id INTEGER REFERENCES categories(id),
+        name TEXT NOT NULL
+    );
+    CREATE TABLE products (
+        id TEXT PRIMARY KEY,
+        article TEXT NOT NULL,
+        name TEXT NOT NULL,
+        price NUMERIC(10,2) NOT NULL,
+        url TEXT,
+        picture TEXT,
+        has_categories BOOLEAN DEFAULT FALSE,
+        search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('russian', coalesce(article,'')), 'A') ||
+            setweight(to_tsvector('russian', coalesce(name,'')), 'B')
+        ) STORED
+    );
+    CREATE TABLE product_categories (
+        product_id TEXT REFERENCES products(id) ON DELETE CASCADE,
+        category_id INTEGER REFERENCES categories(id) ON DELETE CASCADE,
+        PRIMARY KEY (product_id, category_id)
+    );
+    INSERT INTO categories VALUES (1, NULL, 'Корень'), (2, 1, 'Подкатегория');
+    INSERT INTO products (id, article, name, price) VALUES ('10', 'A-10', 'Товар', 99.5);
+    INSERT INTO product_categories VALUES ('10', 2);
+'''
+
+
+@requires_database
+class MigrationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.params = reset_database()
+        # Без миграций база еще не проходит проверку схемы при создании
+        with mock.patch.object(CatalogDatabase, '_check_schema'):
+            self.db = CatalogDatabase(**self.params)
+        self.addCleanup(self.db.close)
+
+    def query(self, sql, params=None):
+        conn = psycopg2.connect(**self.params)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                return cur.fetchall()
+        finally:
+            conn.close()
+
+    def test_fresh_database(self):
+        self.assertEqual(self.db.get_schema_version(), 0)
+        self.assertEqual(self.db.migrate(), [version for version, _, _ in MIGRATIONS])
+        self.assertEqual(self.db.get_schema_version(), SCHEMA_VERSION)
+        self.assertEqual(self.query("SELECT status FROM public.catalog_versions"), [('live',)])
+
+        # Повторный запуск ничего не применяет и ничего не меняет
+        self.assertEqual(self.db.migrate(), [])
+        self.assertEqual(self.query("SELECT count(*) FROM public.catalog_versions"), [(1,)])
+
+    def test_legacy_tables_move_to_catalog_schema(self):
+        conn = psycopg2.connect(**self.params)
+        with conn, conn.cursor() as cur:
+            cur.execute(LEGACY_SCHEMA)
+        conn.close()
+
+        self.db.migrate()
+        self.assertEqual(self.db.migrate(), [])
+        self.assertEqual(
+            self.query("SELECT to_regclass('public.products'), to_regclass('catalog.products')::text"),
+            [(None, 'catalog.products')]
+        )
+        self.assertEqual(self.query('SELECT id, article, price FROM catalog.products'), [('10', 'A-10', 99.5)])
+        # Производные данные дерева посчитаны для перенесенных категорий
+        self.assertEqual(
+            self.query('SELECT id, path FROM catalog.categories ORDER BY id'),
+            [(1, 'Корень'), (2, 'Корень > Подкатегория')]
+        )
+        self.assertEqual(self.db.get_products_by_ids(['10'], [])['items'][0]['category_paths'],
+                         ['Корень > Подкатегория'])
+
+    def test_later_migrations_apply_over_squashed_baseline(self):
+        self.db.migrate()
+        # База, в которой вся схема создана одной миграцией 1
+        conn = psycopg2.connect(**self.params)
+        with conn, conn.cursor() as cur:
+            cur.execute('DELETE FROM public.schema_migrations WHERE version > 1')
+        conn.close()
+
+        self.assertEqual(self.db.migrate(), [version for version, _, _ in MIGRATIONS[1:]])
+        self.assertEqual(self.db.get_schema_version(), SCHEMA_VERSION)
+        self.assertEqual(self.query("SELECT count(*) FROM public.catalog_versions WHERE status = 'live'"), [(1,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
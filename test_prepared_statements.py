@@ -0,0 +1,126 @@
+import hashlib
+import logging
+import unittest
+
+from psycopg2 import errors
+
+from prepared_statements import PreparedStatements
+
+logging.disable(logging.CRITICAL)
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeCursor:
+    """Курсор, записывающий запросы; fail - ошибки для следующих EXECUTE"""
+
+    def __init__(self, connection=None):
+        self.connection = connection or FakeConnection()
+        self.queries = []
+        self.fail = []
+
+    def execute(self, query, params=None):
+        self.queries.append((query, tuple(params) if params is not None else None))
+        if query.startswith('EXECUTE') and self.fail:
+            raise self.fail.pop(0)
+
+
+SQL = 'SELECT id FROM products WHERE id = %s AND name LIKE \'a%%\' AND price <= %s'
+
+
+def statement_name(label, sql):
+    return f"{label}_{hashlib.sha1(sql.encode('utf-8')).hexdigest()[:12]}"
+
+
+class PreparedStatementsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.statements = PreparedStatements()
+        self.cur = FakeCursor()
+        self.name = statement_name('product', SQL)
+
+    def test_prepare_once_per_connection(self):
+        self.statements.execute(self.cur, 'product', SQL, ['1', 10])
+        self.statements.execute(self.cur, 'product', SQL, ['2', 20])
+        self.assertEqual(self.cur.queries, [
+            (f"PREPARE {self.name} AS SELECT id FROM products WHERE id = $1 AND name LIKE 'a%' AND price <= $2", None),
+            (f'EXECUTE {self.name} (%s, %s)', ('1', 10)),
+            (f'EXECUTE {self.name} (%s, %s)', ('2', 20)),
+        ])
+
+        other = FakeCursor()
+        self.statements.execute(other, 'product', SQL, ['3', 30])
+        self.assertTrue(other.queries[0][0].startswith(f'PREPARE {self.name} AS'))
+
+        stats = self.statements.stats()['statements']['product']
+        self.assertEqual((stats['calls'], stats['prepares']), (3, 2))
+
+    def test_name_is_label_and_text_hash(self):
+        variant = SQL + ' ORDER BY id'
+        self.statements.execute(self.cur, 'product', SQL, ['1', 10])
+        self.statements.execute(self.cur, 'product', variant, ['1', 10])
+        self.statements.execute(self.cur, 'count', 'SELECT count(*) FROM products')
+        prepared = [query.split()[1] for query, _ in self.cur.queries if query.startswith('PREPARE')]
+        self.assertEqual(prepared, [self.name, statement_name('product', variant),
+                                    statement_name('count', 'SELECT count(*) FROM products')])
+        self.assertNotEqual(prepared[0], prepared[1])
+        self.assertEqual(self.cur.queries[-1], (f'EXECUTE {prepared[2]}', None))
+        # Варианты одного запроса учитываются под одной меткой
+        self.assertEqual(self.statements.stats()['statements']['product']['prepares'], 2)
+
+    def test_invalidate_resets_each_connection_once(self):
+        other = FakeCursor()
+        for cur in (self.cur, other):
+            self.statements.execute(cur, 'product', SQL, ['1', 10])
+        self.statements.invalidate()
+
+        for cur in (self.cur, other):
+            cur.queries.clear()
+            self.statements.execute(cur, 'product', SQL, ['1', 10])
+            self.statements.execute(cur, 'product', SQL, ['1', 10])
+            self.assertEqual([query.split()[0] for query, _ in cur.queries],
+                             ['DEALLOCATE', 'PREPARE', 'EXECUTE', 'EXECUTE'])
+        self.assertEqual(self.statements.stats()['invalidations'], 1)
+
+    def test_stale_statement_is_prepared_again(self):
+        for error in (errors.InvalidSqlStatementName('prepared statement does not exist'),
+                      errors.FeatureNotSupported('cached plan must not change result type')):
+            with self.subTest(error=type(error).__name__):
+                self.statements.execute(self.cur, 'product', SQL, ['1', 10])
+                self.cur.queries.clear()
+                rollbacks = self.cur.connection.rollbacks
+                self.cur.fail.append(error)
+                self.statements.execute(self.cur, 'product', SQL, ['2', 20])
+                self.assertEqual([query.split()[0] for query, _ in self.cur.queries],
+                                 ['EXECUTE', 'DEALLOCATE', 'PREPARE', 'EXECUTE'])
+                self.assertEqual(self.cur.queries[-1], (f'EXECUTE {self.name} (%s, %s)', ('2', 20)))
+                self.assertEqual(self.cur.connection.rollbacks, rollbacks + 1)
+
+    def test_other_errors_propagate(self):
+        self.cur.fail.append(errors.UndefinedTable('relation does not exist'))
+        with self.assertRaises(errors.UndefinedTable):
+            self.statements.execute(self.cur, 'product', SQL, ['1', 10])
+        self.assertEqual(self.cur.connection.rollbacks, 0)
+
+    def test_repeated_failure_propagates(self):
+        self.cur.fail = [errors.InvalidSqlStatementName('gone'), errors.InvalidSqlStatementName('gone again')]
+        with self.assertRaisesRegex(errors.InvalidSqlStatementName, 'gone again'):
+            self.statements.execute(self.cur, 'product', SQL, ['1', 10])
+
+    def test_unprepared_execution(self):
+        self.statements.execute(self.cur, 'search', SQL, ['1', 10], prepare=False)
+        disabled = PreparedStatements(enabled=False)
+        disabled.execute(self.cur, 'product', SQL, ['1', 10])
+        self.assertEqual(self.cur.queries, [(SQL, ('1', 10))] * 2)
+        self.assertEqual(self.statements.stats()['statements']['search']['prepares'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+import json
+import logging
+import unittest
+
+from flask import Flask, jsonify
+
+from response_cache import ResponseCache
+
+logging.disable(logging.CRITICAL)
+
+
+class VersionSource:
+    """Номер живой версии и общий кэш ответов вместо CatalogDatabase"""
+
+    def __init__(self, version=1):
+        self.version = version
+        self.shared = {}
+
+    def get_live_version(self):
+        return self.version
+
+    def get_cached_response(self, key, version):
+        return self.shared.get((key, version))
+
+    def store_cached_response(self, key, version, body):
+        self.shared[(key, version)] = body
+
+    def prune_cached_responses(self, version):
+        self.shared = {entry: body for entry, body in self.shared.items() if entry[1] == version}
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = VersionSource()
+        self.app = Flask(__name__)
+        self.cache = ResponseCache(self.db, max_entries=2)
+        self.calls = []
+
+        @self.app.route('/items')
+        def items():
+            return self.cache.respond(self.produce)
+
+        self.client = self.app.test_client()
+        self.result = lambda: {'call': len(self.calls)}
+
+    def produce(self):
+        self.calls.append(1)
+        return self.result()
+
+    def get(self, query='', **headers):
+        return self.client.get(f'/items{query}', headers=headers)
+
+    def test_hit_and_miss(self):
+        first = self.get('?b=2&a=1')
+        second = self.get('?a=1&b=2')
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertEqual(first.get_data(), second.get_data())
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+        self.assertEqual(len(self.calls), 1)
+
+        self.get('?a=2')
+        self.assertEqual(len(self.calls), 2)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 2, 2))
+
+    def test_key_keeps_repeated_parameter_order(self):
+        self.get('?id=1&id=2&sort=name')
+        self.get('?sort=name&id=1&id=2')
+        self.assertEqual(len(self.calls), 1)
+        self.get('?id=2&id=1&sort=name')
+        # Значение с & не совпадает с двумя параметрами
+        self.get('?id=1%26id%3D2&sort=name')
+        self.assertEqual(len(self.calls), 3)
+
+    def test_new_version_invalidates(self):
+        first = self.get()
+        self.db.version = 2
+        second = self.get()
+        self.assertEqual(len(self.calls), 2)
+        self.assertNotEqual(first.headers['ETag'], second.headers['ETag'])
+        self.assertTrue(second.headers['ETag'].startswith('"2-'))
+
+    def test_lru_eviction(self):
+        self.get('?q=1')
+        self.get('?q=2')
+        self.get('?q=1')
+        # q=2 давно не запрашивался и вытесняется первым
+        self.get('?q=3')
+        self.assertEqual(len(self.calls), 3)
+        self.get('?q=1')
+        self.assertEqual(len(self.calls), 3)
+        self.get('?q=2')
+        self.assertEqual(len(self.calls), 4)
+
+    def test_byte_limit(self):
+        self.cache = ResponseCache(self.db, max_bytes=100)
+        self.result = lambda: {'data': 'x' * 200}
+        self.get()
+        self.get()
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.cache.stats()['bytes'], 0)
+
+    def test_not_modified(self):
+        etag = self.get().headers['ETag']
+        response = self.get(**{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(self.calls), 1)
+
+        self.db.version = 2
+        self.assertEqual(self.get(**{'If-None-Match': etag}).status_code, 200)
+
+    def test_version_change_during_produce_is_not_cached(self):
+        def produce_and_publish():
+            self.db.version = 2
+            return {'call': len(self.calls)}
+
+        self.result = produce_and_publish
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['ETag'].startswith('"1-'))
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+        self.result = lambda: {'call': len(self.calls)}
+        self.get()
+        self.get()
+        self.assertEqual(len(self.calls), 2)
+
+    def test_response_passthrough(self):
+        with self.app.app_context():
+            error = jsonify({'error': 'not found'})
+        for result in (error, ({'error': 'bad request'}, 400)):
+            with self.subTest(result=result):
+                self.result = lambda: result
+                self.calls.clear()
+                response = self.get('?passthrough=1')
+                self.assertNotIn('ETag', response.headers)
+                self.get('?passthrough=1')
+                self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.get('?passthrough=1').status_code, 400)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_shared_tier(self):
+        self.cache = ResponseCache(self.db, shared=True)
+        body = self.get().get_data()
+        self.assertEqual(list(self.db.shared.values()), [body])
+
+        # Другой воркер берет ответ из общего кэша
+        self.cache = ResponseCache(self.db, shared=True)
+        self.assertEqual(json.loads(self.get().get_data()), {'call': 1})
+        self.assertEqual((len(self.calls), self.cache.stats()['shared_hits']), (1, 1))
+
+        self.db.version = 2
+        self.get()
+        self.assertEqual([version for _, version in self.db.shared], [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import contextmanager
+
+from database import CatalogDatabase
+from db_testing import requires_database, reset_database
+from feed_parser import FeedParser
+from search_index import SearchIndex, build_snapshot, snapshot_path
+
+logging.disable(logging.CRITICAL)
+
+# Артикулы, на которых порядок байтов расходится с правилами сортировки базы:
+# регистр, разделители, кириллица, спецсимволы LIKE
+ARTICLES = [
+    'AB-100', 'ab-100', 'AB100', 'AB-1000', 'AB-1001', 'AB.100', 'AB/100', 'AB_100', 'AB%100',
+    'АБ-100', 'аб-100', 'X1', 'X10', 'X100', 'X1000', 'X1000-1', '100', '1000', '10000', 'Z-9',
+]
+# Запросы-артикулы, на которые отвечает снимок
+ARTICLE_QUERIES = ['AB-100', 'ab-100', 'AB-10', 'AB-1', 'AB100', 'AB_1', 'АБ-1', 'X1', 'X100', '1000']
+
+
+class FakeCatalog:
+    """search_documents в формате CatalogDatabase без базы"""
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.rows = rows
+
+    @contextmanager
+    def search_documents(self):
+        yield self.version, iter(self.rows)
+
+
+class SearchIndexTest(unittest.TestCase):
+    """Снимок отвечает только на первую страницу поиска по артикулу или id"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rows = [
+            (f'{i:03d}', article, f'Товар {article}', 10.0 * i, None, None, None, i, rank)
+            for rank, (i, article) in enumerate(sorted(enumerate(ARTICLES), key=lambda row: row[1]))
+        ]
+        rows.sort(key=lambda row: row[0].encode('utf-8'))
+        version = build_snapshot(FakeCatalog(7, rows), self.directory)
+        self.index = SearchIndex(snapshot_path(self.directory, version))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_exact_article_or_id(self):
+        result = self.index.search('AB-100', include_total=True)
+        self.assertEqual([item['article'] for item in result['items']], ['AB-100'])
+        self.assertEqual((result['next_cursor'], result['total_count']), (None, 1))
+        self.assertEqual(self.index.search('011')['items'][0]['article'], 'X1')
+
+    def test_article_prefix(self):
+        result = self.index.search('X100')
+        self.assertEqual([item['article'] for item in result['items']], ['X100'])
+        result = self.index.search('X1000', per_page=1)
+        self.assertEqual([item['article'] for item in result['items']], ['X1000'])
+        result = self.index.search('AB-10')
+        self.assertEqual([item['article'] for item in result['items']], ['AB-100', 'AB-1000', 'AB-1001'])
+        self.assertEqual(self.index.search('AB-10', min_price=20, max_price=30)['items'][0]['article'], 'AB-1000')
+
+    def test_defers_to_database(self):
+        self.assertIsNone(self.index.search('товар'))
+        self.assertIsNone(self.index.search('AB-100', cursor='abc'))
+        self.assertIsNone(self.index.search('Q-1'))
+        # Короткий запрос без точного совпадения: база ищет по словам
+        self.assertIsNone(self.index.search('AB1'))
+        self.assertIsNone(self.index.search('AB-10', max_candidates=2))
+
+
+@requires_database
+class SearchIndexParityTest(unittest.TestCase):
+    """Ответ снимка совпадает с ответом CatalogDatabase.search_products"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db = CatalogDatabase(migrate=True, **reset_database())
+
+        offers = ''.join(
+            f'<offer id="{i:03d}"><vendorCode>{article}</vendorCode><name>Товар {article}</name>'
+            f'<price>{10 * i}</price><categoryId>1</categoryId></offer>'
+            for i, article in enumerate(ARTICLES)
+        )
+        cls.directory = tempfile.mkdtemp()
+        feed = os.path.join(cls.directory, 'feed.xml')
+        with open(feed, 'w', encoding='utf-8') as f:
+            f.write(
+                '<?xml version="1.0" encoding="utf-8"?><yml_catalog><shop>'
+                '<categories><category id="1">Корень</category></categories>'
+                f'<offers>{offers}</offers></shop></yml_catalog>'
+            )
+        FeedParser(feed, cls.db).parse()
+        version = build_snapshot(cls.db, cls.directory)
+        cls.index = SearchIndex(snapshot_path(cls.directory, version))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.directory)
+
+    def test_same_results_as_database(self):
+        for query in ARTICLE_QUERIES:
+            self.assertIsNotNone(self.index.search(query), query)
+
+        queries = ARTICLE_QUERIES + ['товар', 'AB1', 'Q-1', '011', '%1', 'X']
+        filters = [(None, None), (20, None), (None, 100), (50, 150)]
+        for query in queries:
+            for min_price, max_price in filters:
+                for per_page in (1, 2, 50):
+                    with self.subTest(query=query, min_price=min_price, max_price=max_price, per_page=per_page):
+                        result = self.index.search(query, None, per_page, min_price, max_price, True)
+                        if result is not None:
+                            expected = self.db.search_products(query, None, per_page, None, min_price, max_price, True)
+                            self.assertEqual(result, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import logging
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from single_flight import SingleFlight, coalesced
+
+logging.disable(logging.CRITICAL)
+
+
+class SlowCall:
+    """Вызов, который выполняется, пока тест его не отпустит"""
+
+    def __init__(self, result='result', error=None):
+        self.result = result
+        self.error = error
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.count += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def wait_for_waiters(flight, key, waiters):
+    """Ожидание, пока на вызов key встанут waiters потоков"""
+    for _ in range(500):
+        with flight._lock:
+            call = flight._calls.get(key)
+            if call is not None and call.waiters >= waiters:
+                return
+        threading.Event().wait(0.01)
+    raise AssertionError(f'{waiters} ожидающих вызова {key!r} не дождались')
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPoolExecutor(max_workers=8)
+
+    def tearDown(self):
+        self.pool.shutdown(wait=True)
+
+    def run_concurrently(self, flight, key, fn, waiters):
+        leader = self.pool.submit(flight.do, key, fn)
+        fn.started.wait(5)
+        followers = [self.pool.submit(flight.do, key, fn) for _ in range(waiters)]
+        wait_for_waiters(flight, key, waiters)
+        fn.release.set()
+        return leader, followers
+
+    def test_concurrent_calls_are_coalesced(self):
+        flight = SingleFlight(timeout=5)
+        fn = SlowCall()
+        leader, followers = self.run_concurrently(flight, 'key', fn, waiters=5)
+        self.assertEqual([future.result(5) for future in [leader, *followers]], ['result'] * 6)
+        self.assertEqual(fn.count, 1)
+        stats = flight.stats()
+        self.assertEqual((stats['calls'], stats['executed'], stats['coalesced']), (6, 1, 5))
+        self.assertEqual((stats['max_waiters'], stats['in_flight']), (5, 0))
+
+        # Завершенный вызов не кэшируется: следующий выполняется снова
+        self.assertEqual(flight.do('key', fn), 'result')
+        self.assertEqual(fn.count, 2)
+
+    def test_different_keys_run_separately(self):
+        flight = SingleFlight(timeout=5)
+        first, second = SlowCall('first'), SlowCall('second')
+        futures = [self.pool.submit(flight.do, 'a', first), self.pool.submit(flight.do, 'b', second)]
+        first.started.wait(5)
+        second.started.wait(5)
+        first.release.set()
+        second.release.set()
+        self.assertEqual([future.result(5) for future in futures], ['first', 'second'])
+
+    def test_exception_reaches_waiters(self):
+        flight = SingleFlight(timeout=5)
+        fn = SlowCall(error=ValueError('broken'))
+        leader, followers = self.run_concurrently(flight, 'key', fn, waiters=3)
+        for future in [leader, *followers]:
+            with self.assertRaisesRegex(ValueError, 'broken'):
+                future.result(5)
+        self.assertEqual(fn.count, 1)
+        self.assertEqual(flight.stats()['in_flight'], 0)
+
+    def test_wait_timeout_runs_call_itself(self):
+        flight = SingleFlight(timeout=0.05)
+        hung = SlowCall('hung')
+        leader = self.pool.submit(flight.do, 'key', hung)
+        hung.started.wait(5)
+        self.assertEqual(flight.do('key', lambda: 'own'), 'own')
+        stats = flight.stats()
+        self.assertEqual((stats['timeouts'], stats['executed']), (1, 2))
+        hung.release.set()
+        self.assertEqual(leader.result(5), 'hung')
+
+    def test_disabled(self):
+        flight = SingleFlight(timeout=0)
+        fn = SlowCall()
+        fn.release.set()
+        self.assertEqual([flight.do('key', fn) for _ in range(2)], ['result'] * 2)
+        self.assertEqual((fn.count, flight.stats()['in_flight']), (2, 0))
+
+
+class RecordingFlight(SingleFlight):
+    """SingleFlight, запоминающий ключи вызовов"""
+
+    def __init__(self):
+        super().__init__(timeout=5)
+        self.keys = []
+
+    def do(self, key, fn):
+        self.keys.append(key)
+        return super().do(key, fn)
+
+
+class Reader:
+
+    def __init__(self):
+        self._flight = RecordingFlight()
+        self.calls = []
+
+    @coalesced
+    def get(self, item_id, page=1, per_page=50):
+        self.calls.append((item_id, page, per_page))
+        return [item_id, page, per_page]
+
+    @coalesced
+    def count(self, item_id):
+        return item_id
+
+
+class CoalescedTest(unittest.TestCase):
+
+    def test_key_normalises_arguments(self):
+        reader = Reader()
+        self.assertEqual(reader.get(1), [1, 1, 50])
+        reader.get(1, page=1)
+        reader.get(1, 1, 50)
+        reader.get(item_id=1, per_page=50)
+        reader.get(1, per_page=20)
+        reader.count(1)
+        self.assertEqual(reader._flight.keys, [('get', 1, 1, 50)] * 4 + [('get', 1, 1, 20), ('count', 1)])
+        self.assertEqual(reader.calls[-1], (1, 1, 20))
+
+    def test_key_skips_self(self):
+        first, second = Reader(), Reader()
+        first.get(1)
+        second.get(1)
+        self.assertEqual(first._flight.keys, second._flight.keys)
+
+    def test_concurrent_method_calls_are_coalesced(self):
+        reader = Reader()
+        reader._flight = SingleFlight(timeout=5)
+        release = threading.Event()
+        original = Reader.get.__wrapped__
+
+        def slow_get(self, item_id, page=1, per_page=50):
+            release.wait(5)
+            return original(self, item_id, page, per_page)
+
+        slow = coalesced(slow_get)
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [pool.submit(slow, reader, 7), pool.submit(slow, reader, 7, page=1)]
+            wait_for_waiters(reader._flight, ('slow_get', 7, 1, 50), 1)
+            release.set()
+            results = [future.result(5) for future in futures]
+        self.assertEqual(results, [[7, 1, 50]] * 2)
+        self.assertIs(results[0], results[1])
+        self.assertEqual(reader.calls, [(7, 1, 50)])
+
+
+if __name__ == '__main__':
+    unittest.main()